@@ -0,0 +1,75 @@
+"""
+Time the admin dashboard poll and paginated listings take with many
+connected users - admin.json reads maintained counters and the first page
+of channels, users and channels are listed page by page.
+
+Usage:
+
+    python benchmarks/bench_admin_stats.py [--users 200000] [--channels 1000]
+"""
+import argparse
+import time
+import uuid
+
+from pyramid import testing
+from webob.multidict import MultiDict
+
+from channelstream import operations
+from channelstream.wsgi_views.server import ServerViews
+
+
+def build_state(users, channels):
+    for i in range(users):
+        operations.connect(
+            username="user{}".format(i),
+            fresh_user_state={"name": "user{}".format(i)},
+            state_public_keys=["name"],
+            update_user_state={},
+            conn_id=uuid.uuid4(),
+            channels=["bench{}".format(i % channels)],
+            channel_configs={},
+            publish=False,
+        )
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--users", type=int, default=200000)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    build_state(args.users, args.channels)
+    request = testing.DummyRequest()
+    views = ServerViews(request)
+
+    def query(view, **params):
+        def call():
+            request.GET = MultiDict(params)
+            return view()
+
+        return call
+
+    cases = [
+        ("admin.json", views.admin_json),
+        ("users.json first page", query(views.admin_users)),
+        ("users.json last page", query(views.admin_users, offset=args.users - 100)),
+        ("users.json name filter", query(views.admin_users, name="user1")),
+        ("channels.json first page", query(views.admin_channels)),
+    ]
+    print("{:>26} {:>10}".format("request", "ms"))
+    for name, call in cases:
+        print("{:>26} {:>10.2f}".format(name, best_time(call, args.repeat) * 1000))
+
+
+if __name__ == "__main__":
+    main()
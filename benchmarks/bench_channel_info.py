@@ -0,0 +1,87 @@
+"""
+Cost of channel info returned by /connect, /subscribe and /info during
+a login storm - info of the same hot channels is requested over and over,
+either rebuilt every time (channel version bumped before every request) or
+served from cached info snapshots.
+
+Usage:
+
+    python benchmarks/bench_channel_info.py [--users 5000] [--requests 1000]
+"""
+import argparse
+import time
+import uuid
+
+from channelstream import operations
+from channelstream.server_state import get_state
+from channelstream.wsgi_views.server import SharedUtils
+
+INFO_CONFIG = {
+    "include_history": True,
+    "include_users": True,
+    "exclude_channels": [],
+    "include_connections": False,
+    "return_public_state": True,
+}
+
+
+def build_state(users, channels, messages):
+    config = {"store_history": True, "history_size": messages}
+    channel_configs = {"hot{}".format(i): config for i in range(channels)}
+    for i in range(users):
+        operations.connect(
+            username="user{}".format(i),
+            fresh_user_state={"name": "user{}".format(i), "status": "online"},
+            state_public_keys=["status"],
+            update_user_state={},
+            conn_id=uuid.uuid4(),
+            channels=list(channel_configs),
+            channel_configs=channel_configs,
+            publish=False,
+        )
+    server_state = get_state()
+    for i in range(channels * messages):
+        msg = {
+            "uuid": uuid.uuid4(),
+            "type": "message",
+            "user": "user0",
+            "channel": "hot{}".format(i % channels),
+            "message": {"text": "message {}".format(i)},
+        }
+        operations.pass_message(msg, server_state.stats, publish=False)
+    return list(channel_configs)
+
+
+def measure(channel_names, requests, rebuild):
+    server_state = get_state()
+    shared_utils = SharedUtils(None)
+    start = time.perf_counter()
+    for _ in range(requests):
+        if rebuild:
+            for name in channel_names:
+                server_state.channels[name].bump_version()
+        shared_utils.get_common_info(channel_names, INFO_CONFIG)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+
+    channel_names = build_state(args.users, args.channels, args.messages)
+    rebuilt = measure(channel_names, args.requests, rebuild=True)
+    cached = measure(channel_names, args.requests, rebuild=False)
+    print("{:>12} {:>12} {:>8}".format("rebuilt ms", "cached ms", "speedup"))
+    print(
+        "{:>12.3f} {:>12.3f} {:>7.1f}x".format(
+            rebuilt * 1000, cached * 1000, rebuilt / cached
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compares per-connection heartbeat greenlets with the bucketed heartbeat
+scheduler - memory held by scheduled heartbeats and CPU time of one
+heartbeat round for growing number of connections.
+
+Usage:
+
+    python benchmarks/bench_heartbeat.py [--sizes 1000,10000,100000]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import time
+import tracemalloc
+import uuid
+
+import gevent
+
+from channelstream import heartbeat, patched_json as json
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+
+
+class NullSocket(object):
+    terminated = False
+
+    def send(self, payload):
+        pass
+
+    def ping(self, message):
+        pass
+
+
+def make_connections(count):
+    server_state = get_state()
+    server_state.users = {"bench": User("bench")}
+    server_state.heartbeat_buckets = {}
+    server_state.expiring_connections = []
+    connections = []
+    for i in range(count):
+        connection = Connection("bench", uuid.uuid4())
+        connection.socket = NullSocket()
+        connections.append(connection)
+    return connections
+
+
+def legacy_heartbeat(connection):
+    # what every connection greenlet did before: encode [] and send it
+    while True:
+        gevent.sleep(3600)
+        connection.socket.send(json.encode_messages([]))
+
+
+def measure_greenlets(connections):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    greenlets = [gevent.spawn(legacy_heartbeat, c) for c in connections]
+    gevent.sleep(0)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    start = time.process_time()
+    for connection in connections:
+        connection.socket.send(json.encode_messages([]))
+    elapsed = time.process_time() - start
+    gevent.killall(greenlets)
+    return size, elapsed
+
+
+def measure_scheduler(connections):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for connection in connections:
+        heartbeat.track_connection(connection, now=0)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    start = time.process_time()
+    heartbeat.beat(now=3600)
+    elapsed = time.process_time() - start
+    return size, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    args = parser.parse_args()
+
+    print(
+        "{:>10} {:>14} {:>14} {:>14} {:>14}".format(
+            "conns", "greenlets MB", "buckets MB", "greenlets ms", "buckets ms"
+        )
+    )
+    for size in [int(s) for s in args.sizes.split(",")]:
+        connections = make_connections(size)
+        legacy_mem, legacy_time = measure_greenlets(connections)
+        sched_mem, sched_time = measure_scheduler(connections)
+        print(
+            "{:>10} {:>14.2f} {:>14.2f} {:>14.1f} {:>14.1f}".format(
+                size,
+                legacy_mem / 1024 ** 2,
+                sched_mem / 1024 ** 2,
+                legacy_time * 1000,
+                sched_time * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Write throughput and read latency of history backends - messages are added
+to channels that store history, reads fetch whole channel history (as info
+requests do) and single messages by uuid (as edits and deletes do).
+
+Usage:
+
+    python benchmarks/bench_history.py [--messages 20000] [--history-size 1000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from channelstream import history
+from channelstream.channel import Channel
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def make_backend(name, path):
+    if name == "memory":
+        return history.MemoryHistory()
+    return history.SQLiteHistory(path)
+
+
+def measure(backend, messages, history_size, channels):
+    history.use_backend(backend)
+    config = {"store_history": True, "history_size": history_size}
+    channel_list = [
+        Channel("bench{}".format(i), channel_config=config) for i in range(channels)
+    ]
+    sent = []
+    start = time.perf_counter()
+    for i in range(messages):
+        message = {
+            "type": "message",
+            "uuid": uuid.uuid4(),
+            "user": "bench",
+            "timestamp": datetime.utcnow(),
+            "message": {"text": "message {}".format(i)},
+        }
+        channel = channel_list[i % channels]
+        channel.add_message(message)
+        sent.append((channel, message["uuid"]))
+    write_rate = messages / (time.perf_counter() - start)
+
+    full_reads = []
+    for channel in channel_list:
+        start = time.perf_counter()
+        channel.get_info(include_history=True)
+        full_reads.append(time.perf_counter() - start)
+
+    lookups = []
+    retained = sent[-history_size * channels :]
+    for channel, message_uuid in random.sample(retained, min(1000, len(retained))):
+        start = time.perf_counter()
+        channel.history.get(message_uuid)
+        lookups.append(time.perf_counter() - start)
+    return (
+        write_rate,
+        percentile(full_reads, 0.5) * 1000,
+        percentile(full_reads, 0.99) * 1000,
+        percentile(lookups, 0.5) * 1000000,
+        percentile(lookups, 0.99) * 1000000,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--history-size", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=10)
+    args = parser.parse_args()
+
+    print(
+        "{:>8} {:>12} {:>12} {:>12} {:>12} {:>12}".format(
+            "backend",
+            "writes/s",
+            "read p50 ms",
+            "read p99 ms",
+            "get p50 us",
+            "get p99 us",
+        )
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ["memory", "sqlite"]:
+            path = os.path.join(directory, "history.sqlite")
+            backend = make_backend(name, path)
+            results = measure(backend, args.messages, args.history_size, args.channels)
+            print(
+                "{:>8} {:>12.0f} {:>12.2f} {:>12.2f} {:>12.1f} {:>12.1f}".format(
+                    name, *results
+                )
+            )
+            backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Throughput of a single large POST to /message - messages are validated and
+passed either by a greenlet spawned per message or by the ingest worker pool,
+until every subscriber got them. Subscribers check that messages of every
+channel arrive in order.
+
+Usage:
+
+    python benchmarks/bench_ingest.py [--messages 10000] [--channels 10]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import gc
+import json
+import time
+import uuid
+
+import gevent
+
+from channelstream import ingest, operations
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.user import User
+from channelstream.validation import schemas
+
+
+class CheckingSocket(object):
+    terminated = False
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.last = -1
+
+    def send(self, payload):
+        self.stats["frames"] += 1
+        for message in json.loads(payload):
+            number = message["message"]["no"]
+            self.stats["delivered"] += 1
+            if number < self.last:
+                self.stats["out_of_order"] += 1
+            self.last = number
+
+    def ping(self, message):
+        pass
+
+
+def build_state(channels, subscribers, stats):
+    server_state = get_state()
+    server_state.users = {}
+    server_state.channels = {}
+    server_state.expiring_connections = []
+    connections = []
+    for c in range(channels):
+        channel = Channel("bench{}".format(c))
+        server_state.channels[channel.name] = channel
+        for i in range(subscribers):
+            username = "bench{}-{}".format(c, i)
+            server_state.users[username] = User(username)
+            connection = Connection(username, uuid.uuid4())
+            connection.socket = CheckingSocket(stats)
+            channel.add_connection(connection)
+            connections.append(connection)
+    return connections
+
+
+def make_body(messages, channels):
+    return [
+        {
+            "type": "message",
+            "user": "bench",
+            "channel": "bench{}".format(i % channels),
+            "message": {"no": i},
+        }
+        for i in range(messages)
+    ]
+
+
+def spawn_per_message(data, stats):
+    greenlets = [
+        gevent.spawn(operations.pass_message, msg, stats, publish=False)
+        for msg in data
+    ]
+    gevent.joinall(greenlets)
+
+
+def ingest_pipeline(data, stats):
+    ingest.submit(data, stats)
+    while ingest.get_stats()["depth"]:
+        gevent.sleep(0.001)
+    # last batches taken by workers
+    gevent.sleep(0)
+
+
+def measure(mode, args):
+    stats = {"delivered": 0, "out_of_order": 0, "frames": 0}
+    connections = build_state(args.channels, args.subscribers, stats)
+    body = make_body(args.messages, args.channels)
+    schema = schemas.MessageBodySchema(many=True)
+    gc.collect()
+    start = time.perf_counter()
+    data = schema.load(body)
+    validated = time.perf_counter()
+    if mode == "spawn":
+        spawn_per_message(data, get_state().stats)
+    else:
+        ingest_pipeline(data, get_state().stats)
+    # wait for outboxes of busy connections to be written
+    while any(c.outbox for c in connections):
+        gevent.sleep(0.001)
+    end = time.perf_counter()
+    dropped = sum(c.outbox.dropped for c in connections if c.outbox is not None)
+    return (
+        args.messages / (end - start),
+        args.messages / (end - validated),
+        stats["frames"],
+        dropped,
+        stats["out_of_order"],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    ingest.configure(batch_size=args.batch_size)
+
+    print(
+        "{:>8} {:>12} {:>14} {:>10} {:>10} {:>14}".format(
+            "mode", "msgs/s", "pass msgs/s", "frames", "dropped", "out of order"
+        )
+    )
+    for mode in ["spawn", "ingest"]:
+        results = measure(mode, args)
+        print(
+            "{:>8} {:>12.0f} {:>14.0f} {:>10} {:>10} {:>14}".format(mode, *results)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Size of state snapshots and time needed to write and load them - users with
+state are connected to channels storing history, snapshot is written like
+on shutdown and loaded into empty state like on warm restart.
+
+Usage:
+
+    python benchmarks/bench_snapshot.py [--users 1000000] [--channels 1000]
+"""
+import argparse
+import gc
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from channelstream import operations, snapshot
+from channelstream.server_state import get_state
+
+
+def build_state(users, channels, messages):
+    server_state = get_state()
+    config = {"store_history": True, "history_size": messages}
+    channel_configs = {"bench{}".format(i): config for i in range(channels)}
+    for i in range(users):
+        operations.connect(
+            username="user{}".format(i),
+            fresh_user_state={"name": "user{}".format(i), "status": "online"},
+            state_public_keys=["status"],
+            update_user_state={},
+            conn_id=uuid.uuid4(),
+            channels=["bench{}".format(i % channels)],
+            channel_configs=channel_configs,
+            publish=False,
+        )
+    for i in range(channels * messages):
+        msg = {
+            "uuid": uuid.uuid4(),
+            "timestamp": datetime.utcnow(),
+            "user": "user0",
+            "channel": "bench{}".format(i % channels),
+            "message": {"text": "message {}".format(i)},
+            "no_history": False,
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        operations.pass_message(msg, server_state.stats, publish=False)
+
+
+def reset_state():
+    server_state = get_state()
+    server_state.channels = {}
+    server_state.connections = {}
+    server_state.users = {}
+    server_state.expiring_connections = []
+    server_state.expiring_users = []
+    server_state.active_user_count = 0
+    server_state.remote_connection_count = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=10)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    build_state(args.users, args.channels, args.messages)
+    print("built state in {:.1f}s".format(time.perf_counter() - start))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "state.snapshot")
+        gc.collect()
+        start = time.perf_counter()
+        size = snapshot.save(path)
+        save_time = time.perf_counter() - start
+        reset_state()
+        gc.collect()
+        start = time.perf_counter()
+        snapshot.load(path)
+        load_time = time.perf_counter() - start
+
+    server_state = get_state()
+    print(
+        "users {} connections {} channels {}".format(
+            len(server_state.users),
+            len(server_state.connections),
+            len(server_state.channels),
+        )
+    )
+    print("{:>12} {:>12} {:>12}".format("size MB", "save s", "load s"))
+    print(
+        "{:>12.1f} {:>12.2f} {:>12.2f}".format(size / 1024 / 1024, save_time, load_time)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Stress test for partitioned state locks - runs concurrent connect,
+subscribe, unsubscribe, publish and GC greenlets and reports throughput
+and time spent waiting for locks.
+
+Usage:
+
+    python benchmarks/bench_state_locks.py [--workers 50] [--iterations 500]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import random
+import time
+import uuid
+
+import gevent
+
+from channelstream import gc, operations
+from channelstream.server_state import get_state
+
+
+class YieldingSocket(object):
+    terminated = False
+
+    def send(self, payload):
+        gevent.sleep(0)
+
+    def close(self):
+        self.terminated = True
+
+
+def worker(seed, iterations, channels, counters):
+    server_state = get_state()
+    rand = random.Random(seed)
+    configs = {c: {"notify_presence": True} for c in channels}
+    for i in range(iterations):
+        action = rand.choice(["connect", "subscribe", "unsubscribe", "publish"])
+        connections = list(server_state.connections.values())
+        if action == "connect" or not connections:
+            connection, user = operations.connect(
+                username="user_{}".format(rand.randint(0, 1000)),
+                fresh_user_state={},
+                state_public_keys=[],
+                update_user_state={},
+                conn_id=uuid.uuid4(),
+                channels=rand.sample(channels, 3),
+                channel_configs=configs,
+            )
+            connection.socket = YieldingSocket()
+        elif action == "subscribe":
+            operations.subscribe(
+                connection=rand.choice(connections),
+                channels=rand.sample(channels, 3),
+                channel_configs=configs,
+            )
+        elif action == "unsubscribe":
+            operations.unsubscribe(
+                connection=rand.choice(connections),
+                unsubscribe_channels=rand.sample(channels, 3),
+            )
+        else:
+            msg = {
+                "uuid": uuid.uuid4(),
+                "user": "system",
+                "channel": rand.choice(channels),
+                "message": {"text": "hello"},
+                "no_history": False,
+                "pm_users": [],
+                "exclude_users": [],
+            }
+            operations.pass_message(msg, server_state.stats)
+        counters[action] = counters.get(action, 0) + 1
+
+
+def gc_worker(stop):
+    server_state = get_state()
+    rand = random.Random(0)
+    while not stop:
+        connections = list(server_state.connections.values())
+        for connection in rand.sample(connections, min(len(connections), 5)):
+            connection.mark_for_gc()
+        gc.gc_conns()
+        gevent.sleep(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--workers", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--channels", type=int, default=200)
+    args = parser.parse_args()
+
+    server_state = get_state()
+    channels = ["chan_{}".format(i) for i in range(args.channels)]
+    counters = {}
+    stop = []
+    gc_greenlet = gevent.spawn(gc_worker, stop)
+    start = time.perf_counter()
+    greenlets = [
+        gevent.spawn(worker, seed, args.iterations, channels, counters)
+        for seed in range(args.workers)
+    ]
+    gevent.joinall(greenlets, raise_error=True)
+    elapsed = time.perf_counter() - start
+    stop.append(True)
+    gc_greenlet.join()
+
+    total = sum(counters.values())
+    print(
+        "operations: {} in {:.2f}s ({:.0f} ops/s)".format(
+            total, elapsed, total / elapsed
+        )
+    )
+    for action, count in sorted(counters.items()):
+        print("  {:<12} {}".format(action, count))
+    print("lock usage:")
+    for kind, stats in server_state.lock_stats().items():
+        print(
+            "  {:<9} acquisitions:{:<8} contended:{:<6} wait:{}ms".format(
+                kind, stats["acquisitions"], stats["contended"], stats["wait_time_ms"]
+            )
+        )
+    print("gc: {}".format(server_state.gc_stats["conns"]))
+
+
+if __name__ == "__main__":
+    main()
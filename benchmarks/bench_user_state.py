@@ -0,0 +1,70 @@
+"""
+Measures /user_state throughput against total number of channels on
+the server, the user itself is subscribed to a handful of channels.
+
+Usage:
+
+    python benchmarks/bench_user_state.py [--calls 2000] [--sizes 100,1000]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import time
+import uuid
+
+import mock
+from pyramid import testing
+
+from channelstream import operations
+from channelstream.server_state import get_state
+
+
+def populate(total_channels, own_channels=5):
+    server_state = get_state()
+    server_state.channels = {}
+    server_state.connections = {}
+    server_state.users = {}
+    configs = {}
+    own = ["own_{}".format(i) for i in range(own_channels)]
+    for name in own:
+        configs[name] = {"notify_state": True}
+    operations.set_channel_config(
+        {"chan_{}".format(i): {} for i in range(total_channels - own_channels)}
+    )
+    operations.connect(
+        username="bench",
+        fresh_user_state={},
+        state_public_keys=["status"],
+        update_user_state={},
+        conn_id=uuid.uuid4(),
+        channels=own,
+        channel_configs=configs,
+    )
+
+
+def main():
+    from channelstream.wsgi_views.server import user_state
+
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--sizes", default="100,1000,10000,100000")
+    args = parser.parse_args()
+    testing.setUp(settings={})
+
+    print("{:>10} {:>14}".format("channels", "calls/s"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        populate(size)
+        request = testing.DummyRequest()
+        request.handle_cors = mock.Mock()
+        start = time.perf_counter()
+        for i in range(args.calls):
+            request.json_body = {"user": "bench", "user_state": {"status": i}}
+            user_state(request)
+        elapsed = time.perf_counter() - start
+        print("{:>10} {:>14.0f}".format(size, args.calls / elapsed))
+
+
+if __name__ == "__main__":
+    main()
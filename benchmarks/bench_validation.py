@@ -0,0 +1,135 @@
+"""
+Cost of validating request bodies - payloads are loaded by a new schema like
+views used to do and by cached compiled validators. /message bodies are
+validated as batches, connect and subscribe bodies are validated one by one
+as many times as the batch size.
+
+Usage:
+
+    python benchmarks/bench_validation.py [--repeat 3]
+"""
+import argparse
+import time
+import uuid
+
+from pyramid import testing
+
+from channelstream.connection import Connection
+from channelstream.server_state import get_state
+from channelstream.validation import compiled, schemas
+
+BATCH_SIZES = [1, 10, 100, 1000, 10000]
+
+
+def make_message(i):
+    return {
+        "type": "message",
+        "user": "user{}".format(i),
+        "channel": "bench{}".format(i % 10),
+        "message": {"text": "message {}".format(i)},
+        "pm_users": [],
+    }
+
+
+def make_connect(i):
+    return {
+        "username": "user{}".format(i),
+        "conn_id": str(uuid.uuid4()),
+        "channels": ["bench{}".format(i % 10), "notify"],
+        "fresh_user_state": {"name": "user{}".format(i), "status": "online"},
+        "user_state": {"status": "online"},
+        "state_public_keys": ["status"],
+        "channel_configs": {"notify": {"notify_presence": True}},
+    }
+
+
+def make_subscribe(i, conn_id):
+    return {
+        "conn_id": str(conn_id),
+        "channels": ["bench{}".format(i % 10)],
+        "channel_configs": {"bench{}".format(i % 10): {"store_history": True}},
+    }
+
+
+def schema_messages(bodies, request):
+    schemas.MessageBodySchema(context={"request": request}, many=True).load(bodies)
+
+
+def compiled_messages(bodies, request):
+    compiled.load(schemas.MessageBodySchema, bodies, request, many=True)
+
+
+def schema_each(schema_cls):
+    def load(bodies, request):
+        for body in bodies:
+            schema_cls(context={"request": request}).load(body)
+
+    return load
+
+
+def compiled_each(schema_cls):
+    def load(bodies, request):
+        for body in bodies:
+            compiled.load(schema_cls, body, request)
+
+    return load
+
+
+def best_time(function, bodies, request, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(bodies, request)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    conn_id = uuid.uuid4()
+    get_state().connections[conn_id] = Connection("bench", conn_id)
+    request = testing.DummyRequest()
+    cases = [
+        ("message", make_message, schema_messages, compiled_messages),
+        (
+            "connect",
+            make_connect,
+            schema_each(schemas.ConnectBodySchema),
+            compiled_each(schemas.ConnectBodySchema),
+        ),
+        (
+            "subscribe",
+            lambda i: make_subscribe(i, conn_id),
+            schema_each(schemas.SubscribeBodySchema),
+            compiled_each(schemas.SubscribeBodySchema),
+        ),
+    ]
+
+    print(
+        "{:>10} {:>7} {:>14} {:>14} {:>8}".format(
+            "body", "batch", "schema us/it", "compiled us/it", "speedup"
+        )
+    )
+    for name, make_body, load_schema, load_compiled in cases:
+        for size in BATCH_SIZES:
+            bodies = [make_body(i) for i in range(size)]
+            # warm up compiled validator cache
+            load_compiled(bodies[:1], request)
+            schema_time = best_time(load_schema, bodies, request, args.repeat)
+            compiled_time = best_time(load_compiled, bodies, request, args.repeat)
+            print(
+                "{:>10} {:>7} {:>14.1f} {:>14.1f} {:>7.1f}x".format(
+                    name,
+                    size,
+                    schema_time / size * 1e6,
+                    compiled_time / size * 1e6,
+                    schema_time / compiled_time,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
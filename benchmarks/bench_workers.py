@@ -0,0 +1,213 @@
+"""
+Measures message throughput of a running server as number of worker
+processes grows - every published message has to reach websocket clients
+connected to all of the workers.
+
+The script starts channelstream for every worker count, connects
+websocket clients from separate receiver processes, publishes messages
+through the /message API and waits until every client got every message.
+
+Usage:
+
+    python benchmarks/bench_workers.py [--workers 1,2,4] [--clients 400]
+                                       [--messages 2000] [--port 8711]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import gevent
+import gevent.event
+import requests
+from itsdangerous import TimestampSigner
+from ws4py.client.geventclient import WebSocketClient
+
+from channelstream import patched_json as json
+
+SECRET = "bench_secret"
+CHANNEL = "bench"
+
+
+def headers():
+    signature = TimestampSigner(SECRET).sign("channelstream").decode("utf8")
+    return {"x-channelstream-secret": signature}
+
+
+def wait_for_server(url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url + "/info", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start")
+
+
+def start_server(port, workers):
+    env = dict(os.environ)
+    env.update(
+        {
+            "CHANNELSTREAM_PORT": str(port),
+            "CHANNELSTREAM_HOST": "127.0.0.1",
+            "CHANNELSTREAM_SECRET": SECRET,
+            "CHANNELSTREAM_WORKERS": str(workers),
+            "CHANNELSTREAM_LOG_LEVEL": "WARNING",
+        }
+    )
+    cmd = [sys.executable, "-c", "from channelstream.cli.start import main; main()"]
+    return subprocess.Popen(cmd, env=env)
+
+
+def receive(port, clients, expected):
+    """ Receiver process - connects clients and counts delivered messages """
+    url = "http://127.0.0.1:{}".format(port)
+    counts = []
+    finished = gevent.event.Event()
+    last_delivery = [0.0]
+
+    def on_message(index, message):
+        payload = json.loads(message.data)
+        delivered = len([m for m in payload if m.get("type") == "message"])
+        if delivered:
+            counts[index] += delivered
+            last_delivery[0] = time.time()
+            if sum(counts) >= expected * clients:
+                finished.set()
+
+    sockets = []
+    for index in range(clients):
+        response = requests.post(
+            url + "/connect",
+            json={"username": "user_{}_{}".format(os.getpid(), index)},
+            headers=headers(),
+        )
+        conn_id = response.json()["conn_id"]
+        ws_url = "ws://127.0.0.1:{}/ws?conn_id={}".format(port, conn_id)
+        ws = WebSocketClient(ws_url)
+        ws.connect()
+        counts.append(0)
+        sockets.append(ws)
+        requests.post(
+            url + "/subscribe",
+            json={"conn_id": conn_id, "channels": [CHANNEL]},
+            headers=headers(),
+        )
+
+    def read(index, ws):
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            on_message(index, message)
+
+    for index, ws in enumerate(sockets):
+        gevent.spawn(read, index, ws)
+    print("ready", flush=True)
+    finished.wait(timeout=120)
+    print("done {} {:.6f}".format(sum(counts), last_delivery[0]), flush=True)
+
+
+def publish(port, messages, batch_size=50, publishers=4):
+    url = "http://127.0.0.1:{}/message".format(port)
+
+    def worker(count):
+        session = requests.Session()
+        sent = 0
+        while sent < count:
+            size = min(batch_size, count - sent)
+            batch = [
+                {"channel": CHANNEL, "user": "bench", "message": {"n": sent + i}}
+                for i in range(size)
+            ]
+            session.post(url, json=batch, headers=headers())
+            sent += size
+
+    per_publisher = messages // publishers
+    greenlets = [gevent.spawn(worker, per_publisher) for _ in range(publishers)]
+    gevent.joinall(greenlets, raise_error=True)
+    return per_publisher * publishers
+
+
+def run(workers, args):
+    server = start_server(args.port, workers)
+    receivers = []
+    try:
+        wait_for_server("http://127.0.0.1:{}".format(args.port))
+        per_receiver = args.clients // args.receivers
+        messages = args.messages // 4 * 4
+        for _ in range(args.receivers):
+            cmd = [
+                sys.executable,
+                __file__,
+                "--receive",
+                str(per_receiver),
+                "--port",
+                str(args.port),
+                "--messages",
+                str(messages),
+            ]
+            receivers.append(
+                subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+            )
+        for proc in receivers:
+            assert proc.stdout.readline().strip() == "ready"
+        start = time.time()
+        publish(args.port, messages)
+        published = time.time() - start
+        delivered = 0
+        finished = start
+        for proc in receivers:
+            _, count, last = proc.stdout.readline().split()
+            delivered += int(count)
+            finished = max(finished, float(last))
+        elapsed = finished - start
+        print(
+            "{:<8} {:>10.0f} {:>14.0f} {:>10.2f} {:>10}/{}".format(
+                workers,
+                messages / published,
+                delivered / elapsed,
+                elapsed,
+                delivered,
+                messages * per_receiver * args.receivers,
+            )
+        )
+    finally:
+        for proc in receivers:
+            proc.kill()
+        server.terminate()
+        server.wait()
+        time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--clients", type=int, default=400)
+    parser.add_argument("--receivers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--port", type=int, default=8711)
+    parser.add_argument("--receive", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.receive is not None:
+        receive(args.port, args.receive, args.messages)
+        return
+
+    print(
+        "{:<8} {:>10} {:>14} {:>10} {:>12}".format(
+            "workers", "publish/s", "deliveries/s", "time(s)", "delivered"
+        )
+    )
+    for workers in [int(w) for w in args.workers.split(",")]:
+        run(workers, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Backplane carries state changing operations between channelstream
+processes - worker processes of one server or nodes of a cluster.
+
+Every process applies operations published by others to its own copy of
+the state, so channel membership and presence are eventually consistent
+everywhere, while messages are delivered to a connection only by the
+process serving its socket. Implementations are selected with
+`backplane` setting and pass received operations to `handler`.
+"""
+import abc
+import importlib
+import logging
+import os
+import socket
+from typing import Dict, List
+
+import gevent
+from gevent.queue import Queue
+
+from channelstream import bus, patched_json as json
+
+log = logging.getLogger(__name__)
+
+# how long to wait before reconnecting to the broker
+RECONNECT_DELAY = 0.5
+# how long requests wait for objects created by operations on other nodes
+REPLICATION_WAIT = 2.0
+
+_backplane = None
+
+
+class Backplane(abc.ABC):
+    """
+    Interface of backplanes, implementations send published operations to
+    all other processes and pass operations received from them to handler
+    """
+
+    def __init__(self, url, node_id, handler):
+        """
+
+        :param url: implementation specific address of the backplane
+        :param node_id: unique identifier of this process
+        :param handler: callable(operation, payload, node_id)
+        """
+        self.url = url
+        self.node_id = node_id
+        self.handler = handler
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @abc.abstractmethod
+    def publish(self, operation, payload):
+        """ Sends operation to all other processes """
+
+    def dispatch(self, line):
+        """ Decodes a frame and passes it to handler """
+        frame = json.loads(line)
+        if frame["node"] == self.node_id:
+            return
+        try:
+            self.handler(frame["op"], frame["payload"], frame["node"])
+        except Exception:
+            log.exception("backplane operation {} failed".format(frame["op"]))
+
+
+class LoopbackBackplane(Backplane):
+    """
+    Connects backplanes with the same url within a single process,
+    frames are encoded like for the network and handled synchronously
+    """
+
+    hubs: Dict[str, List["LoopbackBackplane"]] = {}
+
+    def start(self):
+        self.hubs.setdefault(self.url, []).append(self)
+
+    def stop(self):
+        hub = self.hubs.get(self.url, [])
+        if self in hub:
+            hub.remove(self)
+
+    def publish(self, operation, payload):
+        frame = bus.encode_frame(operation, self.node_id, payload)
+        for backplane in list(self.hubs.get(self.url, [])):
+            if backplane is not self:
+                backplane.dispatch(frame)
+
+
+class SocketBackplane(Backplane):
+    """
+    Exchanges frames through a broker listening on tcp://host:port
+    or unix socket, frames published while disconnected are kept
+    and sent after reconnecting
+    """
+
+    def __init__(self, url, node_id, handler):
+        super(SocketBackplane, self).__init__(url, node_id, handler)
+        self.outbox = Queue()
+        self.connected = False
+        self.greenlet = None
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.run_forever)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+
+    def publish(self, operation, payload):
+        self.outbox.put(bus.encode_frame(operation, self.node_id, payload))
+
+    def write_forever(self, sock):
+        for frame in self.outbox:
+            try:
+                sock.sendall(frame)
+            except OSError:
+                # keep the frame for the next connection
+                self.outbox.queue.appendleft(frame)
+                raise
+
+    def run_forever(self):
+        while True:
+            writer = None
+            try:
+                sock = bus.make_connection(self.url)
+                self.connected = True
+                writer = gevent.spawn(self.write_forever, sock)
+                for line in sock.makefile("rb"):
+                    self.dispatch(line)
+            except OSError as exc:
+                log.debug("backplane connection error: {}".format(exc))
+            finally:
+                self.connected = False
+                if writer is not None:
+                    writer.kill()
+            gevent.sleep(RECONNECT_DELAY)
+
+
+def make_node_id():
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def load_backplane(server_config, node_id, handler):
+    """
+    Creates backplane configured by `backplane` and `backplane_url` settings
+    """
+    module_, class_ = server_config["backplane"].rsplit(".", maxsplit=1)
+    backplane_cls = getattr(importlib.import_module(module_), class_)
+    return backplane_cls(server_config["backplane_url"], node_id, handler)
+
+
+def use_backplane(backplane):
+    """ Starts passed backplane and routes published operations to it """
+    global _backplane
+    if _backplane is not None:
+        _backplane.stop()
+    _backplane = backplane
+    if backplane is not None:
+        backplane.start()
+    return backplane
+
+
+def get_backplane():
+    return _backplane
+
+
+def publish(operation, payload):
+    """ Sends operation to other processes if backplane is enabled """
+    if _backplane is not None:
+        _backplane.publish(operation, payload)
+
+
+def wait_for(predicate, timeout=REPLICATION_WAIT):
+    """
+    Operations of other processes are applied asynchronously - gives them
+    a moment to arrive when a request refers to an object that is not
+    known yet, returns the last result of predicate
+    """
+    result = predicate()
+    if result or _backplane is None:
+        return result
+    with gevent.Timeout(timeout, False):
+        while not result:
+            gevent.sleep(0.01)
+            result = predicate()
+    return result
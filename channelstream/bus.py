@@ -0,0 +1,131 @@
+"""
+Socket broker relaying backplane frames between channelstream processes,
+it runs in the master process of a prefork server or standalone
+(`channelstream --broker`) for clusters of nodes, and relays every frame
+it receives from one process to all other processes.
+
+Frames are newline delimited compact JSON objects:
+{"op": operation name, "node": sender id, "payload": operation arguments}
+"""
+import logging
+import os
+import socket
+
+import gevent
+from gevent.queue import Queue
+from gevent.server import StreamServer
+
+from channelstream import patched_json as json
+
+log = logging.getLogger(__name__)
+
+
+def parse_address(url):
+    """
+    Returns socket family and address for tcp://host:port,
+    unix:///path/to.sock or plain unix socket path
+    """
+    if url.startswith("tcp://"):
+        host, port = url[len("tcp://") :].rsplit(":", 1)
+        host = host.strip("[]")
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        return family, (host, int(port))
+    if url.startswith("unix://"):
+        url = url[len("unix://") :]
+    return socket.AF_UNIX, url
+
+
+def make_listener(url, backlog=128):
+    family, address = parse_address(url)
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.unlink(address)
+    else:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(backlog)
+    return listener
+
+
+def make_connection(url):
+    family, address = parse_address(url)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    if family != socket.AF_UNIX:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def encode_frame(operation, node_id, payload):
+    frame = {"op": operation, "node": node_id, "payload": payload}
+    return json.dumpb(frame) + b"\n"
+
+
+class BusPeer(object):
+    """ Broker side of a connected process with its own outbound queue """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.outbox = Queue()
+        self.writer = gevent.spawn(self.write_forever)
+
+    def send(self, frame):
+        self.outbox.put(frame)
+
+    def write_forever(self):
+        try:
+            for frame in self.outbox:
+                self.sock.sendall(frame)
+        except OSError as exc:
+            log.info("bus peer gone: {}".format(exc))
+
+    def close(self):
+        self.writer.kill()
+        self.sock.close()
+
+
+class BusBroker(object):
+    """ Relays frames received from one peer to all other peers """
+
+    def __init__(self, url):
+        self.url = url
+        self.peers = set()
+        self.server = None
+
+    @property
+    def address(self):
+        """ Address the broker listens on, with actual port for port 0 """
+        return self.server.socket.getsockname()
+
+    def start(self):
+        self.server = StreamServer(make_listener(self.url), self.handle)
+        self.server.start()
+        log.info("Message bus listening on {}".format(self.url))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+        for peer in list(self.peers):
+            peer.close()
+
+    def serve_forever(self):
+        self.start()
+        self.server.serve_forever()
+
+    def handle(self, sock, address):
+        peer = BusPeer(sock)
+        self.peers.add(peer)
+        try:
+            for frame in sock.makefile("rb"):
+                self.relay(peer, frame)
+        except OSError as exc:
+            log.info("bus peer gone: {}".format(exc))
+        finally:
+            self.peers.discard(peer)
+            peer.close()
+
+    def relay(self, sender, frame):
+        for peer in self.peers:
+            if peer is not sender:
+                peer.send(frame)
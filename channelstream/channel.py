@@ -1,8 +1,12 @@
-import copy
 import logging
 import uuid
 from datetime import datetime
 
+from channelstream import history, outbox, ringbuffer
+from channelstream import patched_json as json
+from channelstream.frame import MessageFrame
+from channelstream.history import message_uuid
+from channelstream.ringbuffer import RingBuffer
 from channelstream.server_state import get_state
 from channelstream.utils import process_catchup
 from channelstream.validation import MSG_EDITABLE_KEYS
@@ -10,6 +14,10 @@ from channelstream.validation import MSG_EDITABLE_KEYS
 log = logging.getLogger(__name__)
 
 
+def frame_uuid(entry):
+    return message_uuid(entry[1])
+
+
 class Channel(object):
     """ Represents one of our chat channels - has some config options """
 
@@ -20,6 +28,8 @@ class Channel(object):
         "broadcast_presence_with_user_lists",
         "notify_state",
         "store_frames",
+        "frames_size",
+        "flush_window",
     ]
 
     def __init__(self, name, long_name=None, channel_config=None):
@@ -41,11 +51,22 @@ class Channel(object):
         self.salvageable = False
         self.store_history = False
         self.store_frames = True
-        self.history_size = 10
-        self.history = []
+        self.history = history.get_backend().open(name, 10)
         # store frames for fetching when connection is established
-        # those frames will store channel messages including presence ones
-        self.frames = []
+        # those frames will store channel messages including presence ones,
+        # both buffers are keyed by sequence numbers
+        self.frames = RingBuffer(ringbuffer.CHANNEL_FRAMES_SIZE, uuid_of=frame_uuid)
+        # sequence number of the last message in the channel stream and of
+        # the last frame that fell out of retention, stored history of
+        # a recreated channel continues the stream
+        self.seq = self.history[-1].get("seq", 0) if len(self.history) else 0
+        self.trimmed_seq = self.seq
+        # seconds websocket payloads can wait to be coalesced under load
+        self.flush_window = outbox.FLUSH_WINDOW
+        # bumped whenever channel info changes, info snapshots are cached
+        # per info options until the version moves on
+        self.version = 0
+        self.info_cache = {}
         if channel_config:
             self.reconfigure_from_dict(channel_config)
         log.info("%s created" % self)
@@ -55,47 +76,104 @@ class Channel(object):
     def mark_activity(self):
         self.last_active = datetime.utcnow()
 
+    def bump_version(self):
+        self.version += 1
+
+    @property
+    def history_size(self):
+        return self.history.capacity
+
+    @history_size.setter
+    def history_size(self, value):
+        self.history.resize(value)
+        self.bump_version()
+
+    @property
+    def frames_size(self):
+        return self.frames.capacity
+
+    @frames_size.setter
+    def frames_size(self, value):
+        evicted = self.frames.resize(value)
+        if evicted is not None:
+            self.trimmed_seq = evicted
+        self.bump_version()
+
     def get_catchup_frames(self, newer_than, username):
         found = []
         for t, f in self.frames:
             # either old frame or user is excluded or PM not meant for user
             if (
                 t < newer_than
-                or (f["exclude_users"] and username in f["exclude_users"])
-                or (f["pm_users"] and username not in f["pm_users"])
+                or (f.exclude_users and username in f.exclude_users)
+                or (f.pm_users and username not in f.pm_users)
             ):
                 continue
 
             found.append(process_catchup(f))
         return found
 
+    def get_frames_since(self, seq, username):
+        """
+        Returns catchup frames with sequence number greater than seq and
+        whether some of them fell out of retention already
+        """
+        found = [
+            process_catchup(f)
+            for t, f in self.frames.since(seq)
+            if not (f.exclude_users and username in f.exclude_users)
+            and not (f.pm_users and username not in f.pm_users)
+        ]
+        return found, seq < self.trimmed_seq
+
+    def get_gap_message(self, seq):
+        """
+        Message telling client that frames after seq are no longer retained
+        """
+        return {
+            "uuid": uuid.uuid4(),
+            "type": "stream:gap",
+            "user": None,
+            "channel": self.name,
+            "timestamp": datetime.utcnow(),
+            "catchup": True,
+            "message": {
+                "since": seq,
+                "retained_from": self.trimmed_seq + 1,
+                "seq": self.seq,
+            },
+        }
+
     def reconfigure_from_dict(self, config):
         if config:
             for key in self.config_keys:
                 val = config.get(key)
                 if val is not None:
                     setattr(self, key, val)
+            self.bump_version()
 
     def add_connection(self, connection):
         username = connection.username
         connections = self.connections.setdefault(username, [])
         if not connections and self.notify_presence:
             self.send_notify_presence_info(username, "joined")
+        connection.channel_names.add(self.name)
         if connection not in connections:
             connections.append(connection)
+            self.bump_version()
             return True
         return False
 
     def remove_connection(self, connection):
-        was_found = False
         username = connection.username
-        connections = self.connections.setdefault(username, [])
-        if connection in connections:
-            self.connections[username].remove(connection)
-            was_found = True
-
+        connection.channel_names.discard(self.name)
+        connections = self.connections.get(username)
+        if not connections or connection not in connections:
+            return False
+        connections.remove(connection)
+        self.bump_version()
         self.after_parted(username)
-        return was_found
+        return True
 
     def after_parted(self, username):
         """
@@ -107,6 +185,7 @@ class Channel(object):
         """
         if not self.connections[username]:
             del self.connections[username]
+            self.bump_version()
             if self.notify_presence:
                 self.send_notify_presence_info(username, "parted")
 
@@ -170,44 +249,144 @@ class Channel(object):
 
     def add_frame(self, frame):
         if self.store_frames:
-            self.frames.append((datetime.utcnow(), frame))
-            self.frames = self.frames[-100:]
+            evicted = self.frames.append((datetime.utcnow(), frame), key=frame["seq"])
+        else:
+            evicted = frame["seq"]
+        if evicted is not None:
+            self.trimmed_seq = evicted
 
     def add_to_history(self, message):
         if self.store_history and message["type"] == "message":
-            self.history.append(message)
-            self.history = self.history[self.history_size * -1 :]
+            self.history.append(message, key=message["seq"])
+            self.bump_version()
 
     def add_message(self, message, pm_users=None, exclude_users=None):
         """
-        Sends the message to all connections subscribed to this channel
+        Sends the message to all connections subscribed to this channel,
+        message can be a dictionary or a MessageFrame, it gets next sequence
+        number of the channel stream
+        """
+        message = self.store_message(message, pm_users, exclude_users)
+        recipients = self.get_recipients(message.pm_users, message.exclude_users)
+        self.deliver(message.encoded, recipients)
+        return len(recipients)
+
+    def add_messages(self, messages):
+        """
+        Sends consecutive messages in a single fan-out pass - runs of
+        messages with the same recipients are sent to every connection
+        as one payload, returns number of deliveries.
+
+        Sequence numbers messages got are written back to their dictionaries
+        so they are replicated along with them.
         """
-        pm_users = pm_users or []
-        exclude_users = exclude_users or []
+        frames = []
+        for m in messages:
+            frame = self.store_message(
+                m, m.get("pm_users"), m.get("exclude_users"), seq=m.get("seq")
+            )
+            m["seq"] = frame["seq"]
+            frames.append(frame)
+        total_sent = 0
+        start = 0
+        while start < len(frames):
+            pm_users = frames[start].pm_users
+            exclude_users = frames[start].exclude_users
+            end = start + 1
+            while (
+                end < len(frames)
+                and frames[end].pm_users == pm_users
+                and frames[end].exclude_users == exclude_users
+            ):
+                end += 1
+            run = frames[start:end]
+            recipients = self.get_recipients(pm_users, exclude_users)
+            if len(run) == 1:
+                encoded = run[0].encoded
+            else:
+                encoded = json.merge_encoded([frame.encoded for frame in run])
+            self.deliver(encoded, recipients)
+            total_sent += len(recipients) * len(run)
+            start = end
+        return total_sent
+
+    def store_message(self, message, pm_users=None, exclude_users=None, seq=None):
+        """
+        Numbers the message and stores it in history and catchup frames,
+        returns it as a MessageFrame
+
+        Messages replicated from other processes keep the sequence number
+        their publisher assigned, unless this stream is already past it
+        """
+        if seq is not None and seq <= self.seq:
+            # published concurrently with a message of this process
+            log.debug("{} renumbers replicated seq {}".format(self, seq))
+            seq = None
+        self.seq = seq if seq is not None else self.seq + 1
+        if isinstance(message, MessageFrame):
+            message = message.replace(seq=self.seq)
+        else:
+            message = MessageFrame.from_dict(
+                dict(message, seq=self.seq),
+                pm_users=pm_users,
+                exclude_users=exclude_users,
+            )
         self.mark_activity()
-        if not message["no_history"]:
+        if not message.no_history:
             self.add_to_history(message)
         self.add_frame(message)
-        message = copy.deepcopy(message)
-        # do not leak delivery info
-        del message["no_history"]
-        del message["pm_users"]
-        del message["exclude_users"]
-        total_sent = 0
-        # message everyone subscribed except excluded
-        for user, conns in self.connections.items():
-            if not exclude_users or user not in exclude_users:
-                for connection in conns:
-                    if not pm_users or connection.username in pm_users:
-                        connection.add_message(message)
-                        total_sent += 1
-        return total_sent
+        return message
+
+    def get_recipients(self, pm_users, exclude_users):
+        """
+        Connections served by this process that messages for pm_users
+        and without exclude_users should be delivered to - collected before
+        sending as sending can switch to greenlets that tear down connections,
+        replicas of connections served by other processes are left to them
+        """
+        return [
+            connection
+            for user, conns in self.connections.items()
+            if not exclude_users or user not in exclude_users
+            for connection in conns
+            if not connection.remote
+            and (not pm_users or connection.username in pm_users)
+        ]
+
+    def deliver(self, encoded, recipients):
+        """
+        Sends payload encoded once to all recipients
+        """
+        for connection in recipients:
+            connection.send_encoded(encoded, key=self.name, window=self.flush_window)
 
     def __repr__(self):
         return "<Channel: %s, connections:%s>" % (self.name, len(self.connections))
 
     def get_info(self, include_history=True, include_users=False):
-        server_state = get_state()
+        """
+        Returns channel info snapshot, snapshots are shared by all callers
+        asking for the same info until the channel changes and must not be
+        modified - messages that are not stored in history only refresh
+        activity and sequence number of the snapshot
+        """
+        options = (include_history, include_users)
+        cached = self.info_cache.get(options)
+        if cached is not None and cached[0] == self.version:
+            chan_info = cached[1]
+            if (
+                chan_info["seq"] == self.seq
+                and chan_info["last_active"] == self.last_active
+            ):
+                return chan_info
+            chan_info = dict(chan_info, seq=self.seq, last_active=self.last_active)
+            self.info_cache[options] = (self.version, chan_info)
+            return chan_info
+        chan_info = self.build_info(include_history, include_users)
+        self.info_cache[options] = (self.version, chan_info)
+        return chan_info
+
+    def build_info(self, include_history=True, include_users=False):
         settings = {k: getattr(self, k) for k in self.config_keys}
 
         chan_info = {
@@ -215,41 +394,55 @@ class Channel(object):
             "name": self.name,
             "long_name": self.long_name,
             "settings": settings,
-            "history": self.history if include_history else [],
+            "history": list(self.history) if include_history else [],
             "last_active": self.last_active,
+            "seq": self.seq,
             "total_connections": sum(
                 [len(conns) for conns in self.connections.values()]
             ),
             "total_users": 0,
             "users": [],
         }
-
-        for username in self.connections.keys():
-            user_inst = server_state.users.get(username)
-            if include_users and user_inst.username not in chan_info["users"]:
-                chan_info["users"].append(user_inst.username)
-        chan_info["users"] = sorted(chan_info["users"])
+        if include_users:
+            chan_info["users"] = sorted(self.connections.keys())
         chan_info["total_users"] = len(chan_info["users"])
         return chan_info
 
+    def get_users_info(self, public_state=False):
+        """
+        Returns shared snapshot of users present in the channel with their
+        state, must not be modified
+        """
+        options = ("users", public_state)
+        cached = self.info_cache.get(options)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        server_state = get_state()
+        users_info = []
+        for username in sorted(self.connections.keys()):
+            user = server_state.users.get(username)
+            if user is None:
+                continue
+            state = user.public_state if public_state else dict(user.state)
+            users_info.append({"user": username, "state": state})
+        self.info_cache[options] = (self.version, users_info)
+        return users_info
+
     def alter_message(self, to_edit):
-        found = False
-        for msg in self.history:
-            if msg["uuid"] == to_edit["uuid"]:
-                found = True
-                msg.update({k: v for k, v in to_edit.items() if k in MSG_EDITABLE_KEYS})
-                break
-        # if found history then reference in frames will be also updated,
-        # otherwise search frames for channels that do not store history
-        if not found:
-            for f, msg in self.frames:
-                if msg["uuid"] == to_edit["uuid"] and msg["type"] == "message":
-                    msg.update(
-                        {k: v for k, v in to_edit.items() if k in MSG_EDITABLE_KEYS}
-                    )
-                    break
-        altered = copy.deepcopy(to_edit)
-        altered["type"] = "message:edit"
+        changes = {k: v for k, v in to_edit.items() if k in MSG_EDITABLE_KEYS}
+        edited = None
+        msg = self.history.get(to_edit["uuid"])
+        if msg is not None:
+            edited = msg.replace(**changes)
+            self.history.replace(to_edit["uuid"], edited)
+            self.bump_version()
+        # frames share the edited frame with history, for channels that do
+        # not store history the frame is edited on its own
+        entry = self.frames.get(to_edit["uuid"])
+        if entry is not None:
+            t, msg = entry
+            self.frames.replace(to_edit["uuid"], (t, edited or msg.replace(**changes)))
+        altered = dict(to_edit, type="message:edit")
         self.add_message(
             altered,
             pm_users=altered["pm_users"],
@@ -257,19 +450,11 @@ class Channel(object):
         )
 
     def delete_message(self, to_delete):
-        for i, msg in enumerate(self.history):
-            if msg["uuid"] == to_delete["uuid"]:
-                self.history.pop(i)
-                break
-
-        for i, frame in enumerate(self.frames):
-            msg = frame[1]
-            if msg["uuid"] == to_delete["uuid"] and msg["type"] == "message":
-                self.frames.pop(i)
-                break
-
-        deleted = copy.deepcopy(to_delete)
-        deleted["type"] = "message:delete"
+        self.history.remove(to_delete["uuid"])
+        self.bump_version()
+        self.frames.remove(to_delete["uuid"])
+
+        deleted = dict(to_delete, type="message:delete")
         self.add_message(
             deleted,
             pm_users=deleted["pm_users"],
@@ -17,6 +17,29 @@ SHARED_DEFAULTS = {
     "enforce_https": False,
     "http_scheme": "",
     "signature_checker": "channelstream.utils.DefaultSigner",
+    "signature_cache_size": 10000,
+    "json_backend": "auto",
+    "workers": 1,
+    "bus_socket": "",
+    "backplane": "channelstream.backplane.SocketBackplane",
+    "backplane_url": "",
+    "heartbeat_interval": 5,
+    "heartbeat_jitter": 0.1,
+    "heartbeat_ping": True,
+    "outbox_size": 1000,
+    "outbox_policy": "disconnect",
+    "ingest_workers": 8,
+    "ingest_batch_size": 100,
+    "flush_window": 0.0,
+    "flush_max_bytes": 65536,
+    "poll_buffer_size": 1000,
+    "channel_frames_size": 100,
+    "user_frames_size": 50,
+    "history_backend": "channelstream.history.MemoryHistory",
+    "history_url": "",
+    "history_hot_size": 10,
+    "snapshot_path": "",
+    "snapshot_interval": 60.0,
 }
 
 CONFIGURABLE_PARAMS = (
@@ -34,4 +57,27 @@ CONFIGURABLE_PARAMS = (
     "enforce_https",
     "http_scheme",
     "signature_checker",
+    "signature_cache_size",
+    "json_backend",
+    "workers",
+    "bus_socket",
+    "backplane",
+    "backplane_url",
+    "heartbeat_interval",
+    "heartbeat_jitter",
+    "heartbeat_ping",
+    "outbox_size",
+    "outbox_policy",
+    "ingest_workers",
+    "ingest_batch_size",
+    "flush_window",
+    "flush_max_bytes",
+    "poll_buffer_size",
+    "channel_frames_size",
+    "user_frames_size",
+    "history_backend",
+    "history_url",
+    "history_hot_size",
+    "snapshot_path",
+    "snapshot_interval",
 )
@@ -8,14 +8,19 @@ import logging
 import pprint
 import os
 import configparser
+import signal
+import socket
+import tempfile
 
 import gevent
 from gevent.server import StreamServer
 
 import channelstream.wsgi_app as pyramid_app
 import channelstream
+from channelstream import backplane, bus, operations, snapshot
 from channelstream.cli import CONFIGURABLE_PARAMS, SHARED_DEFAULTS
 from channelstream.gc import gc_conns_forever, gc_users_forever
+from channelstream.heartbeat import heartbeat_forever
 from channelstream.policy_server import client_handle
 from channelstream.ws_app import ChatApplicationSocket
 from channelstream.utils import set_config_types
@@ -55,6 +60,12 @@ def main():
         default=None,
         nargs="*",
     )
+    parser.add_argument(
+        "--broker",
+        dest="broker",
+        help="Run only backplane broker on tcp://host:port or unix socket path",
+        default=None,
+    )
     args = parser.parse_args()
 
     if args.version is not None:
@@ -85,23 +96,170 @@ def main():
     log.setLevel(log_level)
     log.debug(pprint.pformat(config))
     log.info("Starting channelstream {}".format(channelstream.__version__))
-    url = "http://{}:{}".format(config["host"], config["port"])
 
-    log.info("Starting flash policy server on port 10843")
-    gevent.spawn(gc_conns_forever)
-    gevent.spawn(gc_users_forever)
-    server = StreamServer(("0.0.0.0", 10843), client_handle)
-    server.start()
-    log.info("Serving on {}".format(url))
-    log.info("Admin interface available on {}/admin".format(url))
+    if args.broker:
+        log.info("Starting backplane broker on {}".format(args.broker))
+        bus.BusBroker(args.broker).serve_forever()
+        return
+
     if config["secret"] == "secret":
         log.warning("Using default secret! Remember to set that for production.")
     if config["admin_secret"] == "admin_secret":
         log.warning("Using default admin secret! Remember to set that for production.")
     log.warning(f"IP's allowed to post to API {config['allow_posting_from']}")
+    if config["workers"] > 1:
+        run_prefork(config)
+    else:
+        start_policy_server()
+        start_backplane(config)
+        listener = make_listener(config["host"], config["port"])
+        serve(config, listener)
+
+
+def start_policy_server():
+    log.info("Starting flash policy server on port 10843")
+    server = StreamServer(("0.0.0.0", 10843), client_handle)
+    try:
+        server.start()
+    except OSError as exc:
+        # other node on the same host is serving it already
+        log.warning("Flash policy server not started: {}".format(exc))
+    return server
+
+
+def start_backplane(config):
+    """
+    Connects this process to other nodes if backplane is configured
+    """
+    if not config["backplane_url"]:
+        return None
+    node_id = backplane.make_node_id()
+    instance = backplane.load_backplane(config, node_id, operations.apply_remote)
+    backplane.use_backplane(instance)
+    gevent.spawn(operations.publish_stats_forever)
+    log.info("Node {} using backplane {}".format(node_id, config["backplane_url"]))
+    return instance
+
+
+def make_listener(host, port, reuse_port=False):
+    """
+    Creates listening socket, with reuse_port many worker processes can
+    bind the same port and the kernel balances connections between them
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+    return listener
+
+
+def serve(config, listener):
+    url = "http://{}:{}".format(config["host"], config["port"])
+    gevent.spawn(gc_conns_forever)
+    gevent.spawn(gc_users_forever)
+    gevent.spawn(heartbeat_forever)
+    log.info("Serving on {}".format(url))
+    log.info("Admin interface available on {}/admin".format(url))
+    app = RoutingApplication(config)
+    # state is restored after history backend is configured by the app
+    # and before any request is accepted
+    snapshot.load(config["snapshot_path"])
+    # in prefork mode every worker holds replicated state, first one saves it
+    snapshot_writer = config["snapshot_path"] and not config.get("worker_number")
+    if snapshot_writer:
+        gevent.spawn(
+            snapshot.snapshot_forever,
+            config["snapshot_path"],
+            config["snapshot_interval"],
+        )
     server = WSGIServer(
-        (config["host"], config["port"]),
-        RoutingApplication(config),
-        log=logging.getLogger("channelstream.WSGIServer"),
+        listener, app, log=logging.getLogger("channelstream.WSGIServer")
     )
+
+    def stop():
+        if snapshot_writer:
+            try:
+                snapshot.save(config["snapshot_path"])
+            except Exception as exc:
+                log.error("Snapshot failed: {}".format(exc))
+        server.stop()
+
+    def shutdown():
+        # signal handlers can not block, saving is done by a greenlet
+        gevent.spawn(stop)
+
+    gevent.signal_handler(signal.SIGTERM, shutdown)
+    gevent.signal_handler(signal.SIGINT, shutdown)
     server.serve_forever()
+
+
+def run_worker(config):
+    start_backplane(config)
+    listener = make_listener(config["host"], config["port"], reuse_port=True)
+    serve(config, listener)
+
+
+def run_prefork(config):
+    """
+    Forks worker processes sharing the listening port, master process
+    relays replicated operations between them and restarts dead workers,
+    with configured backplane workers connect to the cluster broker directly
+    """
+    broker = None
+    if not config["backplane_url"]:
+        if not config["bus_socket"]:
+            config["bus_socket"] = os.path.join(
+                tempfile.gettempdir(), "channelstream-{}.sock".format(os.getpid())
+            )
+        config["backplane_url"] = "unix://{}".format(config["bus_socket"])
+        config["backplane"] = "channelstream.backplane.SocketBackplane"
+        broker = bus.BusBroker(config["backplane_url"])
+    workers = {}
+
+    def spawn_worker(worker_number):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            config["worker_number"] = worker_number
+            try:
+                run_worker(config)
+            finally:
+                os._exit(0)
+        workers[pid] = worker_number
+        log.info("Started worker {} with pid {}".format(worker_number, pid))
+
+    stopping = []
+
+    def shutdown(signum, frame):
+        # handlers run inside event loop, actual work is done by main loop
+        stopping.append(signum)
+
+    for worker_number in range(config["workers"]):
+        spawn_worker(worker_number)
+    # start listening only after forking so workers do not inherit the broker
+    if broker is not None:
+        broker.start()
+    start_policy_server()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    while not stopping:
+        gevent.sleep(0.5)
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid in workers:
+            worker_number = workers.pop(pid)
+            log.warning("Worker {} exited, restarting".format(worker_number))
+            spawn_worker(worker_number)
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    if broker is not None:
+        broker.stop()
@@ -1,13 +1,15 @@
 import logging
 from datetime import datetime, timedelta
 
-import gevent
-
-from channelstream import patched_json as json
+from channelstream import gc, patched_json as json
+from channelstream.frame import MessageFrame
+from channelstream.outbox import Outbox, PING
 from channelstream.server_state import get_state
 
 log = logging.getLogger(__name__)
 
+EMPTY_PAYLOAD = b"[]"
+
 
 class Connection(object):
     """ Represents a client connection"""
@@ -18,74 +20,146 @@ class Connection(object):
         self.socket = None
         self.queue = None
         self.id = conn_id
+        # id of other node serving socket or long polling queue
+        self._owner = None
+        # names of channels this connection is subscribed to,
+        # maintained by channels and GC
+        self.channel_names = set()
+        # deadline of the current expiry check scheduled by GC
+        self.gc_deadline = None
+        # bucket of the heartbeat scheduler this connection is waiting in
+        self.heartbeat_bucket = None
+        # bounded buffer of websocket payloads, created on first write
+        self.outbox = None
         self.mark_activity()
-        gevent.spawn_later(5, self.heartbeat_forever)
+        gc.track_connection(self)
 
     def __repr__(self):
         return "<Connection: id:%s, owner:%s>" % (self.id, self.username)
 
+    @property
+    def owner(self):
+        return self._owner
+
+    @owner.setter
+    def owner(self, node_id):
+        if (node_id is None) != (self._owner is None):
+            server_state = get_state()
+            if server_state.connections.get(self.id) is self:
+                server_state.remote_connection_count += -1 if node_id is None else 1
+        self._owner = node_id
+
+    @property
+    def remote(self):
+        """ Connection is served by other node of the cluster """
+        return self._owner is not None
+
     def mark_activity(self):
         self.last_active = datetime.utcnow()
 
-    def add_message(self, message=None):
-        server_state = get_state()
+    def mark_delivery(self):
+        """ Payload got written to the socket of this connection """
+        self.mark_activity()
+        user = get_state().users.get(self.username)
+        if user is not None:
+            user.mark_activity()
+
+    def add_message(self, message=None, key=None):
         """ Sends the message to the client connection """
+        if isinstance(message, MessageFrame):
+            self.send_encoded(message.encoded, key=key)
+        else:
+            payload = json.encode_messages([message] if message else [])
+            self.send_encoded(payload, key=key)
+
+    def write(self, payload, key=None, window=0.0):
+        """
+        Queues payload in outbox of the websocket, slow consumers are handled
+        according to outbox policy
+        """
+        if self.outbox is None:
+            self.outbox = Outbox(self)
+        if not self.outbox.put(payload, key=key, window=window):
+            log.info("disconnecting slow consumer {}".format(self.id))
+            self.mark_for_gc()
+            self.socket.close()
+
+    def send_encoded(self, payload, key=None, window=0.0):
+        """
+        Sends already encoded JSON list of messages to the client connection,
+        the same payload object can be shared between many connections
+
+        :param payload:
+        :param key: conflation key - name of the channel message belongs to
+        :param window: flush window of websocket frame coalescing
+        """
         # handle websockets
         if self.socket and self.socket.terminated:
             self.mark_for_gc()
         elif self.socket and not self.socket.terminated:
-            try:
-                # payload needs to be converted to JSON now as it gets
-                # piped to client
-                self.socket.send(json.dumps([message] if message else []))
-                self.mark_activity()
-                server_state.users[self.username].mark_activity()
-            except Exception as exc:
-                log.info(exc)
-                self.mark_for_gc()
+            self.write(payload, key=key, window=window)
         elif self.queue:
             # handle long polling
-            # payload will be converted to JSON in WSGI response
-            self.queue.put([message] if message else [])
+            # payloads get merged into single JSON list in WSGI response
+            self.queue.put(payload)
 
     def mark_for_gc(self):
         # set last active time for connection 1 hour in past for GC
         self.last_active -= timedelta(days=60)
+        # and make sure it gets collected on next GC run
+        gc.track_connection(self, datetime.utcnow())
 
-    def heartbeat(self):
-        if (self.socket and not self.socket.terminated) or self.queue:
-            try:
-                self.add_message()
+    def heartbeat(self, ping=False):
+        """
+        Keeps the connection alive, with ping websockets get a ping control
+        frame instead of an empty message list
+        """
+        try:
+            if self.socket and not self.socket.terminated:
+                # pending writes will keep the connection alive
+                if not self.outbox:
+                    self.write(PING if ping else EMPTY_PAYLOAD)
                 return True
-            except Exception as exc:
-                self.mark_for_gc()
-                if self.socket:
-                    self.socket.close()
-
-    def heartbeat_forever(self):
-        while True:
-            if self.heartbeat():
-                gevent.sleep(5)
-            else:
-                break
-
-    def get_catchup_messages(self):
+            elif self.queue:
+                self.queue.put(EMPTY_PAYLOAD)
+                return True
+        except Exception as exc:
+            log.info(exc)
+            self.mark_for_gc()
+            if self.socket:
+                self.socket.close()
+
+    def get_catchup_messages(self, since=None):
+        """
+        Returns messages client missed, channels found in since dictionary
+        (see utils.parse_since) are resumed from given sequence number
+        """
         server_state = get_state()
+        since = since or {}
         messages = []
         # return catchup messages for channels
         for channel in self.channels:
-            channel_inst = server_state.channels[channel]
-            messages.extend(
-                channel_inst.get_catchup_frames(self.last_active, self.username)
-            )
+            channel_inst = server_state.channels.get(channel)
+            if channel_inst is None:
+                continue
+            seq = since.get(channel, since.get(None))
+            if seq is None:
+                messages.extend(
+                    channel_inst.get_catchup_frames(self.last_active, self.username)
+                )
+                continue
+            frames, lost = channel_inst.get_frames_since(seq, self.username)
+            if lost:
+                messages.append(channel_inst.get_gap_message(seq))
+            messages.extend(frames)
         # and users
         messages.extend(
             server_state.users[self.username].get_catchup_frames(self.last_active)
         )
         return messages
 
-    def deliver_catchup_messages(self):
-        [self.add_message(m) for m in self.get_catchup_messages()]
+    def deliver_catchup_messages(self, since=None):
+        [self.add_message(m) for m in self.get_catchup_messages(since)]
 
     @property
     def channels(self):
@@ -93,13 +167,17 @@ class Connection(object):
         Return list of channels names connection belongs to
         :return:
         """
-        server_state = get_state()
-        found_channels = []
-        for channel in server_state.channels.values():
-            user_conns = channel.connections.get(self.username) or []
-            if self in user_conns:
-                found_channels.append(channel.name)
-        return sorted(found_channels)
+        return sorted(self.channel_names)
+
+    def get_info(self):
+        outbox = self.outbox
+        return {
+            "id": self.id,
+            "owner": self.owner,
+            "outbox_depth": len(outbox) if outbox is not None else 0,
+            "outbox_dropped": outbox.dropped if outbox is not None else 0,
+            "outbox_coalesced": outbox.coalesced if outbox is not None else 0,
+        }
 
     def __json__(self):
         return self.id
@@ -0,0 +1,105 @@
+from collections.abc import Mapping
+from types import MappingProxyType
+
+from channelstream import patched_json as json
+
+DELIVERY_KEYS = ("no_history", "pm_users", "exclude_users")
+
+
+class MessageFrame(Mapping):
+    """
+    Immutable message that is shared between history, catchup frames and
+    all recipients - delivery information is kept apart from the payload
+    that gets sent to clients
+    """
+
+    __slots__ = ("_payload", "no_history", "pm_users", "exclude_users", "_cache")
+
+    def __init__(self, payload, no_history=False, pm_users=None, exclude_users=None):
+        """
+
+        :param payload: client visible part of the message
+        :param no_history:
+        :param pm_users:
+        :param exclude_users:
+        """
+        set_attr = object.__setattr__
+        set_attr(self, "_payload", payload)
+        set_attr(self, "no_history", bool(no_history))
+        set_attr(self, "pm_users", tuple(pm_users or ()))
+        set_attr(self, "exclude_users", tuple(exclude_users or ()))
+        set_attr(self, "_cache", {})
+
+    @classmethod
+    def from_dict(cls, message, **delivery):
+        """
+        Builds a frame out of message dictionary, delivery keys passed as
+        keyword arguments take precedence over ones found in message
+        """
+        payload = {k: v for k, v in message.items() if k not in DELIVERY_KEYS}
+        for key in DELIVERY_KEYS:
+            if delivery.get(key) is None:
+                delivery[key] = message.get(key)
+        return cls(payload, **delivery)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("MessageFrame is immutable")
+
+    def __getitem__(self, key):
+        if key in DELIVERY_KEYS:
+            value = getattr(self, key)
+            return list(value) if isinstance(value, tuple) else value
+        return self._payload[key]
+
+    def __iter__(self):
+        yield from self._payload
+        yield from DELIVERY_KEYS
+
+    def __len__(self):
+        return len(self._payload) + len(DELIVERY_KEYS)
+
+    def __repr__(self):
+        return "<MessageFrame: %s>" % dict(self)
+
+    def __reduce__(self):
+        delivery = (self.no_history, self.pm_users, self.exclude_users)
+        return self.__class__, (self._payload,) + delivery
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @property
+    def payload(self):
+        """ Read only view of data that gets sent to clients """
+        return MappingProxyType(self._payload)
+
+    @property
+    def encoded(self):
+        """ Payload encoded as single element JSON list, computed once """
+        encoded = self._cache.get("encoded")
+        if encoded is None:
+            encoded = self._cache["encoded"] = json.encode_messages([self._payload])
+        return encoded
+
+    def replace(self, **changes):
+        """
+        Returns new frame with changed keys, delivery keys are changed on
+        the frame itself while others update a shallow copy of the payload
+        """
+        delivery = {k: changes.pop(k, getattr(self, k)) for k in DELIVERY_KEYS}
+        payload = dict(self._payload)
+        payload.update(changes)
+        return self.__class__(payload, **delivery)
+
+    def as_catchup(self):
+        """ Returns (cached) copy of this frame marked as catchup message """
+        catchup = self._cache.get("catchup")
+        if catchup is None:
+            catchup = self._cache["catchup"] = self.replace(catchup=True)
+        return catchup
+
+    def __json__(self, request=None):
+        return dict(self)
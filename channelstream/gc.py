@@ -1,62 +1,180 @@
+import heapq
+import itertools
 import logging
+import time
 from datetime import datetime, timedelta
 
 import gevent
 
+from channelstream import backplane
 from channelstream.server_state import get_state
 
 log = logging.getLogger(__name__)
 
+CONNECTION_TIMEOUT = timedelta(seconds=15)
+USER_TIMEOUT = timedelta(days=1)
+# how many user expiry entries are processed before yielding to the hub
+USER_GC_BATCH_SIZE = 1000
 
-def gc_conns():
+# tie breaker for heap entries with equal deadlines
+_sequence = itertools.count()
+
+
+def track_connection(connection, deadline=None):
+    """
+    Schedules connection expiry check, by default for the moment it would
+    become stale if there is no more activity
+    """
+    server_state = get_state()
+    if deadline is None:
+        deadline = connection.last_active + CONNECTION_TIMEOUT
+    connection.gc_deadline = deadline
+    entry = (deadline, next(_sequence), connection)
+    heapq.heappush(server_state.expiring_connections, entry)
+
+
+def collect_connection(connection):
+    """
+    Removes connection from channels, user and connection registry
+    and closes it
+    """
+    server_state = get_state()
+    connection.gc_deadline = None
+    while True:
+        channel_names = set(connection.channel_names)
+        with server_state.locks(
+            usernames=[connection.username], channels=channel_names
+        ):
+            # connection got subscribed while we waited for locks - retry
+            if not connection.channel_names <= channel_names:
+                continue
+            for channel_name in channel_names:
+                channel = server_state.channels.get(channel_name)
+                if channel is not None:
+                    channel.remove_connection(connection)
+            connection.channel_names.clear()
+            user = server_state.users.get(connection.username)
+            if user:
+                user.remove_connection(connection)
+            if server_state.connections.get(connection.id) is connection:
+                del server_state.connections[connection.id]
+                if connection.remote:
+                    server_state.remote_connection_count -= 1
+        break
+    # make sure connection is closed after we garbage
+    # collected it from our list
+    connection.queue = None
+    if connection.socket and not connection.socket.terminated:
+        try:
+            connection.socket.close()
+        except Exception as exc:
+            log.info(exc)
+
+
+def record_pause(collector, start_time, collected):
+    server_state = get_state()
+    pause = (time.perf_counter() - start_time) * 1000
+    stats = server_state.gc_stats[collector]
+    stats["runs"] += 1
+    stats["last_pause_ms"] = round(pause, 3)
+    stats["max_pause_ms"] = max(stats["max_pause_ms"], stats["last_pause_ms"])
+    stats["total_collected"] += collected
+    return pause
+
+
+def gc_conns(now=None):
+    """
+    Collects connections that are due according to the expiry heap,
+    connections that were active since they got scheduled are rescheduled
+    """
     server_state = get_state()
     with server_state.lock:
-        start_time = datetime.utcnow()
-        threshold = start_time - timedelta(seconds=15)
-        collected_conns = []
-        # collect every ref in chanels
-        # remove connections from channels
-        for channel in server_state.channels.values():
-            for username, conns in list(channel.connections.items()):
-                for conn in conns:
-                    if conn.last_active < threshold:
-                        channel.connections[username].remove(conn)
-                        collected_conns.append(conn)
-                channel.after_parted(username)
-        # remove old conns from users and connection dictionaries
-        for conn in collected_conns:
-            if conn.username in server_state.users:
-                if conn in server_state.users[conn.username].connections:
-                    server_state.users[conn.username].connections.remove(conn)
-            if conn.id in server_state.connections:
-                del server_state.connections[conn.id]
-            # make sure connection is closed after we garbage
-            # collected it from our list
-            conn.queue = None
-            if conn.socket:
-                try:
-                    conn.socket.close()
-                except Exception:
-                    raise
-        log.debug(
-            "gc_conns() removed:%s time %s"
-            % (len(collected_conns), datetime.utcnow() - start_time)
-        )
-
-
-def gc_users():
+        start_time = time.perf_counter()
+        now = now or datetime.utcnow()
+        expiring = server_state.expiring_connections
+        collected = 0
+        while expiring and expiring[0][0] <= now:
+            deadline, _, connection = heapq.heappop(expiring)
+            # stale entry - connection got rescheduled or collected already
+            if connection.gc_deadline != deadline:
+                continue
+            expires_at = connection.last_active + CONNECTION_TIMEOUT
+            if connection.remote:
+                # node serving the connection decides when it expires
+                track_connection(connection, max(expires_at, now + CONNECTION_TIMEOUT))
+                continue
+            if expires_at > now:
+                track_connection(connection, expires_at)
+                continue
+            collect_connection(connection)
+            backplane.publish("disconnect", {"conn_id": connection.id})
+            collected += 1
+        pause = record_pause("conns", start_time, collected)
+        log.debug("gc_conns() removed:%s time %.3fms" % (collected, pause))
+
+
+def track_user(user, deadline=None):
+    """
+    Schedules user expiry check, by default for the moment it would
+    become stale if there is no more activity
+    """
+    server_state = get_state()
+    if deadline is None:
+        deadline = user.last_active + USER_TIMEOUT
+    user.gc_deadline = deadline
+    entry = (deadline, next(_sequence), user)
+    heapq.heappush(server_state.expiring_users, entry)
+
+
+def gc_users_chunk(now, batch_size):
+    """
+    Processes at most batch_size due entries of user expiry heap,
+    returns number of collected users and if there is more work left
+    """
     server_state = get_state()
     with server_state.lock:
-        counter = 0
-        start_time = datetime.utcnow()
-        threshold = datetime.utcnow() - timedelta(days=1)
-        for user in list(server_state.users.values()):
-            if user.last_active < threshold:
-                counter += 1
-                server_state.users.pop(user.username)
-        log.debug(
-            "gc_users() removed:%s time %s" % (counter, datetime.utcnow() - start_time)
-        )
+        start_time = time.perf_counter()
+        expiring = server_state.expiring_users
+        collected = 0
+        processed = 0
+        while expiring and expiring[0][0] <= now and processed < batch_size:
+            processed += 1
+            deadline, _, user = heapq.heappop(expiring)
+            # stale entry or user that is not registered anymore
+            if user.gc_deadline != deadline:
+                continue
+            with server_state.locks(usernames=[user.username]):
+                if server_state.users.get(user.username) is not user:
+                    continue
+                expires_at = user.last_active + USER_TIMEOUT
+                if expires_at > now:
+                    track_user(user, expires_at)
+                    continue
+                user.gc_deadline = None
+                del server_state.users[user.username]
+                if user.connections:
+                    server_state.active_user_count -= 1
+                collected += 1
+        record_pause("users", start_time, collected)
+        has_more = bool(expiring and expiring[0][0] <= now)
+    return collected, has_more
+
+
+def gc_users(now=None, batch_size=USER_GC_BATCH_SIZE):
+    """
+    Collects expired users in bounded chunks, yielding to other greenlets
+    between chunks so message delivery is not blocked for long
+    """
+    now = now or datetime.utcnow()
+    total = 0
+    has_more = True
+    while has_more:
+        collected, has_more = gc_users_chunk(now, batch_size)
+        total += collected
+        if has_more:
+            gevent.sleep(0)
+    log.debug("gc_users() removed:%s" % total)
+    return total
 
 
 def gc_users_forever():
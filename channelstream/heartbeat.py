@@ -0,0 +1,79 @@
+"""
+Heartbeat scheduler - connections with attached sockets or long polling
+queues are kept in time buckets and a single greenlet sweeps due buckets,
+instead of every connection running its own sleeping greenlet.
+"""
+import logging
+import random
+import time
+
+import gevent
+
+from channelstream.server_state import get_state
+
+log = logging.getLogger(__name__)
+
+# seconds between heartbeats of a connection
+HEARTBEAT_INTERVAL = 5.0
+# heartbeats are spread randomly by this fraction of the interval
+HEARTBEAT_JITTER = 0.1
+# websockets get ping control frames instead of empty message lists
+HEARTBEAT_PING = True
+# resolution of the schedule in seconds
+BUCKET_SIZE = 0.25
+
+
+def configure(interval=None, jitter=None, ping=None):
+    global HEARTBEAT_INTERVAL, HEARTBEAT_JITTER, HEARTBEAT_PING
+    if interval is not None:
+        HEARTBEAT_INTERVAL = float(interval)
+    if jitter is not None:
+        HEARTBEAT_JITTER = min(max(float(jitter), 0.0), 1.0)
+    if ping is not None:
+        HEARTBEAT_PING = bool(ping)
+
+
+def next_beat(now):
+    jitter = random.uniform(-HEARTBEAT_JITTER, HEARTBEAT_JITTER)
+    return now + HEARTBEAT_INTERVAL * (1 + jitter)
+
+
+def track_connection(connection, now=None):
+    """
+    Schedules next heartbeat of connection unless it is scheduled already
+    """
+    if connection.heartbeat_bucket is not None:
+        return
+    server_state = get_state()
+    now = time.monotonic() if now is None else now
+    bucket = int(next_beat(now) // BUCKET_SIZE)
+    connection.heartbeat_bucket = bucket
+    server_state.heartbeat_buckets.setdefault(bucket, []).append(connection)
+
+
+def beat(now=None):
+    """
+    Sends heartbeats to connections in all due buckets and reschedules them,
+    connections without socket or queue are dropped from the schedule
+    """
+    server_state = get_state()
+    now = time.monotonic() if now is None else now
+    buckets = server_state.heartbeat_buckets
+    due = int(now // BUCKET_SIZE)
+    sent = 0
+    for bucket in sorted(b for b in buckets if b <= due):
+        for connection in buckets.pop(bucket):
+            connection.heartbeat_bucket = None
+            if connection.heartbeat(ping=HEARTBEAT_PING):
+                sent += 1
+                track_connection(connection, now)
+    return sent
+
+
+def heartbeat_forever():
+    while True:
+        try:
+            beat()
+        except Exception as exc:
+            log.error(exc)
+        gevent.sleep(BUCKET_SIZE)
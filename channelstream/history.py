@@ -0,0 +1,272 @@
+"""
+Storage of channel message history - channels open their history through
+the configured backend. `MemoryHistory` keeps it in ring buffers while
+`SQLiteHistory` keeps it on disk and only a hot tail of the newest messages
+in memory, so history survives restarts and big `history_size` values do not
+inflate memory usage.
+"""
+import abc
+import importlib
+import logging
+import sqlite3
+
+from channelstream import patched_json as json
+from channelstream.frame import MessageFrame
+from channelstream.ringbuffer import RingBuffer
+from channelstream.utils import restore_message
+
+log = logging.getLogger(__name__)
+
+# newest messages of every channel kept in memory by disk backed histories
+HISTORY_HOT_SIZE = 10
+# milliseconds SQLite waits for other workers writing to a shared database,
+# queries run on the gevent hub so waiting blocks every greenlet
+SQLITE_BUSY_TIMEOUT = 100
+
+_backend = None
+
+
+def message_uuid(message):
+    return message.get("uuid") if message["type"] == "message" else None
+
+
+class HistoryBackend(abc.ABC):
+    """
+    Opens history of channels, history objects support the same operations
+    as `RingBuffer` - append, get, replace and remove by uuid, resize
+    and iteration from the oldest message
+    """
+
+    def __init__(self, url="", hot_size=None):
+        self.url = url
+        self.hot_size = HISTORY_HOT_SIZE if hot_size is None else hot_size
+
+    @abc.abstractmethod
+    def open(self, channel_name, capacity):
+        """ Returns history of the channel keeping up to capacity messages """
+
+    def close(self):
+        pass
+
+
+class MemoryHistory(HistoryBackend):
+    """ Keeps history in process memory """
+
+    def open(self, channel_name, capacity):
+        return RingBuffer(capacity, uuid_of=message_uuid)
+
+
+class SQLiteHistory(HistoryBackend):
+    """
+    Keeps history in SQLite database at `history_url` path, workers and
+    nodes can share the database - every message is stored once
+    """
+
+    def __init__(self, url="", hot_size=None):
+        super(SQLiteHistory, self).__init__(url, hot_size=hot_size)
+        path = url[len("sqlite://") :] if url.startswith("sqlite://") else url
+        self.db = sqlite3.connect(
+            path or ":memory:", isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout={}".format(SQLITE_BUSY_TIMEOUT))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "channel TEXT NOT NULL, "
+            "uuid TEXT NOT NULL, "
+            "frame BLOB NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS history_uuid "
+            "ON history (channel, uuid)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS history_channel ON history (channel, id)"
+        )
+
+    def open(self, channel_name, capacity):
+        return SQLiteChannelHistory(self.db, channel_name, capacity, self.hot_size)
+
+    def close(self):
+        self.db.close()
+
+
+def encode_frame(message):
+    return json.dumpb(dict(message))
+
+
+def decode_frame(data):
+    return MessageFrame.from_dict(restore_message(json.loads(data)))
+
+
+class SQLiteChannelHistory(object):
+    """
+    History of a single channel stored in SQLite, newest messages are kept
+    in a ring buffer too so appending and recent lookups do not read
+    the database
+    """
+
+    def __init__(self, db, channel_name, capacity, hot_size):
+        self.db = db
+        self.channel_name = channel_name
+        self.capacity = capacity
+        self.hot_size = hot_size
+        self.hot = RingBuffer(min(hot_size, capacity), uuid_of=message_uuid)
+        rows = self.db.execute(
+            "SELECT frame FROM history WHERE channel = ? ORDER BY id DESC LIMIT ?",
+            (channel_name, self.hot.capacity),
+        ).fetchall()
+        for row in reversed(rows):
+            self.hot.append(decode_frame(row[0]))
+        (self.count,) = self.db.execute(
+            "SELECT COUNT(*) FROM history WHERE channel = ?", (channel_name,)
+        ).fetchone()
+
+    def __repr__(self):
+        return "<SQLiteChannelHistory: %s %s/%s>" % (
+            self.channel_name,
+            self.count,
+            self.capacity,
+        )
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if self.count <= len(self.hot):
+            return iter(self.hot)
+        # newest rows within capacity, rows of a trim that did not run yet
+        # are not read
+        rows = self.db.execute(
+            "SELECT frame FROM (SELECT id, frame FROM history WHERE channel = ? "
+            "ORDER BY id DESC LIMIT ?) ORDER BY id",
+            (self.channel_name, self.capacity),
+        )
+        return (decode_frame(row[0]) for row in rows.fetchall())
+
+    def __getitem__(self, position):
+        size = min(self.count, self.capacity)
+        if position < 0:
+            position += size
+        if not 0 <= position < size:
+            raise IndexError("history index out of range")
+        newer = size - position - 1
+        if newer < len(self.hot):
+            return self.hot[-newer - 1]
+        row = self.db.execute(
+            "SELECT frame FROM history WHERE channel = ? "
+            "ORDER BY id DESC LIMIT 1 OFFSET ?",
+            (self.channel_name, newer),
+        ).fetchone()
+        if row is None:
+            raise IndexError("history index out of range")
+        return decode_frame(row[0])
+
+    def trim(self):
+        if self.count <= self.capacity:
+            return
+        # newest row past capacity by position, workers sharing the database
+        # trimming the same channel do not remove more than that
+        row = self.db.execute(
+            "SELECT id FROM history WHERE channel = ? "
+            "ORDER BY id DESC LIMIT 1 OFFSET ?",
+            (self.channel_name, self.capacity),
+        ).fetchone()
+        if row is None:
+            return
+        cursor = self.db.execute(
+            "DELETE FROM history WHERE channel = ? AND id <= ?",
+            (self.channel_name, row[0]),
+        )
+        self.count -= cursor.rowcount
+
+    def resize(self, capacity):
+        self.capacity = capacity
+        self.hot.resize(min(self.hot_size, capacity))
+        self.trim()
+
+    def append(self, message, key=None):
+        self.hot.append(message, key=key)
+        try:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO history (channel, uuid, frame) "
+                "VALUES (?, ?, ?)",
+                (self.channel_name, str(message["uuid"]), encode_frame(message)),
+            )
+            if cursor.rowcount:
+                self.count += cursor.rowcount
+            else:
+                # other worker sharing the database stored it already
+                (self.count,) = self.db.execute(
+                    "SELECT COUNT(*) FROM history WHERE channel = ?",
+                    (self.channel_name,),
+                ).fetchone()
+            self.trim()
+        except sqlite3.OperationalError as exc:
+            # database stayed locked by other workers, message is kept
+            # in the hot tail only
+            log.warning("history of %s not stored: %s" % (self.channel_name, exc))
+
+    def get(self, uuid):
+        message = self.hot.get(uuid)
+        if message is not None:
+            return message
+        row = self.db.execute(
+            "SELECT frame FROM history WHERE channel = ? AND uuid = ?",
+            (self.channel_name, str(uuid)),
+        ).fetchone()
+        return decode_frame(row[0]) if row else None
+
+    def replace(self, uuid, message):
+        cursor = self.db.execute(
+            "UPDATE history SET frame = ? WHERE channel = ? AND uuid = ?",
+            (encode_frame(message), self.channel_name, str(uuid)),
+        )
+        self.hot.replace(uuid, message)
+        return cursor.rowcount > 0
+
+    def remove(self, uuid):
+        message = self.get(uuid)
+        cursor = self.db.execute(
+            "DELETE FROM history WHERE channel = ? AND uuid = ?",
+            (self.channel_name, str(uuid)),
+        )
+        self.count -= cursor.rowcount
+        self.hot.remove(uuid)
+        return message
+
+    def clear(self):
+        self.db.execute(
+            "DELETE FROM history WHERE channel = ?", (self.channel_name,)
+        )
+        self.count = 0
+        self.hot.clear()
+
+
+def load_backend(server_config):
+    """
+    Creates history backend configured by `history_backend`, `history_url`
+    and `history_hot_size` settings
+    """
+    module_, class_ = server_config["history_backend"].rsplit(".", maxsplit=1)
+    backend_cls = getattr(importlib.import_module(module_), class_)
+    return backend_cls(
+        server_config["history_url"], hot_size=server_config["history_hot_size"]
+    )
+
+
+def use_backend(backend):
+    global _backend
+    if _backend is not None and _backend is not backend:
+        _backend.close()
+    _backend = backend
+    return backend
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = MemoryHistory()
+    return _backend
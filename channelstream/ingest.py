@@ -0,0 +1,137 @@
+"""
+Ingestion of messages posted to the API - messages are appended to ordered
+queues of their channels (direct messages share one queue) that are serviced
+by a bounded pool of worker greenlets instead of a greenlet per message.
+
+A queue is serviced by one worker at a time, so messages of a channel are
+passed in the order they were posted. Workers take up to `INGEST_BATCH_SIZE`
+consecutive messages of a queue at once and pass them in a single fan-out
+pass, then put the queue back at the end of the line if there are more.
+"""
+import logging
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import gevent
+from gevent.queue import Queue
+
+from channelstream import operations
+
+log = logging.getLogger(__name__)
+
+# size of the worker greenlet pool shared by all channels
+INGEST_WORKERS = 8
+# messages of a channel passed in one fan-out pass
+INGEST_BATCH_SIZE = 100
+
+# channel queues that have messages waiting for a worker
+_ready = Queue()
+_workers: List[gevent.Greenlet] = []
+_queues: Dict[Optional[str], "ChannelQueue"] = {}
+_stats = {
+    "ingested": 0,
+    "batches": 0,
+    "failed": 0,
+    "last_lag_ms": 0.0,
+    "max_lag_ms": 0.0,
+}
+
+
+def configure(workers=None, batch_size=None):
+    global INGEST_WORKERS, INGEST_BATCH_SIZE
+    if workers is not None:
+        INGEST_WORKERS = max(int(workers), 1)
+    if batch_size is not None:
+        INGEST_BATCH_SIZE = max(int(batch_size), 1)
+
+
+class ChannelQueue(object):
+    """ Ordered messages of one channel waiting to be passed """
+
+    __slots__ = ("key", "messages", "stats", "scheduled")
+
+    def __init__(self, key):
+        self.key = key
+        # (message, time it was queued)
+        self.messages = deque()
+        self.stats = None
+        self.scheduled = False
+
+    def process(self):
+        batch = []
+        while self.messages and len(batch) < INGEST_BATCH_SIZE:
+            batch.append(self.messages.popleft())
+        try:
+            operations.pass_messages([msg for msg, _ in batch], self.stats)
+        except Exception:
+            # messages were accepted by the API already, delivery may have
+            # been partial so they are not retried
+            _stats["failed"] += len(batch)
+            log.exception(
+                "passing {} messages of {} failed".format(len(batch), self.key)
+            )
+        finally:
+            lag_ms = (time.perf_counter() - batch[0][1]) * 1000
+            _stats["ingested"] += len(batch)
+            _stats["batches"] += 1
+            _stats["last_lag_ms"] = round(lag_ms, 3)
+            _stats["max_lag_ms"] = max(_stats["max_lag_ms"], _stats["last_lag_ms"])
+            if self.messages:
+                # other channels get their turn before the next batch
+                _ready.put(self)
+            else:
+                self.scheduled = False
+                _queues.pop(self.key, None)
+
+
+def ensure_workers():
+    _workers[:] = [w for w in _workers if not w.dead]
+    while len(_workers) < INGEST_WORKERS:
+        _workers.append(gevent.spawn(work_forever))
+
+
+def work_forever():
+    while True:
+        queue = _ready.get()
+        try:
+            queue.process()
+        except Exception:
+            log.exception("ingest worker failed")
+        # let greenlets writing to sockets run between batches
+        gevent.sleep(0)
+
+
+def submit(messages, stats):
+    """
+    Queues validated messages for passing, messages of the same channel
+    are passed in the order of the list
+    """
+    now = time.perf_counter()
+    for msg in messages:
+        key = msg.get("channel")
+        queue = _queues.get(key)
+        if queue is None:
+            queue = _queues[key] = ChannelQueue(key)
+        queue.stats = stats
+        queue.messages.append((msg, now))
+        if not queue.scheduled:
+            queue.scheduled = True
+            _ready.put(queue)
+    ensure_workers()
+
+
+def get_stats():
+    now = time.perf_counter()
+    oldest = [q.messages[0][1] for q in _queues.values() if q.messages]
+    return {
+        "workers": len([w for w in _workers if not w.dead]),
+        "queued_channels": _ready.qsize(),
+        "depth": sum(len(q.messages) for q in _queues.values()),
+        "lag_ms": round((now - min(oldest)) * 1000, 3) if oldest else 0.0,
+        "last_lag_ms": _stats["last_lag_ms"],
+        "max_lag_ms": _stats["max_lag_ms"],
+        "ingested": _stats["ingested"],
+        "batches": _stats["batches"],
+        "failed": _stats["failed"],
+    }
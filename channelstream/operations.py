@@ -1,12 +1,25 @@
+import itertools
 import logging
+import uuid
+from datetime import datetime, timedelta
 
+import gevent
+
+from channelstream import backplane, gc, heartbeat
 from channelstream.channel import Channel
 from channelstream.connection import Connection
+from channelstream.frame import MessageFrame
 from channelstream.server_state import get_state
 from channelstream.user import User
+from channelstream.utils import restore_message
 
 log = logging.getLogger(__name__)
 
+# how often nodes publish their counters to other nodes, in seconds
+STATS_INTERVAL = 5
+# after how many missed intervals connections of a node are removed
+PEER_TIMEOUT = 3
+
 
 def connect(
     username=None,
@@ -16,6 +29,8 @@ def connect(
     conn_id=None,
     channels=None,
     channel_configs=None,
+    frames_size=None,
+    publish=True,
 ):
     """
 
@@ -26,124 +41,354 @@ def connect(
     :param conn_id:
     :param channels:
     :param channel_configs:
+    :param frames_size: how many private catchup frames user keeps
+    :param publish: replicate the operation to other nodes
     :return:
     """
     server_state = get_state()
-    with server_state.lock:
-        if username not in server_state.users:
-            user = User(username)
-            user.state_from_dict(fresh_user_state)
-            server_state.users[username] = user
-        else:
-            user = server_state.users[username]
-        if state_public_keys is not None:
-            user.state_public_keys = state_public_keys
-
-        user.state_from_dict(update_user_state)
-        connection = Connection(username, conn_id)
-        if connection.id not in server_state.connections:
-            server_state.connections[connection.id] = connection
-        user.add_connection(connection)
-        for channel_name in channels:
-            # user gets assigned to a channel
-            if channel_name not in server_state.channels:
-                channel = Channel(
-                    channel_name, channel_config=channel_configs.get(channel_name)
-                )
-                server_state.channels[channel_name] = channel
-            server_state.channels[channel_name].add_connection(connection)
-        log.info("connecting %s with uuid %s" % (username, connection.id))
+    with server_state.locks(usernames=[username], channels=channels or ()):
+        connection, user = _connect(
+            username,
+            fresh_user_state,
+            state_public_keys,
+            update_user_state,
+            conn_id,
+            channels,
+            channel_configs,
+            frames_size,
+        )
+        if publish:
+            backplane.publish(
+                "connect",
+                _connect_payload(
+                    username,
+                    fresh_user_state,
+                    state_public_keys,
+                    update_user_state,
+                    connection.id,
+                    channels,
+                    channel_configs,
+                    frames_size,
+                ),
+            )
         return connection, user
 
 
-def subscribe(connection=None, channels=None, channel_configs=None):
+def _connect(
+    username,
+    fresh_user_state,
+    state_public_keys,
+    update_user_state,
+    conn_id,
+    channels,
+    channel_configs,
+    frames_size,
+):
+    """ Body of `connect`, callers hold the locks """
+    server_state = get_state()
+    if username not in server_state.users:
+        user = User(username)
+        user.state_from_dict(fresh_user_state)
+        server_state.users[username] = user
+    else:
+        user = server_state.users[username]
+    if state_public_keys is not None:
+        user.state_public_keys = state_public_keys
+    if frames_size is not None:
+        user.frames_size = frames_size
+
+    user.state_from_dict(update_user_state)
+    connection = Connection(username, conn_id)
+    if connection.id not in server_state.connections:
+        server_state.connections[connection.id] = connection
+    user.add_connection(connection)
+    for channel_name in channels:
+        # user gets assigned to a channel
+        if channel_name not in server_state.channels:
+            channel = Channel(
+                channel_name, channel_config=channel_configs.get(channel_name)
+            )
+            server_state.channels[channel_name] = channel
+        server_state.channels[channel_name].add_connection(connection)
+    log.info("connecting %s with uuid %s" % (username, connection.id))
+    return connection, user
+
+
+def _connect_payload(
+    username,
+    fresh_user_state,
+    state_public_keys,
+    update_user_state,
+    conn_id,
+    channels,
+    channel_configs,
+    frames_size,
+):
+    return {
+        "username": username,
+        "fresh_user_state": fresh_user_state,
+        "state_public_keys": state_public_keys,
+        "update_user_state": update_user_state,
+        "conn_id": conn_id,
+        "channels": channels,
+        "channel_configs": channel_configs,
+        "frames_size": frames_size,
+    }
+
+
+def subscribe(connection=None, channels=None, channel_configs=None, publish=True):
     """
 
     :param connection:
     :param channels:
     :param channel_configs:
+    :param publish: replicate the operation to other nodes
     :return:
     """
     server_state = get_state()
+    with server_state.locks(usernames=[connection.username], channels=channels or ()):
+        subscribed_to = _subscribe(connection, channels, channel_configs)
+        if subscribed_to is not None and publish:
+            payload = {
+                "conn_id": connection.id,
+                "channels": channels,
+                "channel_configs": channel_configs,
+            }
+            backplane.publish("subscribe", payload)
+    return subscribed_to or []
+
+
+def _subscribe(connection, channels, channel_configs):
+    """
+    Body of `subscribe`, callers hold the locks - returns None
+    if connection is gone
+    """
+    server_state = get_state()
     user = server_state.users.get(connection.username)
+    # connection could be collected while we waited for locks
+    if not user or server_state.connections.get(connection.id) is not connection:
+        return None
     subscribed_to = []
-    with server_state.lock:
-        if user:
-            for channel_name in channels:
-                if channel_name not in server_state.channels:
-                    channel = Channel(
-                        channel_name, channel_config=channel_configs.get(channel_name)
-                    )
-                    server_state.channels[channel_name] = channel
-                is_found = server_state.channels[channel_name].add_connection(
-                    connection
-                )
-                if is_found:
-                    subscribed_to.append(channel_name)
+    for channel_name in channels:
+        if channel_name not in server_state.channels:
+            channel = Channel(
+                channel_name, channel_config=channel_configs.get(channel_name)
+            )
+            server_state.channels[channel_name] = channel
+        is_found = server_state.channels[channel_name].add_connection(connection)
+        if is_found:
+            subscribed_to.append(channel_name)
     return subscribed_to
 
 
-def unsubscribe(connection=None, unsubscribe_channels=None):
+def unsubscribe(connection=None, unsubscribe_channels=None, publish=True):
     """
 
     :param connection:
     :param unsubscribe_channels:
+    :param publish: replicate the operation to other nodes
     :return:
     """
     server_state = get_state()
-    user = server_state.users.get(connection.username)
+    with server_state.locks(
+        usernames=[connection.username], channels=unsubscribe_channels or ()
+    ):
+        unsubscribed_from = _unsubscribe(connection, unsubscribe_channels)
+        if unsubscribed_from is not None and publish:
+            payload = {"conn_id": connection.id, "channels": unsubscribe_channels}
+            backplane.publish("unsubscribe", payload)
+    return unsubscribed_from or []
+
+
+def _unsubscribe(connection, unsubscribe_channels):
+    """
+    Body of `unsubscribe`, callers hold the locks - returns None
+    if user is gone
+    """
+    server_state = get_state()
+    if not server_state.users.get(connection.username):
+        return None
     unsubscribed_from = []
-    with server_state.lock:
-        if user:
-            for channel_name in unsubscribe_channels:
-                if channel_name in server_state.channels:
-                    is_found = server_state.channels[channel_name].remove_connection(
-                        connection
-                    )
-                    if is_found:
-                        unsubscribed_from.append(channel_name)
+    for channel_name in unsubscribe_channels:
+        if channel_name in server_state.channels:
+            is_found = server_state.channels[channel_name].remove_connection(connection)
+            if is_found:
+                unsubscribed_from.append(channel_name)
     return unsubscribed_from
 
 
-def change_user_state(user_inst=None, user_state=None):
+def bulk_connect(items, publish=True):
+    """
+    Connects many users acquiring every needed lock partition once,
+    replicated to other nodes as a single operation
+
+    :param items: dicts of `connect` keyword arguments
+    :param publish: replicate the operation to other nodes
+    :return: list of (connection, user) tuples in order of items
+    """
+    server_state = get_state()
+    usernames = [item["username"] for item in items]
+    channels = {name for item in items for name in item["channels"]}
+    results = []
+    replicated = []
+    with server_state.locks(usernames=usernames, channels=channels):
+        for item in items:
+            connection, user = _connect(
+                item["username"],
+                item.get("fresh_user_state"),
+                item.get("state_public_keys"),
+                item.get("update_user_state"),
+                item.get("conn_id"),
+                item["channels"],
+                item.get("channel_configs") or {},
+                item.get("frames_size"),
+            )
+            results.append((connection, user))
+            payload = _connect_payload(
+                item["username"],
+                item.get("fresh_user_state"),
+                item.get("state_public_keys"),
+                item.get("update_user_state"),
+                connection.id,
+                item["channels"],
+                item.get("channel_configs") or {},
+                item.get("frames_size"),
+            )
+            replicated.append(("connect", payload))
+        if publish:
+            backplane.publish("bulk", {"operations": replicated})
+    return results
+
+
+def bulk_subscribe(items, publish=True):
+    """
+    Subscribes many connections acquiring every needed lock partition once
+
+    :param items: dicts with connection, channels and channel_configs
+    :param publish: replicate the operation to other nodes
+    :return: list of subscribed channel lists in order of items,
+        None for connections that are gone
+    """
+    server_state = get_state()
+    usernames = {item["connection"].username for item in items}
+    channels = {name for item in items for name in item["channels"]}
+    results = []
+    replicated = []
+    with server_state.locks(usernames=usernames, channels=channels):
+        for item in items:
+            connection = item["connection"]
+            channel_configs = item.get("channel_configs") or {}
+            subscribed_to = _subscribe(connection, item["channels"], channel_configs)
+            results.append(subscribed_to)
+            if subscribed_to is not None:
+                payload = {
+                    "conn_id": connection.id,
+                    "channels": item["channels"],
+                    "channel_configs": channel_configs,
+                }
+                replicated.append(("subscribe", payload))
+        if publish and replicated:
+            backplane.publish("bulk", {"operations": replicated})
+    return results
+
+
+def bulk_unsubscribe(items, publish=True):
+    """
+    Unsubscribes many connections acquiring every needed lock partition once
+
+    :param items: dicts with connection and channels
+    :param publish: replicate the operation to other nodes
+    :return: list of unsubscribed channel lists in order of items,
+        None for connections of users that are gone
+    """
+    server_state = get_state()
+    usernames = {item["connection"].username for item in items}
+    channels = {name for item in items for name in item["channels"]}
+    results = []
+    replicated = []
+    with server_state.locks(usernames=usernames, channels=channels):
+        for item in items:
+            connection = item["connection"]
+            unsubscribed_from = _unsubscribe(connection, item["channels"])
+            results.append(unsubscribed_from)
+            if unsubscribed_from is not None:
+                payload = {"conn_id": connection.id, "channels": item["channels"]}
+                replicated.append(("unsubscribe", payload))
+        if publish and replicated:
+            backplane.publish("bulk", {"operations": replicated})
+    return results
+
+
+def change_user_state(user_inst=None, user_state=None, publish=True):
     """
 
     :param user_inst:
     :param user_state:
+    :param publish: replicate the operation to other nodes
     :return:
     """
-    changed = user_inst.state_from_dict(user_state)
-    # mark active
-    user_inst.mark_activity()
-    if changed:
-        channels = user_inst.get_channels()
-        for channel in [c for c in channels if c.notify_state]:
-            channel.send_user_state(user_inst, changed)
+    server_state = get_state()
+    channel_names = user_inst.channel_names
+    with server_state.locks(usernames=[user_inst.username], channels=channel_names):
+        changed = user_inst.state_from_dict(user_state)
+        # mark active
+        user_inst.mark_activity()
+        if changed:
+            channels = user_inst.get_channels()
+            for channel in [c for c in channels if c.notify_state]:
+                channel.send_user_state(user_inst, changed)
+        if publish:
+            payload = {
+                "username": user_inst.username,
+                "user_state": user_state,
+                "state_public_keys": user_inst.state_public_keys,
+            }
+            backplane.publish("change_user_state", payload)
     return changed
 
 
-def disconnect(conn_id):
+def disconnect(conn_id, publish=True):
     """
 
     :param conn_id:
+    :param publish: replicate the operation to other nodes
     :return:
     """
     server_state = get_state()
     conn = server_state.connections.get(conn_id)
     if conn is not None:
-        conn.mark_for_gc()
+        gc.collect_connection(conn)
+        if publish:
+            backplane.publish("disconnect", {"conn_id": conn_id})
         return True
     return False
 
 
-def set_channel_config(channel_configs):
+def claim_connection(connection, publish=True):
+    """
+    Marks connection as served by this node after a socket or long
+    polling queue got attached to it, other nodes stop serving it
+
+    :param connection:
+    :param publish: replicate the operation to other nodes
+    :return:
+    """
+    was_remote = connection.remote
+    connection.owner = None
+    heartbeat.track_connection(connection)
+    if publish and was_remote:
+        backplane.publish("claim_connection", {"conn_id": connection.id})
+
+
+def set_channel_config(channel_configs, publish=True):
     """
 
     :param channel_configs:
+    :param publish: replicate the operation to other nodes
     :return:
     """
     server_state = get_state()
-    with server_state.lock:
+    with server_state.locks(channels=channel_configs.keys()):
         for channel_name, config in channel_configs.items():
             if not server_state.channels.get(channel_name):
                 channel = Channel(
@@ -153,70 +398,300 @@ def set_channel_config(channel_configs):
             else:
                 channel = server_state.channels[channel_name]
                 channel.reconfigure_from_dict(channel_configs.get(channel_name))
+        if publish:
+            payload = {"channel_configs": channel_configs}
+            backplane.publish("set_channel_config", payload)
 
 
-def pass_message(msg, stats):
+def pass_message(msg, stats, publish=True):
     """
 
     :param msg:
     :param stats:
+    :param publish: replicate the operation to other nodes
+    :return:
+    """
+    pass_messages([msg], stats, publish=publish)
+
+
+def pass_messages(msgs, stats, publish=True):
+    """
+    Passes messages in order, consecutive messages of a channel are added
+    under one lock acquisition in a single fan-out pass
+
+    :param msgs:
+    :param stats:
+    :param publish: replicate the operation to other nodes
     :return:
     """
     server_state = get_state()
-    msg["catchup"] = False
-    msg["edited"] = None
-    msg["type"] = "message"
+    for msg in msgs:
+        msg["catchup"] = False
+        msg["edited"] = None
+        msg["type"] = "message"
+        if publish:
+            # stream sequence numbers are assigned by the publisher only
+            msg.pop("seq", None)
 
     total_sent = 0
-    stats["total_unique_messages"] += 1
-    if msg.get("channel"):
-        channel_inst = server_state.channels.get(msg["channel"])
-        if channel_inst:
-            total_sent += channel_inst.add_message(
-                msg, pm_users=msg["pm_users"], exclude_users=msg["exclude_users"]
-            )
-    elif msg["pm_users"]:
-        # if pm then iterate over all users and notify about new message!
-        for username in msg["pm_users"]:
-            user_inst = server_state.users.get(username)
-            if user_inst:
-                total_sent += user_inst.add_message(msg)
+    stats["total_unique_messages"] += len(msgs)
+    for channel_name, group in itertools.groupby(msgs, lambda m: m.get("channel")):
+        if channel_name:
+            with server_state.locks(channels=[channel_name]):
+                channel_inst = server_state.channels.get(channel_name)
+                if channel_inst:
+                    total_sent += channel_inst.add_messages(list(group))
+            continue
+        for msg in group:
+            if not msg["pm_users"]:
+                continue
+            # if pm then iterate over all users and notify about new message!
+            # all of them share single frame
+            frame = MessageFrame.from_dict(msg)
+            with server_state.locks(usernames=msg["pm_users"]):
+                for username in msg["pm_users"]:
+                    user_inst = server_state.users.get(username)
+                    if user_inst:
+                        total_sent += user_inst.add_message(frame)
     stats["total_messages"] += total_sent
+    # published once numbered, so every process resumes streams from
+    # the same sequence numbers
+    if publish:
+        if len(msgs) == 1:
+            backplane.publish("pass_message", msgs[0])
+        else:
+            replicated = [("pass_message", msg) for msg in msgs]
+            backplane.publish("bulk", {"operations": replicated})
 
 
-def edit_message(msg):
+def edit_message(msg, publish=True):
     """
 
     :param msg:
+    :param publish: replicate the operation to other nodes
     :return:
     """
     server_state = get_state()
+    if publish:
+        backplane.publish("edit_message", msg)
     if msg.get("channel"):
-        channel_inst = server_state.channels.get(msg["channel"])
-        if channel_inst:
-            channel_inst.alter_message(msg)
+        with server_state.locks(channels=[msg["channel"]]):
+            channel_inst = server_state.channels.get(msg["channel"])
+            if channel_inst:
+                channel_inst.alter_message(msg)
     elif msg["pm_users"]:
         # if pm then iterate over all users and notify about new message!
-        for username in msg["pm_users"]:
-            user_inst = server_state.users.get(username)
-            if user_inst:
-                user_inst.alter_message(msg)
+        with server_state.locks(usernames=msg["pm_users"]):
+            for username in msg["pm_users"]:
+                user_inst = server_state.users.get(username)
+                if user_inst:
+                    user_inst.alter_message(msg)
 
 
-def delete_message(msg):
+def delete_message(msg, publish=True):
     """
 
     :param msg:
+    :param publish: replicate the operation to other nodes
     :return:
     """
     server_state = get_state()
+    if publish:
+        backplane.publish("delete_message", msg)
     if msg.get("channel"):
-        channel_inst = server_state.channels.get(msg["channel"])
-        if channel_inst:
-            channel_inst.delete_message(msg)
+        with server_state.locks(channels=[msg["channel"]]):
+            channel_inst = server_state.channels.get(msg["channel"])
+            if channel_inst:
+                channel_inst.delete_message(msg)
     elif msg["pm_users"]:
         # if pm then iterate over all users and notify about new message!
-        for username in msg["pm_users"]:
-            user_inst = server_state.users.get(username)
-            if user_inst:
-                user_inst.delete_message(msg)
+        with server_state.locks(usernames=msg["pm_users"]):
+            for username in msg["pm_users"]:
+                user_inst = server_state.users.get(username)
+                if user_inst:
+                    user_inst.delete_message(msg)
+
+
+def _remote_connect(payload, node_id):
+    payload["conn_id"] = uuid.UUID(payload["conn_id"])
+    connection, user = connect(publish=False, **payload)
+    # socket of the connection is served by the node that created it
+    connection.owner = node_id
+    registered = get_state().connections.get(connection.id)
+    if registered is not None:
+        registered.owner = node_id
+
+
+def _remote_subscribe(payload, node_id):
+    server_state = get_state()
+    connection = server_state.connections.get(uuid.UUID(payload["conn_id"]))
+    if connection is not None:
+        subscribe(
+            connection=connection,
+            channels=payload["channels"],
+            channel_configs=payload["channel_configs"],
+            publish=False,
+        )
+
+
+def _remote_unsubscribe(payload, node_id):
+    server_state = get_state()
+    connection = server_state.connections.get(uuid.UUID(payload["conn_id"]))
+    if connection is not None:
+        unsubscribe(
+            connection=connection,
+            unsubscribe_channels=payload["channels"],
+            publish=False,
+        )
+
+
+def _remote_change_user_state(payload, node_id):
+    server_state = get_state()
+    user_inst = server_state.users.get(payload["username"])
+    if user_inst is not None:
+        user_inst.state_public_keys = payload["state_public_keys"]
+        change_user_state(
+            user_inst=user_inst, user_state=payload["user_state"], publish=False
+        )
+
+
+def _remote_disconnect(payload, node_id):
+    disconnect(uuid.UUID(payload["conn_id"]), publish=False)
+
+
+def _remote_claim_connection(payload, node_id):
+    server_state = get_state()
+    connection = server_state.connections.get(uuid.UUID(payload["conn_id"]))
+    if connection is None:
+        return
+    connection.owner = node_id
+    connection.queue = None
+    socket, connection.socket = connection.socket, None
+    if socket is not None and not socket.terminated:
+        # client reconnected to other node
+        socket.close()
+
+
+def _remote_set_channel_config(payload, node_id):
+    set_channel_config(payload["channel_configs"], publish=False)
+
+
+def _remote_pass_message(payload, node_id):
+    server_state = get_state()
+    pass_message(restore_message(payload), server_state.stats, publish=False)
+
+
+def _remote_edit_message(payload, node_id):
+    edit_message(restore_message(payload), publish=False)
+
+
+def _remote_delete_message(payload, node_id):
+    delete_message(restore_message(payload), publish=False)
+
+
+def _remote_bulk(payload, node_id):
+    for operation, item_payload in payload["operations"]:
+        apply_remote(operation, item_payload, node_id)
+
+
+def _remote_stats(payload, node_id):
+    server_state = get_state()
+    payload["updated"] = datetime.utcnow()
+    server_state.peer_stats[node_id] = payload
+
+
+REMOTE_OPERATIONS = {
+    "connect": _remote_connect,
+    "subscribe": _remote_subscribe,
+    "unsubscribe": _remote_unsubscribe,
+    "change_user_state": _remote_change_user_state,
+    "disconnect": _remote_disconnect,
+    "claim_connection": _remote_claim_connection,
+    "set_channel_config": _remote_set_channel_config,
+    "pass_message": _remote_pass_message,
+    "edit_message": _remote_edit_message,
+    "delete_message": _remote_delete_message,
+    "bulk": _remote_bulk,
+    "stats": _remote_stats,
+}
+
+
+def apply_remote(operation, payload, node_id=None):
+    """
+    Applies operation published by another node to local state
+    without publishing it again
+
+    :param operation:
+    :param payload:
+    :param node_id: node that published the operation
+    :return:
+    """
+    handler = REMOTE_OPERATIONS.get(operation)
+    if handler is None:
+        log.warning("unknown backplane operation {}".format(operation))
+        return
+    handler(payload, node_id)
+
+
+def local_stats():
+    """
+    Counters of this node that get aggregated by other nodes
+    """
+    server_state = get_state()
+    local_connections = (
+        len(server_state.connections) - server_state.remote_connection_count
+    )
+    return {
+        "total_messages": server_state.stats["total_messages"],
+        "connections": local_connections,
+    }
+
+
+def live_peers():
+    server_state = get_state()
+    cutoff = datetime.utcnow() - timedelta(seconds=STATS_INTERVAL * PEER_TIMEOUT)
+    return {
+        node_id: peer
+        for node_id, peer in server_state.peer_stats.items()
+        if peer["updated"] > cutoff
+    }
+
+
+def cluster_stats():
+    """
+    Sums counters of this node and ones recently published by others
+    """
+    nodes = list(live_peers().values()) + [local_stats()]
+    return {
+        "nodes": len(nodes),
+        "connections": sum(node["connections"] for node in nodes),
+        "total_messages": sum(node["total_messages"] for node in nodes),
+    }
+
+
+def expire_peers():
+    """
+    Forgets nodes that stopped publishing their stats, connections served
+    by them are removed on every node independently
+    """
+    server_state = get_state()
+    peers = live_peers()
+    expired = [n for n in server_state.peer_stats.keys() if n not in peers]
+    for node_id in expired:
+        log.warning("node {} stopped responding".format(node_id))
+        del server_state.peer_stats[node_id]
+        for conn in list(server_state.connections.values()):
+            if conn.owner == node_id:
+                disconnect(conn.id, publish=False)
+    return expired
+
+
+def publish_stats_forever(interval=STATS_INTERVAL):
+    """ Publishes stats of this node that also serve as its heartbeat """
+    while True:
+        try:
+            backplane.publish("stats", local_stats())
+            expire_peers()
+        except Exception as exc:
+            log.error(exc)
+        gevent.sleep(interval)
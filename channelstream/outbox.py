@@ -0,0 +1,216 @@
+"""
+Bounded outbound buffers of websocket connections - payloads are written
+by a writer greenlet of the connection so slow clients do not hold up
+delivery to others, the greenlet runs only while there is something
+to write.
+
+Payloads waiting in the outbox are coalesced into single frames, under load
+the writer also waits up to a flush window for more of them.
+"""
+import logging
+import time
+import weakref
+from collections import deque
+from typing import MutableSet
+
+import gevent
+from gevent.event import Event
+
+from channelstream.patched_json import merge_encoded
+
+log = logging.getLogger(__name__)
+
+# what to do when outbox of a connection is full
+POLICIES = ("drop_oldest", "conflate", "disconnect")
+OUTBOX_SIZE = 1000
+OUTBOX_POLICY = "disconnect"
+# default seconds a busy connection waits to coalesce payloads, 0 disables it
+FLUSH_WINDOW = 0.0
+# coalesced frames are flushed once they would get bigger than this,
+# 0 disables coalescing
+FLUSH_MAX_BYTES = 65536
+
+# marker of websocket ping control frame in outbox
+PING = object()
+
+# outboxes with pending payloads or ones that dropped some, so slow
+# connections can be listed without scanning all of them
+_backlogged: MutableSet["Outbox"] = weakref.WeakSet()
+
+
+def configure(size=None, policy=None, flush_window=None, flush_max_bytes=None):
+    global OUTBOX_SIZE, OUTBOX_POLICY, FLUSH_WINDOW, FLUSH_MAX_BYTES
+    if flush_window is not None:
+        FLUSH_WINDOW = max(float(flush_window), 0.0)
+    if flush_max_bytes is not None:
+        FLUSH_MAX_BYTES = max(int(flush_max_bytes), 0)
+    if size is not None:
+        OUTBOX_SIZE = max(int(size), 1)
+    if policy is not None:
+        if policy not in POLICIES:
+            log.warning("Unknown outbox policy {}, using disconnect".format(policy))
+            policy = "disconnect"
+        OUTBOX_POLICY = policy
+
+
+class Outbox(object):
+    """
+    Payloads waiting to be written to websocket of connection, when full:
+
+    * drop_oldest - oldest payload is dropped
+    * conflate - oldest payload with the same key (channel) is replaced,
+      oldest payload is dropped if there is none
+    * disconnect - connection gets disconnected, client will get
+      catchup messages when it reconnects
+
+    Payloads get a flush window - a connection that has pending payloads
+    or flushed recently waits that long for more of them, an idle one
+    writes right away.
+    """
+
+    __slots__ = (
+        "connection",
+        "items",
+        "size",
+        "policy",
+        "dropped",
+        "writer",
+        "bytes",
+        "deadline",
+        "last_flush",
+        "wakeup",
+        "frames",
+        "coalesced",
+        "__weakref__",
+    )
+
+    def __init__(self, connection, size=None, policy=None):
+        self.connection = connection
+        self.items = deque()
+        self.size = size or OUTBOX_SIZE
+        self.policy = policy or OUTBOX_POLICY
+        self.dropped = 0
+        self.writer = None
+        # size of pending payloads
+        self.bytes = 0
+        # when pending payloads have to be flushed
+        self.deadline = 0.0
+        self.last_flush = 0.0
+        # set when writer waiting for flush window should flush sooner
+        self.wakeup = None
+        # frames written and payloads merged into other frames
+        self.frames = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _pop(self, index=0):
+        key, payload = self.items[index]
+        del self.items[index]
+        if payload is not PING:
+            self.bytes -= len(payload)
+        return key, payload
+
+    def _make_room(self, key):
+        if self.policy == "conflate" and key is not None:
+            for i, item in enumerate(self.items):
+                if item[0] == key:
+                    self._pop(i)
+                    return
+        self._pop()
+
+    def put(self, payload, key=None, window=0.0):
+        """
+        Queues payload for writing, returns False if the connection
+        should be disconnected instead
+
+        :param window: seconds the payload can wait to be coalesced
+            with others when connection is busy
+        """
+        if len(self.items) >= self.size:
+            self.dropped += 1
+            _backlogged.add(self)
+            if self.policy == "disconnect":
+                self.items.clear()
+                self.bytes = 0
+                return False
+            self._make_room(key)
+        now = time.monotonic()
+        # adapt to load - idle connections do not wait for the window
+        if window and not self.items and now - self.last_flush >= window:
+            window = 0.0
+        deadline = now + window
+        if not self.items or deadline < self.deadline:
+            self.deadline = deadline
+        self.items.append((key, payload))
+        if payload is not PING:
+            self.bytes += len(payload)
+        if self.writer is None:
+            _backlogged.add(self)
+            self.writer = gevent.spawn(self.drain)
+        elif self.wakeup is not None and (
+            deadline <= now or self.bytes >= FLUSH_MAX_BYTES
+        ):
+            self.wakeup.set()
+        return True
+
+    def pop_frame(self):
+        """
+        Removes pending payloads that fit into one frame and merges them
+        """
+        payloads = []
+        size = 0
+        while self.items:
+            payload = self.items[0][1]
+            if payload is PING or (
+                payloads and size + len(payload) > FLUSH_MAX_BYTES
+            ):
+                break
+            self._pop()
+            payloads.append(payload)
+            size += len(payload)
+        if len(payloads) == 1:
+            return payloads[0]
+        self.coalesced += len(payloads) - 1
+        return merge_encoded(payloads)
+
+    def wait_for_window(self):
+        delay = self.deadline - time.monotonic()
+        if delay <= 0 or self.bytes >= FLUSH_MAX_BYTES:
+            return
+        if self.wakeup is None:
+            self.wakeup = Event()
+        self.wakeup.clear()
+        self.wakeup.wait(delay)
+
+    def drain(self):
+        connection = self.connection
+        try:
+            while self.items:
+                self.wait_for_window()
+                socket = connection.socket
+                if socket is None or socket.terminated:
+                    break
+                if not self.items:
+                    break
+                if self.items[0][1] is PING:
+                    self._pop()
+                    socket.ping("")
+                else:
+                    socket.send(self.pop_frame())
+                self.frames += 1
+                self.last_flush = time.monotonic()
+                connection.mark_delivery()
+        except Exception as exc:
+            log.info(exc)
+            connection.mark_for_gc()
+        finally:
+            self.writer = None
+            if not self.items and not self.dropped:
+                _backlogged.discard(self)
+
+
+def backlogged():
+    """ Outboxes that have pending payloads or dropped some """
+    return list(_backlogged)
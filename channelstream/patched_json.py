@@ -2,43 +2,160 @@ from __future__ import absolute_import
 
 import datetime
 import decimal
-import functools
 import json
+import logging
 import uuid
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+log = logging.getLogger(__name__)
+
+COMPACT_SEPARATORS = (",", ":")
+PRETTY_SEPARATORS = (",", ": ")
+
+
+def complex_default(obj):
+    if isinstance(obj, complex):
+        return [obj.real, obj.imag]
+    elif isinstance(obj, datetime.datetime):
+        r = obj.isoformat()
+        if r.endswith("+00:00"):
+            r = r[:-6] + "Z"
+        return r
+    elif isinstance(obj, uuid.UUID):
+        return str(obj)
+    elif isinstance(obj, datetime.date):
+        return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        return str(obj)
+    elif isinstance(obj, datetime.time):
+        r = obj.isoformat()
+        if obj.microsecond:
+            r = r[:12]
+        return r
+    elif isinstance(obj, set):
+        return list(obj)
+    elif hasattr(obj, "__json__"):
+        if callable(obj.__json__):
+            return obj.__json__()
+        else:
+            return obj.__json__
+    else:
+        raise NotImplementedError
+
 
 class ComplexEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, complex):
-            return [obj.real, obj.imag]
-        elif isinstance(obj, datetime.datetime):
-            r = obj.isoformat()
-            if r.endswith("+00:00"):
-                r = r[:-6] + "Z"
-            return r
-        elif isinstance(obj, uuid.UUID):
-            return str(obj)
-        elif isinstance(obj, datetime.date):
-            return obj.isoformat()
-        elif isinstance(obj, decimal.Decimal):
-            return str(obj)
-        elif isinstance(obj, datetime.time):
-            r = obj.isoformat()
-            if obj.microsecond:
-                r = r[:12]
-            return r
-        elif isinstance(obj, set):
-            return list(obj)
-        elif hasattr(obj, "__json__"):
-            if callable(obj.__json__):
-                return obj.__json__()
-            else:
-                return obj.__json__
-        else:
-            raise NotImplementedError
+        return complex_default(obj)
+
+
+def _chain_default(default):
+    """
+    Prefer adapters passed by the caller (like pyramid renderer adapters)
+    and fall back to our own type handling
+    """
+    if default is None:
+        return complex_default
+
+    def chained(obj):
+        try:
+            return default(obj)
+        except TypeError:
+            return complex_default(obj)
+
+    return chained
+
+
+def stdlib_dumps(obj, default=None, **kwargs):
+    if kwargs.get("indent") is not None:
+        kwargs.setdefault("separators", PRETTY_SEPARATORS)
+    else:
+        kwargs.setdefault("separators", COMPACT_SEPARATORS)
+    return json.dumps(obj, default=_chain_default(default), **kwargs)
+
+
+def stdlib_dumpb(obj, default=None, **kwargs):
+    return stdlib_dumps(obj, default=default, **kwargs).encode("utf8")
+
+
+if orjson is not None:
+    ORJSON_OPTIONS = (
+        orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+        | orjson.OPT_NON_STR_KEYS
+    )
+
+
+def orjson_dumpb(obj, default=None, **kwargs):
+    if kwargs:
+        # pretty printing and other stdlib options are not supported
+        return stdlib_dumpb(obj, default=default, **kwargs)
+    try:
+        return orjson.dumps(obj, default=_chain_default(default), option=ORJSON_OPTIONS)
+    except TypeError:
+        # let stdlib handle big integers or raise familiar exceptions
+        return stdlib_dumpb(obj, default=default)
+
+
+def orjson_dumps(obj, default=None, **kwargs):
+    return orjson_dumpb(obj, default=default, **kwargs).decode("utf8")
+
+
+BACKENDS = {"json": (stdlib_dumps, stdlib_dumpb)}
+if orjson is not None:
+    BACKENDS["orjson"] = (orjson_dumps, orjson_dumpb)
+
+_backend = BACKENDS["orjson" if orjson is not None else "json"]
+
+
+def use_backend(name="auto"):
+    """
+    Selects encoder used for all payloads,
+    "auto" picks the fastest one available
+    """
+    global _backend
+    if name in (None, "", "auto"):
+        name = "orjson" if "orjson" in BACKENDS else "json"
+    if name not in BACKENDS:
+        log.warning("JSON backend {} is not available, using json".format(name))
+        name = "json"
+    _backend = BACKENDS[name]
+    return name
+
+
+def dumps(obj, **kwargs):
+    """ Returns compact JSON string, pass indent=4 for pretty output """
+    return _backend[0](obj, **kwargs)
+
+
+def dumpb(obj, **kwargs):
+    """ Returns compact UTF-8 encoded JSON bytes """
+    return _backend[1](obj, **kwargs)
+
+
+def dump(obj, fp, **kwargs):
+    fp.write(dumps(obj, **kwargs))
 
 
 load = json.load
 loads = json.loads
-dump = json.load
-dumps = functools.partial(json.dumps, indent=4, cls=ComplexEncoder)
+
+
+def encode_messages(messages):
+    """
+    Encodes list of messages to UTF-8 JSON bytes that can be sent directly
+    to websockets or merged into long polling responses
+    """
+    return dumpb(messages)
+
+
+def merge_encoded(payloads):
+    """
+    Merges encoded JSON lists into a single encoded JSON list without
+    decoding them again
+    """
+    items = [p[1:-1] for p in payloads if p != b"[]"]
+    return b"[" + b",".join(items) + b"]"
@@ -0,0 +1,81 @@
+"""
+Ring buffers of long polling connections - payloads get monotonically
+increasing sequence numbers and stay in the buffer between polls, so
+clients can fetch everything after the last sequence number they saw.
+"""
+import itertools
+from collections import deque
+
+from gevent.event import Event
+
+from channelstream.connection import EMPTY_PAYLOAD
+
+# how many payloads a long polling connection keeps between polls
+POLL_BUFFER_SIZE = 1000
+
+
+def configure(size=None):
+    global POLL_BUFFER_SIZE
+    if size is not None:
+        POLL_BUFFER_SIZE = max(int(size), 1)
+
+
+class PollBuffer(object):
+    """
+    Bounded buffer of (sequence number, payload) pairs, oldest payloads are
+    dropped when it is full
+    """
+
+    __slots__ = ("items", "seq", "delivered", "ready")
+
+    def __init__(self, size=None):
+        self.items = deque(maxlen=size or POLL_BUFFER_SIZE)
+        # sequence number of the last payload put into the buffer
+        self.seq = 0
+        # sequence number of the last payload returned to the client
+        self.delivered = 0
+        # set when there is something to return to waiting poll
+        self.ready = Event()
+
+    def __bool__(self):
+        return True
+
+    @property
+    def oldest(self):
+        """ Sequence number of the oldest payload still in the buffer """
+        return self.seq - len(self.items) + 1
+
+    def put(self, payload):
+        """
+        Buffers payload, empty payloads (heartbeats) only wake waiting polls
+        """
+        if payload != EMPTY_PAYLOAD:
+            self.seq += 1
+            self.items.append((self.seq, payload))
+        self.ready.set()
+
+    def since(self, cursor):
+        """
+        Returns payloads with sequence number greater than cursor and how
+        many of them were already dropped from the buffer
+        """
+        cursor = max(cursor, 0)
+        missed = self.seq - cursor
+        available = min(missed, len(self.items))
+        payloads = [p for s, p in itertools.islice(reversed(self.items), available)]
+        payloads.reverse()
+        return payloads, missed - available
+
+    def wait(self, cursor, timeout, drain_timeout=0.25):
+        """
+        Blocks until there are payloads after cursor or heartbeat wakes the
+        poll, then waits for more payloads while they keep coming
+        """
+        if self.seq <= cursor:
+            self.ready.clear()
+            if not self.ready.wait(timeout):
+                return
+        while True:
+            self.ready.clear()
+            if not self.ready.wait(drain_timeout):
+                return
@@ -0,0 +1,122 @@
+"""
+Fixed capacity buffers used for channel history and catchup frames of
+channels and users - append, lookup, edit and delete by message uuid are
+O(1) instead of rebuilding and scanning lists.
+"""
+import itertools
+from collections import OrderedDict
+
+# default capacities of catchup frame buffers
+CHANNEL_FRAMES_SIZE = 100
+USER_FRAMES_SIZE = 50
+
+
+def configure(channel_frames_size=None, user_frames_size=None):
+    global CHANNEL_FRAMES_SIZE, USER_FRAMES_SIZE
+    if channel_frames_size is not None:
+        CHANNEL_FRAMES_SIZE = max(int(channel_frames_size), 0)
+    if user_frames_size is not None:
+        USER_FRAMES_SIZE = max(int(user_frames_size), 0)
+
+
+class RingBuffer(object):
+    """
+    Entries in insertion order under unique increasing keys, oldest entries
+    are evicted when the buffer is full.
+
+    Entries are indexed by uuid returned by `uuid_of` callable, entries it
+    returns None for can not be looked up.
+    """
+
+    __slots__ = ("entries", "index", "capacity", "uuid_of", "_next_key")
+
+    def __init__(self, capacity, uuid_of=None):
+        self.entries = OrderedDict()
+        self.index = {}
+        self.capacity = capacity
+        self.uuid_of = uuid_of
+        self._next_key = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __getitem__(self, position):
+        if position < 0:
+            values = reversed(self.entries.values())
+            position = -position - 1
+        else:
+            values = iter(self.entries.values())
+        for value in itertools.islice(values, position, None):
+            return value
+        raise IndexError("RingBuffer index out of range")
+
+    def __repr__(self):
+        return "<RingBuffer: %s/%s>" % (len(self.entries), self.capacity)
+
+    def _uuid(self, entry):
+        return self.uuid_of(entry) if self.uuid_of else None
+
+    def trim(self):
+        """
+        Evicts oldest entries over capacity, returns key of the last one
+        """
+        evicted = None
+        while len(self.entries) > self.capacity:
+            evicted, entry = self.entries.popitem(last=False)
+            uuid = self._uuid(entry)
+            if uuid is not None and self.index.get(uuid) == evicted:
+                del self.index[uuid]
+        return evicted
+
+    def resize(self, capacity):
+        self.capacity = capacity
+        return self.trim()
+
+    def append(self, entry, key=None):
+        """
+        Adds entry under key (next integer by default), returns key of the
+        last entry evicted to make room for it or None
+        """
+        if key is None:
+            key = self._next_key
+        self._next_key = key + 1
+        self.entries[key] = entry
+        uuid = self._uuid(entry)
+        if uuid is not None:
+            self.index[uuid] = key
+        return self.trim()
+
+    def get(self, uuid):
+        key = self.index.get(uuid)
+        return self.entries[key] if key is not None else None
+
+    def replace(self, uuid, entry):
+        """ Replaces entry found by uuid keeping its position """
+        key = self.index.get(uuid)
+        if key is None:
+            return False
+        self.entries[key] = entry
+        return True
+
+    def remove(self, uuid):
+        key = self.index.pop(uuid, None)
+        if key is None:
+            return None
+        return self.entries.pop(key)
+
+    def since(self, key):
+        """ Returns entries with key greater than given one in order """
+        found = []
+        for entry_key, entry in reversed(self.entries.items()):
+            if entry_key <= key:
+                break
+            found.append(entry)
+        found.reverse()
+        return found
+
+    def clear(self):
+        self.entries.clear()
+        self.index.clear()
@@ -1,3 +1,5 @@
+import contextlib
+import time
 from datetime import datetime
 
 from gevent.lock import RLock
@@ -5,14 +7,125 @@ from gevent.lock import RLock
 STATS = {"started_on": datetime.utcnow()}
 lock = RLock()
 
+# number of independently locked partitions for users and channels
+LOCK_SHARDS = 64
+
+
+class TimedLock(object):
+    """ Reentrant lock that keeps track of time greenlets spent waiting """
+
+    def __init__(self):
+        self._lock = RLock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        self.acquisitions += 1
+        if self._lock.acquire(blocking=False):
+            return True
+        self.contended += 1
+        start_time = time.perf_counter()
+        self._lock.acquire()
+        self.wait_time += time.perf_counter() - start_time
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
 
 class State(object):
+    """
+    Holds users, channels and connections of a tenant.
+
+    Dictionaries are shared, but modifications are guarded by locks that are
+    partitioned by hash of username and channel name. Partitions must be
+    taken in order: user partitions, then channel partitions, each kind in
+    ascending partition order - use `locks()` which does that.
+
+    `lock` serializes garbage collection runs. It is only ever taken
+    outermost by GC, which then takes partitions through `locks()`, so it
+    must never be acquired while holding a partition and `locks()` does not
+    take it.
+    """
+
     def __init__(self):
         self.channels = {}
         self.connections = {}
         self.users = {}
         self.stats = {"total_messages": 0, "total_unique_messages": 0}
-        self.lock = RLock()
+        # maintained by users and connections so stats do not scan the state
+        self.active_user_count = 0
+        self.remote_connection_count = 0
+        # last counters published by other workers keyed by their node id
+        self.peer_stats = {}
+        # heap of (deadline, sequence, connection) entries checked by GC
+        self.expiring_connections = []
+        # heap of (deadline, sequence, user) entries checked by GC
+        self.expiring_users = []
+        # heartbeat scheduler buckets of connections keyed by time slot
+        self.heartbeat_buckets = {}
+        self.gc_stats = {
+            "conns": {
+                "runs": 0,
+                "last_pause_ms": 0.0,
+                "max_pause_ms": 0.0,
+                "total_collected": 0,
+            },
+            "users": {
+                "runs": 0,
+                "last_pause_ms": 0.0,
+                "max_pause_ms": 0.0,
+                "total_collected": 0,
+            },
+        }
+        self.lock = TimedLock()
+        self.user_locks = [TimedLock() for _ in range(LOCK_SHARDS)]
+        self.channel_locks = [TimedLock() for _ in range(LOCK_SHARDS)]
+
+    @contextlib.contextmanager
+    def locks(self, usernames=(), channels=()):
+        """
+        Acquires partitions guarding passed usernames and channel names
+        in a deadlock free order
+        """
+        user_shards = sorted({hash(name) % LOCK_SHARDS for name in usernames})
+        channel_shards = sorted({hash(name) % LOCK_SHARDS for name in channels})
+        to_acquire = [self.user_locks[i] for i in user_shards] + [
+            self.channel_locks[i] for i in channel_shards
+        ]
+        acquired = []
+        try:
+            for partition_lock in to_acquire:
+                partition_lock.acquire()
+                acquired.append(partition_lock)
+            yield
+        finally:
+            for partition_lock in reversed(acquired):
+                partition_lock.release()
+
+    def lock_stats(self):
+        """ Summary of lock usage and time spent waiting for locks """
+        all_locks = {
+            "state": [self.lock],
+            "users": self.user_locks,
+            "channels": self.channel_locks,
+        }
+        stats = {}
+        for kind, kind_locks in all_locks.items():
+            wait_time = sum(item.wait_time for item in kind_locks)
+            stats[kind] = {
+                "acquisitions": sum(item.acquisitions for item in kind_locks),
+                "contended": sum(item.contended for item in kind_locks),
+                "wait_time_ms": round(wait_time * 1000, 3),
+            }
+        return stats
 
 
 STATES = {"0": State()}
@@ -0,0 +1,233 @@
+"""
+Snapshots of server state for warm restarts - users with their state,
+connections, channels with configuration, history and frames, and message
+counters are written to a binary file periodically and on shutdown, and
+loaded at startup before the server accepts requests.
+
+Periodic snapshots are written by a forked child process, so the server
+keeps serving requests while the copy-on-write state gets serialized.
+"""
+import contextlib
+import gc as python_gc
+import logging
+import os
+import pickle
+import time
+
+import gevent
+
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.ringbuffer import RingBuffer
+from channelstream.server_state import get_state
+from channelstream.user import User
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"CHANNELSTREAM-SNAPSHOT-1\n"
+
+
+def dump_state(server_state):
+    """
+    Returns state as tuples of plain values, frames and configs, ring buffers
+    are stored as (key, entry) pairs so catchup offsets stay valid
+    """
+    users = [
+        (
+            user.username,
+            user.uuid,
+            user.state,
+            user.state_public_keys,
+            user.frames_size,
+            list(user.frames.entries.items()),
+        )
+        for user in server_state.users.values()
+    ]
+    channels = []
+    for channel in server_state.channels.values():
+        config = {key: getattr(channel, key) for key in channel.config_keys}
+        # persistent history backends keep history on their own
+        history = None
+        if isinstance(channel.history, RingBuffer):
+            history = list(channel.history.entries.items())
+        channels.append(
+            (
+                channel.name,
+                channel.uuid,
+                channel.long_name,
+                config,
+                channel.seq,
+                channel.trimmed_seq,
+                history,
+                list(channel.frames.entries.items()),
+            )
+        )
+    # connections replicated from other workers are kept too, clients can
+    # reconnect to any worker after restart
+    connections = [
+        (connection.id, connection.username, sorted(connection.channel_names))
+        for connection in server_state.connections.values()
+    ]
+    return {
+        "users": users,
+        "channels": channels,
+        "connections": connections,
+        "stats": {
+            "total_messages": server_state.stats["total_messages"],
+            "total_unique_messages": server_state.stats["total_unique_messages"],
+        },
+    }
+
+
+def restore_state(server_state, data):
+    """
+    Recreates users, channels and connections without sending presence
+    or state change notifications, restored objects count as active now
+    """
+    for username, user_uuid, state, public_keys, frames_size, frames in data["users"]:
+        user = User(username)
+        user.uuid = user_uuid
+        user.state = state
+        user.state_public_keys = public_keys
+        user.frames_size = frames_size
+        for key, entry in frames:
+            user.frames.append(entry, key=key)
+        server_state.users[username] = user
+    for entry in data["channels"]:
+        name, channel_uuid, long_name, config, seq, trimmed_seq, history, frames = entry
+        channel = Channel(name, long_name=long_name, channel_config=config)
+        channel.uuid = channel_uuid
+        for key, message in history or []:
+            channel.history.append(message, key=key)
+        for key, entry in frames:
+            channel.frames.append(entry, key=key)
+        channel.seq = max(seq, channel.seq)
+        channel.trimmed_seq = trimmed_seq
+        server_state.channels[name] = channel
+    for conn_id, username, channel_names in data["connections"]:
+        user = server_state.users.get(username)
+        if user is None:
+            continue
+        connection = Connection(username, conn_id)
+        server_state.connections[conn_id] = connection
+        user.add_connection(connection)
+        for name in channel_names:
+            channel = server_state.channels.get(name)
+            if channel is not None:
+                channel.connections.setdefault(username, []).append(connection)
+                connection.channel_names.add(name)
+    server_state.stats.update(data["stats"])
+
+
+def clear_state(server_state):
+    """ Drops everything a failed restore may have left behind """
+    server_state.users.clear()
+    server_state.channels.clear()
+    server_state.connections.clear()
+    server_state.active_user_count = 0
+    server_state.remote_connection_count = 0
+    server_state.stats["total_messages"] = 0
+    server_state.stats["total_unique_messages"] = 0
+
+
+@contextlib.contextmanager
+def collection_paused():
+    """
+    Cyclic garbage collection would walk all objects over and over while
+    millions of them are being created
+    """
+    enabled = python_gc.isenabled()
+    python_gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            python_gc.enable()
+
+
+def save(path):
+    """ Writes snapshot of state atomically, returns its size """
+    start_time = time.perf_counter()
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with collection_paused(), open(tmp_path, "wb") as snapshot_file:
+        data = dump_state(get_state())
+        snapshot_file.write(MAGIC)
+        pickle.dump(data, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+        size = snapshot_file.tell()
+    os.replace(tmp_path, path)
+    log.info(
+        "Snapshot of {} users written to {} in {:.2f}s".format(
+            len(data["users"]), path, time.perf_counter() - start_time
+        )
+    )
+    return size
+
+
+def load(path):
+    """
+    Restores state from snapshot if there is one, returns True on success,
+    corrupted or truncated snapshots are logged and the server starts cold.
+
+    Snapshots are unpickled, so `path` must point to a trusted file that
+    only channelstream itself writes.
+    """
+    if not path or not os.path.exists(path):
+        return False
+    start_time = time.perf_counter()
+    server_state = get_state()
+    with open(path, "rb") as snapshot_file:
+        if snapshot_file.read(len(MAGIC)) != MAGIC:
+            log.error("{} is not a channelstream snapshot".format(path))
+            return False
+        with collection_paused():
+            try:
+                data = pickle.load(snapshot_file)
+                restore_state(server_state, data)
+            except (
+                pickle.UnpicklingError,
+                EOFError,
+                ValueError,
+                KeyError,
+                TypeError,
+                AttributeError,
+                ImportError,
+            ) as exc:
+                log.error("Snapshot {} could not be loaded: {!r}".format(path, exc))
+                clear_state(server_state)
+                return False
+    log.info(
+        "Snapshot of {} users loaded from {} in {:.2f}s".format(
+            len(data["users"]), path, time.perf_counter() - start_time
+        )
+    )
+    return True
+
+
+def save_in_background(path):
+    """
+    Writes snapshot from a forked child process, the parent waits for it
+    without blocking other greenlets
+    """
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            save(path)
+        except Exception as exc:
+            log.error("Snapshot failed: {}".format(exc))
+            code = 1
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    return status == 0
+
+
+def snapshot_forever(path, interval):
+    while True:
+        gevent.sleep(interval)
+        try:
+            save_in_background(path)
+        except Exception as exc:
+            log.error(exc)
@@ -1,8 +1,10 @@
-import copy
 import logging
 import uuid
 from datetime import datetime
 
+from channelstream import gc, ringbuffer
+from channelstream.frame import MessageFrame
+from channelstream.ringbuffer import RingBuffer
 from channelstream.server_state import get_state
 from channelstream.utils import process_catchup
 from channelstream.validation import MSG_EDITABLE_KEYS
@@ -10,6 +12,11 @@ from channelstream.validation import MSG_EDITABLE_KEYS
 log = logging.getLogger(__name__)
 
 
+def frame_uuid(entry):
+    message = entry[1]
+    return message.get("uuid") if message["type"] == "message" else None
+
+
 class User(object):
     """ represents a unique user of the system """
 
@@ -17,13 +24,16 @@ class User(object):
         self.uuid = uuid.uuid4()
         self.username = username
         self.state = {}
-        self.state_public_keys = []
+        self._state_public_keys = []
         self.connections = []  # holds ids of connections
         # store frames for fetching when connection is established
         # those frames will store private messages
-        self.frames = []
+        self.frames = RingBuffer(ringbuffer.USER_FRAMES_SIZE, uuid_of=frame_uuid)
         self.last_active = None
+        # deadline of the current expiry check scheduled by GC
+        self.gc_deadline = None
         self.mark_activity()
+        gc.track_user(self)
 
     def mark_activity(self):
         self.last_active = datetime.utcnow()
@@ -31,9 +41,16 @@ class User(object):
     def __repr__(self):
         return "<User:%s, connections:%s>" % (self.username, len(self.connections))
 
+    @property
+    def frames_size(self):
+        return self.frames.capacity
+
+    @frames_size.setter
+    def frames_size(self, value):
+        self.frames.resize(value)
+
     def add_frame(self, frame):
         self.frames.append((datetime.utcnow(), frame))
-        self.frames = self.frames[-50:]
 
     def get_catchup_frames(self, newer_than):
         return [process_catchup(f[1]) for f in self.frames if f[0] > newer_than]
@@ -44,24 +61,35 @@ class User(object):
         """
         if connection not in self.connections:
             self.connections.append(connection)
+            if len(self.connections) == 1:
+                get_state().active_user_count += 1
         # mark active
         self.mark_activity()
         return connection
 
+    def remove_connection(self, connection):
+        if connection not in self.connections:
+            return False
+        self.connections.remove(connection)
+        if not self.connections:
+            get_state().active_user_count -= 1
+        return True
+
     def add_message(self, message):
         """
-        Send a message to all connections of this user
+        Send a message to all connections of this user,
+        message can be a dictionary or a MessageFrame
         """
-        # mark active
-        message = copy.deepcopy(message)
-        message.pop("no_history", None)
-        message.pop("pm_users", None)
-        message.pop("exclude_users", None)
+        if not isinstance(message, MessageFrame):
+            message = MessageFrame.from_dict(message)
         self.add_frame(message)
+        # mark active
         self.mark_activity()
-        for connection in self.connections:
-            connection.add_message(message)
-        return len(self.connections)
+        # connections served by other processes get it from them
+        local_connections = [conn for conn in self.connections if not conn.remote]
+        for connection in local_connections:
+            connection.send_encoded(message.encoded)
+        return len(local_connections)
 
     def state_from_dict(self, state_dict):
         changed = []
@@ -70,11 +98,30 @@ class User(object):
                 if self.state.get(k) != v:
                     self.state[k] = v
                     changed.append({"key": k, "value": v})
+        if changed:
+            self.bump_channel_versions()
         return changed
 
+    @property
+    def state_public_keys(self):
+        return self._state_public_keys
+
+    @state_public_keys.setter
+    def state_public_keys(self, value):
+        # reconnecting clients send the same keys on every connect
+        if value != self._state_public_keys:
+            self._state_public_keys = value
+            self.bump_channel_versions()
+
     @property
     def public_state(self):
-        return {k: v for k, v in self.state.items() if k in self.state_public_keys}
+        public_keys = self._state_public_keys
+        return {k: v for k, v in self.state.items() if k in public_keys}
+
+    def bump_channel_versions(self):
+        """ User state is part of info of channels user is present in """
+        for channel in self.get_channels():
+            channel.bump_version()
 
     def get_info(self, include_connections=False):
         info = {"state": self.public_state, "user": self.username, "uuid": self.uuid}
@@ -82,34 +129,41 @@ class User(object):
             info["connections"] = [c.id for c in self.connections]
         return info
 
+    @property
+    def channel_names(self):
+        """
+        Names of channels user is present in, built from subscription
+        indexes of user connections
+        """
+        names = set()
+        for connection in self.connections:
+            names.update(connection.channel_names)
+        return names
+
     def get_channels(self):
         server_state = get_state()
         channels = []
-        for channel in server_state.channels.values():
-            if channel.connections.get(self.username):
+        for name in sorted(self.channel_names):
+            channel = server_state.channels.get(name)
+            if channel is not None:
                 channels.append(channel)
         return channels
 
     def alter_message(self, to_edit):
         # normally tried to get channel and user from history
-        for f, msg in self.frames:
-            if msg["uuid"] == to_edit["uuid"] and msg["type"] == "message":
-                msg.update({k: v for k, v in to_edit.items() if k in MSG_EDITABLE_KEYS})
-                break
-        altered = copy.deepcopy(to_edit)
-        altered["type"] = "message:edit"
+        changes = {k: v for k, v in to_edit.items() if k in MSG_EDITABLE_KEYS}
+        entry = self.frames.get(to_edit["uuid"])
+        if entry is not None:
+            t, msg = entry
+            self.frames.replace(to_edit["uuid"], (t, msg.replace(**changes)))
+        altered = dict(to_edit, type="message:edit")
         self.add_message(altered)
 
     def delete_message(self, to_delete):
         # normally tried to get channel and user from history
-        for i, frame in enumerate(self.frames):
-            msg = frame[1]
-            if msg["uuid"] == to_delete["uuid"] and msg["type"] == "message":
-                self.frames.pop(i)
-                break
-
-        deleted = copy.deepcopy(to_delete)
-        deleted["type"] = "message:delete"
+        self.frames.remove(to_delete["uuid"])
+
+        deleted = dict(to_delete, type="message:delete")
         self.add_message(deleted)
 
     def __json__(self, request=None):
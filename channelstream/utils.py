@@ -1,6 +1,9 @@
+import calendar
 import copy
+import hmac
 import uuid
 
+import dateutil.parser
 import marshmallow
 from itsdangerous import (
     TimestampSigner,
@@ -57,13 +60,41 @@ def uuid_from_string(str_uuid):
         raise marshmallow.ValidationError("Wrong UUID format")
 
 
-def process_catchup(m):
-    copied = copy.deepcopy(m)
-    copied["catchup"] = True
-    copied.pop("pm_users", None)
-    copied.pop("exclude_users", None)
-    copied.pop("no_history", None)
-    return copied
+def parse_since(values):
+    """
+    Parses resume offsets passed by clients - either `seq` for all channels
+    or `channel:seq`, returns dictionary of channel names (None for all
+    channels) and sequence numbers
+    """
+    if isinstance(values, str):
+        values = [values]
+    since = {}
+    for value in values or []:
+        channel, _, seq = value.rpartition(":")
+        try:
+            since[channel or None] = int(seq)
+        except ValueError:
+            raise marshmallow.ValidationError("Wrong since format")
+    return since
+
+
+def restore_message(msg):
+    """
+    Converts JSON decoded message published by another node or read from
+    storage back to the types produced by message schemas
+    """
+    msg["uuid"] = uuid.UUID(msg["uuid"])
+    if isinstance(msg.get("timestamp"), str):
+        msg["timestamp"] = dateutil.parser.isoparse(msg["timestamp"])
+    return msg
+
+
+def process_catchup(frame):
+    """
+    Returns catchup version of the message frame, frames are immutable so
+    the copy is shared by all reconnecting clients
+    """
+    return frame.as_catchup()
 
 
 def set_config_types(config):
@@ -75,7 +106,22 @@ def set_config_types(config):
     config = copy.deepcopy(config)
     config["debug"] = asbool(config["debug"])
     config["port"] = int(config["port"])
+    config["workers"] = max(int(config["workers"]), 1)
+    config["heartbeat_interval"] = float(config["heartbeat_interval"])
+    config["heartbeat_jitter"] = float(config["heartbeat_jitter"])
+    config["heartbeat_ping"] = asbool(config["heartbeat_ping"])
+    config["outbox_size"] = int(config["outbox_size"])
+    config["ingest_workers"] = int(config["ingest_workers"])
+    config["ingest_batch_size"] = int(config["ingest_batch_size"])
+    config["flush_window"] = float(config["flush_window"])
+    config["flush_max_bytes"] = int(config["flush_max_bytes"])
+    config["poll_buffer_size"] = int(config["poll_buffer_size"])
+    config["channel_frames_size"] = int(config["channel_frames_size"])
+    config["user_frames_size"] = int(config["user_frames_size"])
+    config["history_hot_size"] = int(config["history_hot_size"])
+    config["snapshot_interval"] = float(config["snapshot_interval"])
     config["validate_requests"] = asbool(config["validate_requests"])
+    config["signature_cache_size"] = int(config["signature_cache_size"])
     config["enforce_https"] = asbool(config["enforce_https"])
     if not config["cookie_secret"]:
         config["cookie_secret"] = str(uuid.uuid4())
@@ -101,7 +147,26 @@ class DefaultSigner:
         self.signer = TimestampSigner(secret, **kwargs)
 
     def unsign(self, secret, **kwargs):
+        """
+        Returns unix time the token was signed at, so verified tokens can be
+        cached until they expire
+        """
         try:
-            self.signer.unsign(secret, **kwargs)
+            _, signed_on = self.signer.unsign(secret, return_timestamp=True, **kwargs)
         except (itsBadSignature, BadTimeSignature):
             raise BadSignature(f"Signature {secret} does not match")
+        return calendar.timegm(signed_on.utctimetuple())
+
+
+class StaticKeyChecker:
+    """
+    Accepts requests passing the server secret itself as a static bearer key,
+    keys never expire so `max_age` does not apply
+    """
+
+    def __init__(self, secret, **kwargs):
+        self.key = secret.encode("utf8")
+
+    def unsign(self, secret, **kwargs):
+        if not hmac.compare_digest(secret.encode("utf8"), self.key):
+            raise BadSignature("Key does not match")
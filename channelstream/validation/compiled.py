@@ -0,0 +1,299 @@
+"""
+Validators compiled from request schemas for hot API endpoints - building
+a schema for every request and running it field by field costs more than
+delivering the messages, so schemas are turned once into plain functions
+that check and convert the usual well formed payloads.
+
+Whenever compiled code is not sure about a value (wrong type, failed
+validator, unusual conversion) the whole payload is loaded by a fresh schema
+instead, so invalid payloads get exactly the same errors as before and
+everything the compiled code accepts loads to the same data.
+"""
+import uuid
+from typing import Dict, Tuple, Type
+
+import marshmallow
+from marshmallow import fields, validate
+from marshmallow.decorators import POST_LOAD, PRE_LOAD, VALIDATES, VALIDATES_SCHEMA
+
+from channelstream.validation import UserStateField
+
+_validators: Dict[Tuple[Type[marshmallow.Schema], bool], "CompiledValidator"] = {}
+
+
+class Fallback(Exception):
+    """ Payload has to be loaded by the schema """
+
+
+def compile_checks(validators):
+    """
+    Returns function running field validators or None if there are none,
+    length and range checks are inlined
+    """
+    lengths = []
+    ranges = []
+    others = []
+    for validator in validators:
+        if type(validator) is validate.Length and validator.equal is None:
+            lengths.append((validator.min, validator.max))
+        elif type(validator) is validate.Range:
+            ranges.append(validator)
+        else:
+            others.append(validator)
+    if not validators:
+        return None
+
+    def check(value):
+        for low, high in lengths:
+            size = len(value)
+            if (low is not None and size < low) or (high is not None and size > high):
+                raise Fallback()
+        for item in ranges:
+            if item.min is not None and (
+                value < item.min if item.min_inclusive else value <= item.min
+            ):
+                raise Fallback()
+            if item.max is not None and (
+                value > item.max if item.max_inclusive else value >= item.max
+            ):
+                raise Fallback()
+        for validator in others:
+            try:
+                result = validator(value)
+            except marshmallow.ValidationError:
+                raise Fallback()
+            if result is False:
+                raise Fallback()
+
+    return check
+
+
+def compile_value(field):
+    """ Returns function converting present, not None value of the field """
+    field_type = type(field)
+    if field_type is fields.String:
+
+        def convert(value):
+            if type(value) is not str:
+                raise Fallback()
+            return value
+
+    elif field_type is fields.Boolean:
+
+        def convert(value):
+            if value is not True and value is not False:
+                raise Fallback()
+            return value
+
+    elif field_type is fields.Integer:
+
+        def convert(value):
+            if type(value) is not int:
+                raise Fallback()
+            return value
+
+    elif field_type is fields.UUID:
+
+        def convert(value):
+            if isinstance(value, uuid.UUID):
+                return value
+            if type(value) is not str:
+                raise Fallback()
+            try:
+                return uuid.UUID(value)
+            except ValueError:
+                raise Fallback()
+
+    elif field_type is UserStateField:
+
+        def convert(value):
+            if not isinstance(value, (str, float, int)):
+                raise Fallback()
+            return value
+
+    elif field_type is fields.List:
+        inner = compile_field(field.inner)
+
+        def convert(value):
+            if type(value) is not list:
+                raise Fallback()
+            return [inner(item) for item in value]
+
+    elif field_type is fields.Dict:
+        keys = compile_field(field.key_field) if field.key_field else None
+        values = compile_field(field.value_field) if field.value_field else None
+
+        def convert(value):
+            if type(value) is not dict:
+                raise Fallback()
+            if keys is None and values is None:
+                return dict(value)
+            return {
+                (keys(k) if keys else k): (values(v) if values else v)
+                for k, v in value.items()
+            }
+
+    elif field_type is fields.Nested and not field.many:
+        nested = compile_schema(field.schema)
+        if nested is None:
+            return compile_generic(field)
+
+        def convert(value):
+            return nested(value, False, None)
+
+    else:
+        return compile_generic(field)
+
+    check = compile_checks(field.validators)
+    if check is None:
+        return convert
+
+    def convert_and_check(value):
+        value = convert(value)
+        check(value)
+        return value
+
+    return convert_and_check
+
+
+def compile_generic(field):
+    """ Fields without compiled conversion are deserialized by themselves """
+
+    def convert(value):
+        try:
+            return field.deserialize(value)
+        except marshmallow.ValidationError:
+            raise Fallback()
+
+    return convert
+
+
+def compile_field(field):
+    convert = compile_value(field)
+    allow_none = field.allow_none
+
+    def load(value):
+        if value is None:
+            if allow_none:
+                return None
+            raise Fallback()
+        return convert(value)
+
+    return load
+
+
+def compile_schema(schema):
+    """
+    Returns function loading single item of the schema or None if
+    the schema uses features compiled code does not support
+    """
+    hooks = schema._hooks
+    if (
+        hooks[VALIDATES]
+        or hooks[(VALIDATES_SCHEMA, True)]
+        or hooks[(VALIDATES_SCHEMA, False)]
+        or hooks[(PRE_LOAD, True)]
+        or hooks[(POST_LOAD, True)]
+        or schema.partial
+    ):
+        return None
+    pre_load = [getattr(schema, name) for name in hooks[(PRE_LOAD, False)]]
+    post_load = [getattr(schema, name) for name in hooks[(POST_LOAD, False)]]
+    for hook in pre_load + post_load:
+        for options in hook.__marshmallow_hook__.values():
+            if options.get("pass_original"):
+                return None
+    loaders = []
+    for name, field in schema.load_fields.items():
+        attribute = field.attribute or name
+        if "." in attribute:
+            return None
+        data_key = field.data_key if field.data_key is not None else name
+        loaders.append(
+            (attribute, data_key, compile_field(field), field.required, field.missing)
+        )
+    known_keys = {data_key for _, data_key, _, _, _ in loaders}
+    unknown = schema.unknown
+    dict_class = schema.dict_class
+    missing = marshmallow.missing
+
+    def load(data, many, context):
+        if type(data) is not dict:
+            raise Fallback()
+        if pre_load:
+            # hooks read context of the shared schema, there is no greenlet
+            # switch between setting it and running them
+            schema.context = context or {}
+            data = dict(data)
+            for hook in pre_load:
+                try:
+                    data = hook(data, many=many, partial=False)
+                except marshmallow.ValidationError:
+                    raise Fallback()
+        if unknown == marshmallow.RAISE:
+            for key in data:
+                if key not in known_keys:
+                    raise Fallback()
+        result = dict_class()
+        for attribute, data_key, loader, required, default in loaders:
+            value = data.get(data_key, missing)
+            if value is missing:
+                if required:
+                    raise Fallback()
+                if default is missing:
+                    continue
+                result[attribute] = default() if callable(default) else default
+            else:
+                result[attribute] = loader(value)
+        if unknown == marshmallow.INCLUDE:
+            for key, value in data.items():
+                if key not in known_keys:
+                    result[key] = value
+        if post_load:
+            schema.context = context or {}
+            for hook in post_load:
+                try:
+                    result = hook(result, many=many, partial=False)
+                except marshmallow.ValidationError:
+                    raise Fallback()
+        return result
+
+    return load
+
+
+class CompiledValidator(object):
+    """
+    Loads payloads like `schema_cls(context=context, many=many).load()`
+    """
+
+    def __init__(self, schema_cls, many=False):
+        self.schema_cls = schema_cls
+        self.many = many
+        self.schema = schema_cls()
+        self.load_item = compile_schema(self.schema)
+
+    def load(self, data, context=None):
+        if self.load_item is not None:
+            try:
+                if not self.many:
+                    return self.load_item(data, False, context)
+                if type(data) is not list:
+                    raise Fallback()
+                return [self.load_item(item, True, context) for item in data]
+            except Fallback:
+                pass
+        schema = self.schema_cls(context=context or {}, many=self.many)
+        return schema.load(data)
+
+
+def get_validator(schema_cls, many=False):
+    key = (schema_cls, many)
+    validator = _validators.get(key)
+    if validator is None:
+        validator = _validators[key] = CompiledValidator(schema_cls, many=many)
+    return validator
+
+
+def load(schema_cls, data, request=None, many=False):
+    """ Loads payload with cached compiled validator of the schema """
+    return get_validator(schema_cls, many=many).load(data, {"request": request})
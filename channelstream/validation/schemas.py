@@ -34,6 +34,20 @@ class ChannelConfigSchema(ChannelstreamSchema):
     store_frames = fields.Boolean(
         missing=True, description="Should store catchup frames"
     )
+    frames_size = fields.Integer(
+        missing=None,
+        allow_none=True,
+        validate=[validate.Range(min=0)],
+        description="How many catchup frames should be stored, "
+        "server default if empty",
+    )
+    flush_window = fields.Float(
+        missing=None,
+        allow_none=True,
+        validate=[validate.Range(min=0, max=10)],
+        description="Seconds websocket messages can wait to be sent in one "
+        "frame with others when connections are busy, server default if empty",
+    )
 
 
 class InfoResolutionSchema(ChannelstreamSchema):
@@ -97,6 +111,13 @@ class ConnectBodySchema(ChannelstreamSchema):
         description="Sets configuration for newly created channels "
         "in form of channelName:ChannelConfigBody",
     )
+    frames_size = fields.Integer(
+        missing=None,
+        allow_none=True,
+        validate=[validate.Range(min=0)],
+        description="How many private catchup frames should be stored "
+        "for the user, server default if empty",
+    )
     info = fields.Nested(
         InfoResolutionSchema(),
         missing=lambda: {},
@@ -133,6 +154,44 @@ class UnsubscribeBodySchema(SubscribeBodySchema):
     pass
 
 
+class BulkSubscribeItemSchema(SubscribeBodySchema):
+    @marshmallow.pre_load
+    def get_connection(self, in_data, many=False, partial=False):
+        # every item names its connection
+        return in_data
+
+
+class BulkConnectBodySchema(ChannelstreamSchema):
+    items = fields.List(
+        fields.Dict(),
+        required=True,
+        validate=validate.Length(min=1),
+        description="List of ConnectBody objects, every one is validated "
+        "and reported on separately",
+    )
+    info = fields.Nested(
+        InfoResolutionSchema(),
+        missing=None,
+        allow_none=True,
+        description="Channel information of all items is returned "
+        "only if this is present",
+    )
+
+
+class BulkSubscribeBodySchema(BulkConnectBodySchema):
+    items = fields.List(
+        fields.Dict(),
+        required=True,
+        validate=validate.Length(min=1),
+        description="List of SubscribeBody objects with conn_id, every one "
+        "is validated and reported on separately",
+    )
+
+
+class BulkUnsubscribeBodySchema(BulkSubscribeBodySchema):
+    pass
+
+
 class UserStateBodySchema(ChannelstreamSchema):
     user = fields.String(
         required=True, validate=[validate.Length(min=1, max=512), validate_username]
@@ -220,3 +279,23 @@ class MessagesDeleteBodySchema(PayloadDeliveryInfo, ChannelstreamSchema):
 
 class DisconnectBodySchema(ChannelstreamSchema):
     conn_id = fields.UUID(required=True)
+
+
+class ListingQuerySchema(ChannelstreamSchema):
+    offset = fields.Integer(missing=0, validate=validate.Range(min=0))
+    limit = fields.Integer(missing=100, validate=validate.Range(min=1, max=1000))
+    name = fields.String(
+        validate=validate.Length(min=1, max=512),
+        description="Lists only items with names containing this string",
+    )
+
+
+class UserListingQuerySchema(ListingQuerySchema):
+    connected = fields.Boolean(
+        description="Lists only users with (true) or without (false) connections"
+    )
+
+
+class ChannelListingQuerySchema(ListingQuerySchema):
+    include_history = fields.Boolean(missing=False)
+    include_users = fields.Boolean(missing=False)
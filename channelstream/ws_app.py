@@ -1,7 +1,9 @@
 from urllib.parse import parse_qs
+
+import marshmallow
 from ws4py.websocket import WebSocket
 
-from channelstream import utils
+from channelstream import backplane, operations, utils
 from channelstream.server_state import get_state
 
 
@@ -15,14 +17,23 @@ class ChatApplicationSocket(WebSocket):
         server_state = get_state()
         self.qs = parse_qs(self.environ["QUERY_STRING"])
         self.conn_id = utils.uuid_from_string(self.qs.get("conn_id")[0])
-        if self.conn_id not in server_state.connections:
+        connection = backplane.wait_for(
+            lambda: server_state.connections.get(self.conn_id)
+        )
+        if connection is None:
             # close connection instantly if user played with id
             self.close()
-        else:
-            # attach a socket to connection
-            connection = server_state.connections[self.conn_id]
-            connection.socket = self
-            connection.deliver_catchup_messages()
+            return
+        try:
+            since = utils.parse_since(self.qs.get("since"))
+        except marshmallow.ValidationError as exc:
+            # policy violation, connection stays as it was
+            self.close(code=1008, reason=str(exc.messages[0]))
+            return
+        # attach a socket to connection
+        connection.socket = self
+        operations.claim_connection(connection)
+        connection.deliver_catchup_messages(since)
 
     def received_message(self, m):
         server_state = get_state()
@@ -34,10 +45,17 @@ class ChatApplicationSocket(WebSocket):
             if user:
                 user.mark_activity()
 
+    def ponged(self, pong):
+        # clients answer server heartbeat pings
+        self.received_message(pong)
+
     def closed(self, code, reason=""):
         server_state = get_state()
         self.environ.pop("ws4py.app")
         found_conn = self.conn_id in server_state.connections
         if hasattr(self, "conn_id") and found_conn:
             connection = server_state.connections[self.conn_id]
-            connection.mark_for_gc()
+            # socket could be replaced after client reconnected elsewhere
+            if connection.socket is self:
+                # tear down right away instead of waiting for GC
+                operations.disconnect(self.conn_id)
@@ -8,7 +8,10 @@ from pyramid.config import Configurator
 from pyramid.renderers import JSON
 from pyramid.security import NO_PERMISSION_REQUIRED
 
+from channelstream import heartbeat, history, ingest, outbox, pollbuffer
+from channelstream import ringbuffer
 from channelstream import patched_json as json
+from channelstream.wsgi_views import wsgi_security
 from channelstream.wsgi_views.wsgi_security import APIFactory
 
 
@@ -28,6 +31,7 @@ def make_app(server_config):
     module_, class_ = server_config["signature_checker"].rsplit(".", maxsplit=1)
     signature_checker_cls = getattr(importlib.import_module(module_), class_)
     config.registry.signature_checker = signature_checker_cls(server_config["secret"])
+    wsgi_security.configure(cache_size=server_config["signature_cache_size"])
     authn_policy = AuthTktAuthenticationPolicy(
         server_config["cookie_secret"], max_age=2592000
     )
@@ -36,10 +40,38 @@ def make_app(server_config):
     config.set_authentication_policy(authn_policy)
     config.set_authorization_policy(authz_policy)
 
-    json_renderer = JSON(serializer=json.dumps, indent=4)
+    json.use_backend(server_config["json_backend"])
+    outbox.configure(
+        size=server_config["outbox_size"],
+        policy=server_config["outbox_policy"],
+        flush_window=server_config["flush_window"],
+        flush_max_bytes=server_config["flush_max_bytes"],
+    )
+    ingest.configure(
+        workers=server_config["ingest_workers"],
+        batch_size=server_config["ingest_batch_size"],
+    )
+    pollbuffer.configure(size=server_config["poll_buffer_size"])
+    history.use_backend(history.load_backend(server_config))
+    ringbuffer.configure(
+        channel_frames_size=server_config["channel_frames_size"],
+        user_frames_size=server_config["user_frames_size"],
+    )
+    heartbeat.configure(
+        interval=server_config["heartbeat_interval"],
+        jitter=server_config["heartbeat_jitter"],
+        ping=server_config["heartbeat_ping"],
+    )
+    # compact output for API responses
+    json_renderer = JSON(serializer=json.dumps)
     json_renderer.add_adapter(datetime.datetime, datetime_adapter)
     json_renderer.add_adapter(uuid.UUID, uuid_adapter)
     config.add_renderer("json", json_renderer)
+    # human readable output for admin/debug views
+    pretty_json_renderer = JSON(serializer=json.dumps, indent=4)
+    pretty_json_renderer.add_adapter(datetime.datetime, datetime_adapter)
+    pretty_json_renderer.add_adapter(uuid.UUID, uuid_adapter)
+    config.add_renderer("json_pretty", pretty_json_renderer)
 
     config.add_subscriber(
         "channelstream.subscribers.handle_new_request", "pyramid.events.NewRequest"
@@ -36,6 +36,16 @@ def includeme(config):
         "/admin/admin.json",
         factory="channelstream.wsgi_views.wsgi_security:AdminAuthFactory",
     )
+    config.add_route(
+        "admin_users",
+        "/admin/users.json",
+        factory="channelstream.wsgi_views.wsgi_security:AdminAuthFactory",
+    )
+    config.add_route(
+        "admin_channels",
+        "/admin/channels.json",
+        factory="channelstream.wsgi_views.wsgi_security:AdminAuthFactory",
+    )
     config.add_route(
         "admin_action",
         "/admin/{action}",
@@ -45,6 +55,9 @@ def includeme(config):
     config.add_route("connect", "/connect")
     config.add_route("subscribe", "/subscribe")
     config.add_route("unsubscribe", "/unsubscribe")
+    config.add_route("bulk_connect", "/bulk/connect")
+    config.add_route("bulk_subscribe", "/bulk/subscribe")
+    config.add_route("bulk_unsubscribe", "/bulk/unsubscribe")
     config.add_route("user_state", "/user_state")
     config.add_route("message", "/message")
     config.add_route("channel_config", "/channel_config")
@@ -1,22 +1,48 @@
+import itertools
 import logging
+import uuid
 from datetime import datetime
 
 import gevent
 import gevent.util
+import marshmallow
 from apispec import APISpec
 from apispec.ext.marshmallow import MarshmallowPlugin
-from gevent.queue import Queue, Empty
 from pyramid.httpexceptions import HTTPUnauthorized, HTTPFound
 from pyramid.security import remember, forget, NO_PERMISSION_REQUIRED
 from pyramid.view import view_config, view_defaults
 from pyramid_apispec.helpers import add_pyramid_paths
 
-from channelstream import operations, utils, patched_json as json, __version__
+from channelstream import backplane, ingest, operations, outbox, utils
+from channelstream import __version__
+from channelstream import patched_json as json
+from channelstream.pollbuffer import PollBuffer
 from channelstream.server_state import get_state, STATS
-from channelstream.validation import schemas
+from channelstream.validation import compiled, schemas
 
 log = logging.getLogger(__name__)
 
+# channels included in admin.json, all of them are listed by channels.json
+ADMIN_CHANNELS = 100
+
+
+def paginate(values, offset, limit, matches=None):
+    """
+    Returns page of values in iteration order and number of all matching
+    values, values are scanned to the end only when they are filtered
+    """
+    if matches is None:
+        page = list(itertools.islice(values, offset, offset + limit))
+        return page, len(values)
+    page = []
+    total = 0
+    for value in values:
+        if matches(value):
+            if offset <= total < offset + limit:
+                page.append(value)
+            total += 1
+    return page, total
+
 
 class SharedUtils(object):
     def __init__(self, request):
@@ -49,7 +75,7 @@ class SharedUtils(object):
 
         json_data = {"channels": {}, "users": []}
 
-        users_to_list = set()
+        listed_users = set()
 
         # select everything for empty list
         if req_channels is None:
@@ -65,22 +91,18 @@ class SharedUtils(object):
             if channel_inst.name in exclude_channels:
                 continue
 
+            # info snapshots are cached by channels until they change
             channel_info = channel_inst.get_info(
                 include_history=include_history, include_users=include_users
             )
             json_data["channels"][channel_inst.name] = channel_info
-            users_to_list.update(channel_info["users"])
-
-        for username in users_to_list:
-            user = server_state.users[username]
-            json_data["users"].append(
-                {
-                    "user": username,
-                    "state": user.state
-                    if not return_public_state
-                    else user.public_state,
-                }
-            )
+            if not include_users:
+                continue
+            for user_info in channel_inst.get_users_info(return_public_state):
+                if user_info["user"] not in listed_users:
+                    listed_users.add(user_info["user"])
+                    json_data["users"].append(user_info)
+
         log.info("info time: %s" % (datetime.utcnow() - start_time))
         return json_data
 
@@ -140,8 +162,7 @@ def connect(request):
             $ref: '#/definitions/ConnectBody'
     """
     shared_utils = SharedUtils(request)
-    schema = schemas.ConnectBodySchema(context={"request": request})
-    json_body = schema.load(request.json_body)
+    json_body = compiled.load(schemas.ConnectBodySchema, request.json_body, request)
     channels = sorted(json_body["channels"])
     connection, user = operations.connect(
         username=json_body["username"],
@@ -151,6 +172,7 @@ def connect(request):
         conn_id=json_body["conn_id"],
         channels=channels,
         channel_configs=json_body["channel_configs"],
+        frames_size=json_body["frames_size"],
     )
 
     # get info config for channel information
@@ -198,8 +220,8 @@ def subscribe(request):
     """
     server_state = get_state()
     shared_utils = SharedUtils(request)
-    schema = schemas.SubscribeBodySchema(context={"request": request})
-    json_body = schema.load(request.json_body)
+    wait_for_replication(conn_ids=body_conn_ids(request))
+    json_body = compiled.load(schemas.SubscribeBodySchema, request.json_body, request)
     connection = server_state.connections.get(json_body["conn_id"])
     channels = json_body["channels"]
     channel_configs = json_body.get("channel_configs", {})
@@ -249,8 +271,8 @@ def unsubscribe(request):
     """
     server_state = get_state()
     shared_utils = SharedUtils(request)
-    schema = schemas.UnsubscribeBodySchema(context={"request": request})
-    json_body = schema.load(request.json_body)
+    wait_for_replication(conn_ids=body_conn_ids(request))
+    json_body = compiled.load(schemas.UnsubscribeBodySchema, request.json_body, request)
     connection = server_state.connections.get(json_body["conn_id"])
     unsubscribed_from = operations.unsubscribe(
         connection=connection, unsubscribe_channels=json_body["channels"]
@@ -266,6 +288,240 @@ def unsubscribe(request):
     }
 
 
+def wait_for_replication(conn_ids=(), usernames=()):
+    """
+    Connections and users created by other processes are replicated
+    asynchronously - gives them one moment to arrive for the whole request,
+    validators only check the state as it is
+    """
+    server_state = get_state()
+    known_ids = []
+    for conn_id in conn_ids:
+        try:
+            known_ids.append(uuid.UUID(str(conn_id)))
+        except ValueError:
+            continue
+    usernames = [username for username in usernames if isinstance(username, str)]
+    backplane.wait_for(
+        lambda: all(conn_id in server_state.connections for conn_id in known_ids)
+        and all(username in server_state.users for username in usernames)
+    )
+
+
+def body_conn_ids(request):
+    """ Connection ids raw body of a (bulk) subscription request refers to """
+    body = request.json_body
+    if not isinstance(body, dict):
+        return []
+    items = body.get("items")
+    if isinstance(items, list):
+        return [item.get("conn_id") for item in items if isinstance(item, dict)]
+    return [body.get("conn_id", request.GET.get("conn_id"))]
+
+
+def validate_items(request, validator, items):
+    """
+    Validates items of bulk requests one by one, returns valid items
+    with their positions and list of results with errors filled in
+    """
+    results = [None] * len(items)
+    valid = []
+    for position, item in enumerate(items):
+        try:
+            valid.append((position, validator.load(item, {"request": request})))
+        except marshmallow.ValidationError as exc:
+            results[position] = {"error": exc.messages}
+    return valid, results
+
+
+@view_config(route_name="bulk_connect", request_method="POST", renderer="json")
+def bulk_connect(request):
+    """
+    Bulk connect view
+    ---
+    post:
+      security:
+        - APIKeyHeader: []
+      tags:
+      - "API"
+      summary: "connects many users to the server in one request"
+      description: "Results are returned for every item in the same order,
+        invalid items get an error and do not stop the others"
+      operationId: "bulk_connect"
+      consumes:
+      - "application/json"
+      produces:
+      - "application/json"
+      parameters:
+      - in: "body"
+        name: "body"
+        description: "Request JSON body"
+        required: true
+        schema:
+          $ref: "#/definitions/BulkConnectBody"
+      responses:
+        422:
+          description: "Unprocessable Entity"
+        200:
+          description: "Success"
+    """
+    shared_utils = SharedUtils(request)
+    json_body = compiled.load(schemas.BulkConnectBodySchema, request.json_body, request)
+    validator = compiled.get_validator(schemas.ConnectBodySchema)
+    valid, results = validate_items(request, validator, json_body["items"])
+    items = [
+        {
+            "username": data["username"],
+            "fresh_user_state": data["fresh_user_state"],
+            "state_public_keys": data["state_public_keys"],
+            "update_user_state": data["user_state"],
+            "conn_id": data["conn_id"],
+            "channels": sorted(data["channels"]),
+            "channel_configs": data["channel_configs"],
+            "frames_size": data["frames_size"],
+        }
+        for _, data in valid
+    ]
+    connected = operations.bulk_connect(items) if items else []
+    all_channels = set()
+    for (position, _), item, (connection, user) in zip(valid, items, connected):
+        all_channels.update(item["channels"])
+        results[position] = {
+            "conn_id": connection.id,
+            "state": user.state,
+            "username": user.username,
+            "public_state": user.public_state,
+            "channels": item["channels"],
+        }
+    response = {"results": results}
+    if json_body["info"] is not None:
+        response["channels_info"] = shared_utils.get_common_info(
+            sorted(all_channels), json_body["info"]
+        )
+    return response
+
+
+def bulk_subscription(request, schema_cls, operation, result_key):
+    server_state = get_state()
+    shared_utils = SharedUtils(request)
+    wait_for_replication(conn_ids=body_conn_ids(request))
+    json_body = compiled.load(schema_cls, request.json_body, request)
+    validator = compiled.get_validator(schemas.BulkSubscribeItemSchema)
+    valid, results = validate_items(request, validator, json_body["items"])
+    items = []
+    for position, data in valid:
+        connection = server_state.connections.get(data["conn_id"])
+        if connection is None:
+            # collected after validation
+            results[position] = {"error": {"conn_id": ["Unknown connection"]}}
+            continue
+        items.append(
+            {
+                "position": position,
+                "connection": connection,
+                "channels": data["channels"],
+                "channel_configs": data["channel_configs"],
+            }
+        )
+    changed = operation(items) if items else []
+    all_channels = set()
+    for item, channels in zip(items, changed):
+        if channels is None:
+            results[item["position"]] = {"error": {"conn_id": ["Unknown connection"]}}
+            continue
+        current_channels = item["connection"].channels
+        all_channels.update(current_channels)
+        results[item["position"]] = {
+            "conn_id": item["connection"].id,
+            "channels": current_channels,
+            result_key: sorted(channels),
+        }
+    response = {"results": results}
+    if json_body["info"] is not None:
+        response["channels_info"] = shared_utils.get_common_info(
+            sorted(all_channels), json_body["info"]
+        )
+    return response
+
+
+@view_config(route_name="bulk_subscribe", request_method="POST", renderer="json")
+def bulk_subscribe(request):
+    """
+    Bulk subscribe view
+    ---
+    post:
+      security:
+        - APIKeyHeader: []
+      tags:
+      - "API"
+      summary: "Subscribes many connections to new channels in one request"
+      description: "Results are returned for every item in the same order,
+        invalid items get an error and do not stop the others"
+      operationId: "bulk_subscribe"
+      consumes:
+      - "application/json"
+      produces:
+      - "application/json"
+      parameters:
+      - in: "body"
+        name: "body"
+        description: "Request JSON body"
+        required: true
+        schema:
+          $ref: "#/definitions/BulkSubscribeBody"
+      responses:
+        422:
+          description: "Unprocessable Entity"
+        200:
+          description: "Success"
+    """
+    return bulk_subscription(
+        request,
+        schemas.BulkSubscribeBodySchema,
+        operations.bulk_subscribe,
+        "subscribed_to",
+    )
+
+
+@view_config(route_name="bulk_unsubscribe", request_method="POST", renderer="json")
+def bulk_unsubscribe(request):
+    """
+    Bulk unsubscribe view
+    ---
+    post:
+      security:
+        - APIKeyHeader: []
+      tags:
+      - "API"
+      summary: "Removes many connections from channels in one request"
+      description: "Results are returned for every item in the same order,
+        invalid items get an error and do not stop the others"
+      operationId: "bulk_unsubscribe"
+      consumes:
+      - "application/json"
+      produces:
+      - "application/json"
+      parameters:
+      - in: "body"
+        name: "body"
+        description: "Request JSON body"
+        required: true
+        schema:
+          $ref: "#/definitions/BulkUnsubscribeBody"
+      responses:
+        422:
+          description: "Unprocessable Entity"
+        200:
+          description: "Success"
+    """
+    return bulk_subscription(
+        request,
+        schemas.BulkUnsubscribeBodySchema,
+        operations.bulk_unsubscribe,
+        "unsubscribed_from",
+    )
+
+
 @view_config(
     route_name="api_listen",
     request_method="GET",
@@ -284,6 +540,21 @@ def listen(request):
       operationId: "listen"
       produces:
       - "application/json"
+      parameters:
+      - in: "query"
+        name: "cursor"
+        type: "integer"
+        description: "Sequence number of the last payload client got, returns
+          everything after it as {cursor, missed, messages} object. Cursors
+          are known only to the worker that issued them, a cursor that lands
+          on another worker or node gets `reset: true` in the response"
+      - in: "query"
+        name: "since"
+        type: "string"
+        description: "Resumes channel streams after sequence number - `seq`
+          for all channels or `channel:seq`, can be repeated. Used when
+          the poll buffer is created, clients that are not routed to the
+          same worker every time should send it with every poll"
       responses:
         200:
           description: "Success"
@@ -291,41 +562,56 @@ def listen(request):
     server_state = get_state()
     config = request.registry.settings
     conn_id = utils.uuid_from_string(request.params.get("conn_id"))
-    connection = server_state.connections.get(conn_id)
+    connection = backplane.wait_for(lambda: server_state.connections.get(conn_id))
     if not connection:
         raise HTTPUnauthorized()
-    # attach a queue to connection
-    connection.queue = Queue()
-    connection.deliver_catchup_messages()
-    request.response.app_iter = yield_response(request, connection, config)
+    try:
+        cursor = int(request.params["cursor"])
+    except (KeyError, ValueError):
+        cursor = None
+    # the buffer is kept between polls so nothing published in between
+    # gets lost, catchup messages are only needed for a new one - buffers
+    # live in the worker that served the poll, a cursor issued by other
+    # worker or node can only be replaced by channel catchup after `since`
+    attach = not isinstance(connection.queue, PollBuffer)
+    if attach:
+        connection.queue = PollBuffer()
+    operations.claim_connection(connection)
+    if attach:
+        since = utils.parse_since(request.params.getall("since"))
+        connection.deliver_catchup_messages(since)
+    reset = attach and bool(cursor)
+    request.response.app_iter = yield_response(
+        request, connection, cursor, config, reset=reset
+    )
     return request.response
 
 
-def yield_response(request, connection, config):
-    messages = await_data(connection, config)
+def yield_response(request, connection, cursor, config, reset=False):
+    buffer = connection.queue
+    legacy = cursor is None
+    if legacy:
+        cursor = buffer.delivered
+    elif reset or cursor > buffer.seq:
+        # cursor of a previous buffer
+        reset = True
+        cursor = 0
+    buffer.wait(cursor, config["wake_connections_after"])
+    payloads, missed = buffer.since(cursor)
+    buffer.delivered = buffer.seq
     connection.mark_activity()
     cb = request.params.get("callback")
+    resp = json.merge_encoded(payloads)
+    if not legacy:
+        resp = b'{"cursor":%d,"missed":%d,"messages":%s%s}' % (
+            buffer.seq,
+            missed,
+            resp,
+            b',"reset":true' if reset else b"",
+        )
     if cb:
-        resp = cb + "(" + json.dumps(messages) + ")"
-    else:
-        resp = json.dumps(messages)
-    yield resp.encode("utf8")
-
-
-def await_data(connection, config):
-    messages = []
-    # block for first message - wake up after a while
-    try:
-        messages.extend(connection.queue.get(timeout=config["wake_connections_after"]))
-    except Empty:
-        pass
-    # get more messages if enqueued takes up total 0.25
-    while True:
-        try:
-            messages.extend(connection.queue.get(timeout=0.25))
-        except Empty:
-            break
-    return messages
+        resp = cb.encode("utf8") + b"(" + resp + b")"
+    yield resp
 
 
 @view_config(route_name="user_state", request_method="POST", renderer="json")
@@ -359,6 +645,8 @@ def user_state(request):
           description: "Success"
     """
     server_state = get_state()
+    if isinstance(request.json_body, dict):
+        wait_for_replication(usernames=[request.json_body.get("user")])
     schema = schemas.UserStateBodySchema(context={"request": request})
     data = schema.load(request.json_body)
     user_inst = server_state.users[data["user"]]
@@ -377,11 +665,11 @@ def user_state(request):
 
 def shared_messages(request):
     server_state = get_state()
-    schema = schemas.MessageBodySchema(context={"request": request}, many=True)
-    data = schema.load(request.json_body)
+    data = compiled.load(
+        schemas.MessageBodySchema, request.json_body, request, many=True
+    )
     data = [m for m in data if m.get("channel") or m.get("pm_users")]
-    for msg in data:
-        gevent.spawn(operations.pass_message, msg, server_state.stats)
+    ingest.submit(data, server_state.stats)
     return list(data)
 
 
@@ -696,7 +984,10 @@ class ServerViews(object):
         Serve admin page html
         :return:
         """
-        return {}
+        return {
+            "total_channels": len(get_state().channels),
+            "listed_channels": ADMIN_CHANNELS,
+        }
 
     @view_config(
         route_name="admin_action", match_param=("action=debug",), renderer="string"
@@ -737,7 +1028,7 @@ class ServerViews(object):
         return HTTPFound(url, headers=headers)
 
     @view_config(
-        route_name="admin_json", renderer="json", request_method=("POST", "GET")
+        route_name="admin_json", renderer="json_pretty", request_method=("POST", "GET")
     )
     def admin_json(self):
         """
@@ -787,35 +1078,151 @@ class ServerViews(object):
         server_state = get_state()
         uptime = datetime.utcnow() - STATS["started_on"]
         uptime = str(uptime).split(".")[0]
-        remembered_user_count = len([user for user in server_state.users.items()])
-        active_users = [
-            user for user in server_state.users.values() if user.connections
-        ]
-        unique_user_count = len(active_users)
-        total_connections = sum([len(user.connections) for user in active_users])
-        channels_info = self.utils.get_common_info(
-            None,
-            {
-                "include_history": True,
-                "include_users": True,
-                "exclude_channels": [],
-                "include_connections": True,
-            },
-        )
+        # counters are maintained by users and connections, users and all
+        # channels are listed page by page by users.json and channels.json
+        channels = itertools.islice(server_state.channels.values(), ADMIN_CHANNELS)
+        # state is replicated between nodes, delivery counters are not
+        cluster_stats = operations.cluster_stats()
         return {
-            "remembered_user_count": remembered_user_count,
-            "unique_user_count": unique_user_count,
-            "total_connections": total_connections,
-            "total_channels": len(server_state.channels.keys()),
-            "total_messages": server_state.stats["total_messages"],
+            "remembered_user_count": len(server_state.users),
+            "unique_user_count": server_state.active_user_count,
+            "total_connections": len(server_state.connections),
+            "total_channels": len(server_state.channels),
+            "listed_channels": min(len(server_state.channels), ADMIN_CHANNELS),
+            "total_messages": cluster_stats["total_messages"],
             "total_unique_messages": server_state.stats["total_unique_messages"],
-            "channels": channels_info["channels"],
-            "users": [user.get_info(include_connections=True) for user in active_users],
+            "channels": {
+                channel.name: channel.get_info(include_users=True)
+                for channel in channels
+            },
             "uptime": uptime,
             "version": str(__version__),
+            "gc": server_state.gc_stats,
+            "locks": server_state.lock_stats(),
+            "nodes": cluster_stats["nodes"],
+            "ingest": ingest.get_stats(),
+            "slow_connections": [
+                box.connection.get_info()
+                for box in outbox.backlogged()
+                if server_state.connections.get(box.connection.id) is box.connection
+            ],
         }
 
-    @view_config(route_name="openapi_spec", renderer="json")
+    @view_config(route_name="admin_users", renderer="json_pretty")
+    def admin_users(self):
+        """
+        Users listing
+        ---
+        get:
+          tags:
+          - "Admin API"
+          summary: "Return page of users with their connections"
+          description: ""
+          operationId: "admin_users"
+          produces:
+          - "application/json"
+          parameters:
+          - in: "query"
+            name: "offset"
+            type: "integer"
+          - in: "query"
+            name: "limit"
+            type: "integer"
+          - in: "query"
+            name: "name"
+            type: "string"
+          - in: "query"
+            name: "connected"
+            type: "boolean"
+          responses:
+            422:
+              description: "Unprocessable Entity"
+            200:
+              description: "Success"
+        """
+        server_state = get_state()
+        params = schemas.UserListingQuerySchema().load(dict(self.request.GET))
+        name = params.get("name")
+        connected = params.get("connected")
+        matches = None
+        if name is not None or connected is not None:
+
+            def matches(user):
+                if name is not None and name not in user.username:
+                    return False
+                return connected is None or bool(user.connections) == connected
+
+        users, total = paginate(
+            server_state.users.values(), params["offset"], params["limit"], matches
+        )
+        return {
+            "offset": params["offset"],
+            "limit": params["limit"],
+            "total": total,
+            "users": [user.get_info(include_connections=True) for user in users],
+        }
+
+    @view_config(route_name="admin_channels", renderer="json_pretty")
+    def admin_channels(self):
+        """
+        Channels listing
+        ---
+        get:
+          tags:
+          - "Admin API"
+          summary: "Return page of channels"
+          description: ""
+          operationId: "admin_channels"
+          produces:
+          - "application/json"
+          parameters:
+          - in: "query"
+            name: "offset"
+            type: "integer"
+          - in: "query"
+            name: "limit"
+            type: "integer"
+          - in: "query"
+            name: "name"
+            type: "string"
+          - in: "query"
+            name: "include_history"
+            type: "boolean"
+          - in: "query"
+            name: "include_users"
+            type: "boolean"
+          responses:
+            422:
+              description: "Unprocessable Entity"
+            200:
+              description: "Success"
+        """
+        server_state = get_state()
+        params = schemas.ChannelListingQuerySchema().load(dict(self.request.GET))
+        name = params.get("name")
+        matches = None
+        if name is not None:
+
+            def matches(channel):
+                return name in channel.name
+
+        channels, total = paginate(
+            server_state.channels.values(), params["offset"], params["limit"], matches
+        )
+        return {
+            "offset": params["offset"],
+            "limit": params["limit"],
+            "total": total,
+            "channels": [
+                channel.get_info(
+                    include_history=params["include_history"],
+                    include_users=params["include_users"],
+                )
+                for channel in channels
+            ],
+        }
+
+    @view_config(route_name="openapi_spec", renderer="json_pretty")
     def api_spec(self):
         """
         OpenApi 2.0 spec
@@ -846,6 +1253,13 @@ class ServerViews(object):
         spec.components.schema("SubscribeBody", schema=schemas.SubscribeBodySchema)
         spec.components.schema("UnsubscribeBody", schema=schemas.UnsubscribeBodySchema)
         spec.components.schema("UserStateBody", schema=schemas.UserStateBodySchema)
+        spec.components.schema("BulkConnectBody", schema=schemas.BulkConnectBodySchema)
+        spec.components.schema(
+            "BulkSubscribeBody", schema=schemas.BulkSubscribeBodySchema
+        )
+        spec.components.schema(
+            "BulkUnsubscribeBody", schema=schemas.BulkUnsubscribeBodySchema
+        )
         spec.components.schema(
             "MessagesBody", schema=schemas.MessageBodySchema(many=True)
         )
@@ -864,6 +1278,9 @@ class ServerViews(object):
         add_pyramid_paths(spec, "connect", request=self.request)
         add_pyramid_paths(spec, "subscribe", request=self.request)
         add_pyramid_paths(spec, "unsubscribe", request=self.request)
+        add_pyramid_paths(spec, "bulk_connect", request=self.request)
+        add_pyramid_paths(spec, "bulk_subscribe", request=self.request)
+        add_pyramid_paths(spec, "bulk_unsubscribe", request=self.request)
         add_pyramid_paths(spec, "user_state", request=self.request)
         add_pyramid_paths(spec, "message", request=self.request)
         add_pyramid_paths(spec, "channel_config", request=self.request)
@@ -874,6 +1291,8 @@ class ServerViews(object):
         add_pyramid_paths(spec, "api_disconnect", request=self.request)
 
         add_pyramid_paths(spec, "admin_json", request=self.request)
+        add_pyramid_paths(spec, "admin_users", request=self.request)
+        add_pyramid_paths(spec, "admin_channels", request=self.request)
         spec_dict = spec.to_dict()
         spec_dict["securityDefinitions"] = {
             "APIKeyHeader": {
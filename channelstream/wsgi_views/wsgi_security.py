@@ -1,9 +1,52 @@
 import logging
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
 
 from pyramid.security import Allow, Everyone, ALL_PERMISSIONS
 
 log = logging.getLogger(__name__)
 
+# verified tokens remembered, 0 disables the cache
+SIGNATURE_CACHE_SIZE = 10000
+
+# (signature checker, token) -> unix time the token was signed at or None
+_verified: "OrderedDict[Tuple[Any, str], Optional[int]]" = OrderedDict()
+
+
+def configure(cache_size=None):
+    global SIGNATURE_CACHE_SIZE
+    if cache_size is not None:
+        SIGNATURE_CACHE_SIZE = max(int(cache_size), 0)
+    _verified.clear()
+
+
+def verify_signature(signature_checker, token, max_age=None):
+    """
+    Checks the token with signature checker unless it was verified before
+    and is still younger than `max_age`, raises BadSignature for bad tokens.
+
+    Tokens are cached only if the checker tells when they were signed or
+    when their age is not checked at all.
+    """
+    key = (signature_checker, token)
+    if key in _verified:
+        signed_on = _verified[key]
+        if max_age is None:
+            _verified.move_to_end(key)
+            return
+        if signed_on is not None and 0 <= int(time.time()) - signed_on <= max_age:
+            _verified.move_to_end(key)
+            return
+        # expired tokens get the error of the checker
+        del _verified[key]
+    signed_on = signature_checker.unsign(token, max_age=max_age)
+    if not SIGNATURE_CACHE_SIZE or (signed_on is None and max_age is not None):
+        return
+    _verified[key] = signed_on
+    while len(_verified) > SIGNATURE_CACHE_SIZE:
+        _verified.popitem(last=False)
+
 
 class RequestBasicChallenge(Exception):
     pass
@@ -29,7 +72,9 @@ class APIFactory:
 
         if req_secret:
             max_age = 60 if config["validate_requests"] else None
-            request.registry.signature_checker.unsign(req_secret, max_age=max_age)
+            verify_signature(
+                request.registry.signature_checker, req_secret, max_age=max_age
+            )
         else:
             return
         self.__acl__ = [(Allow, Everyone, ALL_PERMISSIONS)]
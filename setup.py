@@ -52,6 +52,7 @@ setup(
     extras_require={
         "dev": ["coverage", "pytest", "pyramid", "tox", "mock", "webtest", "mypy"],
         "lint": ["black"],
+        "speedups": ["orjson"],
     },
     entry_points={
         "console_scripts": [
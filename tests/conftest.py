@@ -31,6 +31,12 @@ def cleanup_globals():
     server_state.channels = {}
     server_state.connections = {}
     server_state.users = {}
+    server_state.expiring_connections = []
+    server_state.expiring_users = []
+    server_state.heartbeat_buckets = {}
+    server_state.active_user_count = 0
+    server_state.remote_connection_count = 0
+    server_state.peer_stats = {}
     server_state.stats = {
         "total_messages": 0,
         "total_unique_messages": 0,
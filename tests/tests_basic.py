@@ -2,14 +2,34 @@ from gevent import monkey
 
 monkey.patch_all()
 
+import copy
+import json as stdlib_json
+import pickle
+import random
+import uuid
+import gevent
+import marshmallow
 import pytest
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date, time, timezone
+from decimal import Decimal
 from gevent.queue import Queue
-from channelstream.server_state import get_state
+from channelstream import patched_json as json
+from channelstream.server_state import State, get_state
+import channelstream.server_state
 import channelstream.gc
+import channelstream.outbox
+from channelstream import backplane, bus, heartbeat, history, ingest
+from channelstream import operations, snapshot
+from channelstream import utils
+from channelstream.backplane import LoopbackBackplane, SocketBackplane
 from channelstream.channel import Channel
 from channelstream.connection import Connection
+from channelstream.frame import MessageFrame
+from channelstream.outbox import Outbox, PING
+from channelstream.ringbuffer import RingBuffer
 from channelstream.user import User
+from channelstream.validation import compiled, schemas
+from channelstream.ws_app import ChatApplicationSocket
 
 
 @pytest.mark.usefixtures("cleanup_globals", "test_uuids")
@@ -24,7 +44,7 @@ class TestChannel(object):
         assert channel.salvageable is False
         assert channel.store_history is False
         assert channel.history_size == 10
-        assert channel.history == []
+        assert list(channel.history) == []
 
     def test_repr(self):
         channel = Channel("test", long_name="long name")
@@ -192,7 +212,7 @@ class TestChannel(object):
         )
 
         assert len(channel.history) == 3
-        assert channel.history == [
+        assert list(channel.history) == [
             {
                 "channel": "test",
                 "message": "test2",
@@ -200,6 +220,7 @@ class TestChannel(object):
                 "no_history": False,
                 "pm_users": [],
                 "exclude_users": [],
+                "seq": 2,
             },
             {
                 "channel": "test",
@@ -208,6 +229,7 @@ class TestChannel(object):
                 "no_history": False,
                 "pm_users": [],
                 "exclude_users": [],
+                "seq": 3,
             },
             {
                 "channel": "test",
@@ -216,9 +238,87 @@ class TestChannel(object):
                 "no_history": False,
                 "pm_users": [],
                 "exclude_users": [],
+                "seq": 5,
             },
         ]
 
+    def test_add_message_encodes_once(self, test_uuids):
+        channel = Channel("test")
+        connections = []
+        for conn_id in test_uuids[:3]:
+            connection = Connection("test_user", conn_id=conn_id)
+            connection.queue = Queue()
+            channel.add_connection(connection)
+            connections.append(connection)
+        sent = channel.add_message(
+            {
+                "channel": "test",
+                "message": "test1",
+                "type": "message",
+                "no_history": False,
+                "pm_users": [],
+                "exclude_users": [],
+            }
+        )
+        assert sent == 3
+        payloads = [c.queue.get() for c in connections]
+        assert payloads[0] is payloads[1] is payloads[2]
+        assert json.loads(payloads[0]) == [
+            {"channel": "test", "message": "test1", "type": "message", "seq": 1}
+        ]
+
+    def test_frames_since(self):
+        channel = Channel("test")
+        for i in range(5):
+            pm_users = ["other"] if i == 3 else []
+            channel.add_message(
+                {"type": "message", "message": i, "uuid": uuid.uuid4()},
+                pm_users=pm_users,
+            )
+        frames, lost = channel.get_frames_since(2, "test")
+        assert [f["seq"] for f in frames] == [3, 5]
+        assert all(f["catchup"] for f in frames)
+        assert lost is False
+        frames, lost = channel.get_frames_since(5, "test")
+        assert frames == []
+        assert lost is False
+
+    def test_frames_size(self):
+        channel = Channel("test", channel_config={"frames_size": 3})
+        messages = [{"type": "message", "uuid": uuid.uuid4()} for i in range(5)]
+        for message in messages:
+            channel.add_message(message)
+        assert [f["seq"] for t, f in channel.frames] == [3, 4, 5]
+        assert channel.trimmed_seq == 2
+        channel.reconfigure_from_dict({"frames_size": 1})
+        assert [f["seq"] for t, f in channel.frames] == [5]
+        assert channel.trimmed_seq == 4
+        assert channel.get_info()["settings"]["frames_size"] == 1
+
+    def test_frames_since_out_of_retention(self):
+        channel = Channel("test")
+        for i in range(105):
+            channel.add_message({"type": "message", "message": i, "uuid": uuid.uuid4()})
+        frames, lost = channel.get_frames_since(5, "test")
+        assert [f["seq"] for f in frames] == list(range(6, 106))
+        assert lost is False
+        frames, lost = channel.get_frames_since(4, "test")
+        assert len(frames) == 100
+        assert lost is True
+        gap = channel.get_gap_message(4)
+        assert gap["type"] == "stream:gap"
+        assert gap["message"] == {"since": 4, "retained_from": 6, "seq": 105}
+
+    def test_merge_encoded(self):
+        payloads = [
+            json.encode_messages([{"a": 1}]),
+            json.encode_messages([]),
+            json.encode_messages([{"b": 2}, {"c": 3}]),
+        ]
+        merged = json.merge_encoded(payloads)
+        assert json.loads(merged) == [{"a": 1}, {"b": 2}, {"c": 3}]
+        assert json.loads(json.merge_encoded([])) == []
+
     def test_user_state(self, test_uuids):
         user = User("test_user")
         changed = user.state_from_dict({"key": "1", "key2": "2"})
@@ -261,6 +361,83 @@ class TestChannel(object):
         channel.add_connection(connection2)
         channel2.add_connection(connection3)
         assert ["test", "test2"] == sorted([c.name for c in user.get_channels()])
+        channel2.remove_connection(connection3)
+        assert user.channel_names == {"test"}
+        assert [channel] == user.get_channels()
+
+    def test_info_snapshots_are_cached(self, test_uuids):
+        server_state = get_state()
+        user = server_state.users["test"] = User("test")
+        connection = Connection("test", conn_id=test_uuids[1])
+        user.add_connection(connection)
+        channel = server_state.channels["test"] = Channel("test")
+        channel.add_connection(connection)
+        info = channel.get_info(include_users=True)
+        assert channel.get_info(include_users=True) is info
+        assert channel.get_info(include_history=False) is not info
+        users_info = channel.get_users_info()
+        assert channel.get_users_info() is users_info
+        assert users_info == [{"user": "test", "state": {}}]
+
+    def test_info_snapshots_outlive_messages_without_history(self, test_uuids):
+        channel = Channel("test")
+        info = channel.get_info(include_users=True)
+        version = channel.version
+        channel.add_message({"uuid": test_uuids[1], "type": "message", "user": "a"})
+        assert channel.version == version
+        # activity and sequence number are refreshed without rebuilding
+        refreshed = channel.get_info(include_users=True)
+        assert refreshed["seq"] == 1
+        assert refreshed["last_active"] == channel.last_active
+        assert refreshed["users"] is info["users"]
+        assert info["seq"] == 0
+        assert channel.get_info(include_users=True) is refreshed
+
+    def test_info_snapshots_follow_changes(self, test_uuids):
+        server_state = get_state()
+        user = server_state.users["test"] = User("test")
+        server_state.users["test2"] = User("test2")
+        connection = Connection("test", conn_id=test_uuids[1])
+        user.add_connection(connection)
+        channel = server_state.channels["test"] = Channel(
+            "test", channel_config={"store_history": True}
+        )
+
+        def changed(change):
+            version = channel.version
+            info = channel.get_info(include_users=True)
+            users_info = channel.get_users_info(public_state=True)
+            change()
+            assert channel.version > version
+            assert channel.get_info(include_users=True) is not info
+            assert channel.get_users_info(public_state=True) is not users_info
+
+        changed(lambda: channel.add_connection(connection))
+        assert channel.get_info(include_users=True)["users"] == ["test"]
+        changed(lambda: channel.add_connection(Connection("test2", test_uuids[2])))
+        assert channel.get_info(include_users=True)["total_connections"] == 2
+        changed(lambda: channel.reconfigure_from_dict({"history_size": 3}))
+        assert channel.get_info()["settings"]["history_size"] == 3
+        msg = {"uuid": test_uuids[3], "type": "message", "user": "test"}
+        changed(lambda: channel.add_message(msg))
+        assert len(channel.get_info()["history"]) == 1
+        edit = {
+            "uuid": test_uuids[3],
+            "message": {"text": "x"},
+            "edited": None,
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        changed(lambda: channel.alter_message(edit))
+        changed(lambda: user.state_from_dict({"key": "value"}))
+        changed(lambda: setattr(user, "state_public_keys", ["key"]))
+        version = channel.version
+        user.state_public_keys = ["key"]
+        assert channel.version == version
+        users_info = channel.get_users_info(public_state=True)
+        assert users_info[0] == {"user": "test", "state": {"key": "value"}}
+        changed(lambda: channel.remove_connection(connection))
+        assert channel.get_info(include_users=True)["users"] == ["test2"]
 
 
 @pytest.mark.usefixtures("cleanup_globals")
@@ -284,13 +461,366 @@ class TestConnection(object):
         connection = Connection("test", test_uuids[1])
         connection.queue = Queue()
         connection.add_message({"message": "test"})
-        assert connection.queue.get() == [{"message": "test"}]
+        assert json.loads(connection.queue.get()) == [{"message": "test"}]
+
+    def test_channels_index(self, test_uuids):
+        server_state = get_state()
+        user = User("test")
+        server_state.users[user.username] = user
+        connection = Connection("test", test_uuids[1])
+        server_state.connections[connection.id] = connection
+        user.add_connection(connection)
+        for name in ["b", "a", "c"]:
+            channel = Channel(name)
+            server_state.channels[name] = channel
+            channel.add_connection(connection)
+        assert connection.channels == ["a", "b", "c"]
+        server_state.channels["b"].remove_connection(connection)
+        assert connection.channels == ["a", "c"]
+        connection.mark_for_gc()
+        channelstream.gc.gc_conns()
+        assert connection.channels == []
+
+    def test_catchup_since(self, test_uuids):
+        server_state = get_state()
+        user = User("test")
+        server_state.users[user.username] = user
+        connection = Connection("test", test_uuids[1])
+        for name in ["a", "b"]:
+            channel = Channel(name, channel_config={"store_frames": name == "a"})
+            server_state.channels[name] = channel
+            channel.add_connection(connection)
+            for i in range(3):
+                channel.add_message(
+                    {"type": "message", "channel": name, "uuid": uuid.uuid4()}
+                )
+        messages = connection.get_catchup_messages({"a": 1, None: 2})
+        assert [(m["channel"], m["seq"]) for m in messages[:2]] == [
+            ("a", 2),
+            ("a", 3),
+        ]
+        assert messages[2]["type"] == "stream:gap"
+        assert messages[2]["message"] == {"since": 2, "retained_from": 4, "seq": 3}
+        assert len(messages) == 3
+
+    def test_parse_since(self):
+        assert utils.parse_since(None) == {}
+        assert utils.parse_since("5") == {None: 5}
+        assert utils.parse_since(["a:b:1", "c:2"]) == {"a:b": 1, "c": 2}
+        with pytest.raises(marshmallow.ValidationError):
+            utils.parse_since(["a:x"])
 
     def test_heartbeat(self, test_uuids):
         connection = Connection("test", test_uuids[1])
         connection.queue = Queue()
         connection.heartbeat()
-        assert connection.queue.get() == []
+        assert json.loads(connection.queue.get()) == []
+
+    def test_heartbeat_ping(self, test_uuids):
+        server_state = get_state()
+        server_state.users["test"] = User("test")
+        connection = Connection("test", test_uuids[1])
+        connection.socket = PingSocket()
+        assert connection.heartbeat(ping=True) is True
+        gevent.sleep(0)
+        assert connection.heartbeat(ping=False) is True
+        gevent.sleep(0)
+        assert connection.socket.pings == 1
+        assert connection.socket.sent == [b"[]"]
+        connection.socket.terminated = True
+        assert not connection.heartbeat(ping=True)
+
+
+class PingSocket(object):
+    def __init__(self):
+        self.terminated = False
+        self.pings = 0
+        self.sent = []
+
+    def ping(self, message):
+        self.pings += 1
+
+    def send(self, payload):
+        self.sent.append(payload)
+
+    def close(self):
+        self.terminated = True
+
+
+class SlowSocket(PingSocket):
+    def send(self, payload):
+        gevent.sleep(0.5)
+        self.sent.append(payload)
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestOutbox(object):
+    def make_connection(self, socket, conn_id):
+        server_state = get_state()
+        server_state.users.setdefault("test", User("test"))
+        connection = Connection("test", conn_id)
+        connection.socket = socket
+        return connection
+
+    @pytest.mark.parametrize(
+        "policy, expected",
+        [
+            ("drop_oldest", [b"[2,3,4]"]),
+            ("conflate", [b"[0,3,4]"]),
+        ],
+    )
+    def test_overflow_policy(self, test_uuids, policy, expected):
+        connection = self.make_connection(PingSocket(), test_uuids[1])
+        connection.outbox = Outbox(connection, size=3, policy=policy)
+        for i, key in enumerate(["a", "b", "b", "b", "b"]):
+            connection.send_encoded("[{}]".format(i).encode("utf8"), key=key)
+        assert connection.get_info()["outbox_depth"] == 3
+        assert connection.get_info()["outbox_dropped"] == 2
+        gevent.sleep(0)
+        assert connection.socket.sent == expected
+        assert connection.get_info()["outbox_depth"] == 0
+
+    def test_backlogged_outboxes(self, test_uuids):
+        fast = self.make_connection(PingSocket(), test_uuids[1])
+        fast.outbox = Outbox(fast, size=3)
+        dropping = self.make_connection(PingSocket(), test_uuids[2])
+        dropping.outbox = Outbox(dropping, size=1, policy="drop_oldest")
+        fast.send_encoded(b"[1]")
+        for i in range(2):
+            dropping.send_encoded("[{}]".format(i).encode("utf8"))
+        backlogged = channelstream.outbox.backlogged()
+        assert fast.outbox in backlogged
+        assert dropping.outbox in backlogged
+        gevent.sleep(0)
+        # connections that dropped payloads stay listed
+        backlogged = channelstream.outbox.backlogged()
+        assert fast.outbox not in backlogged
+        assert dropping.outbox in backlogged
+
+    def test_disconnect_policy(self, test_uuids):
+        connection = self.make_connection(PingSocket(), test_uuids[1])
+        connection.outbox = Outbox(connection, size=2, policy="disconnect")
+        for i in range(3):
+            connection.send_encoded(b"[]")
+        assert connection.socket.terminated
+        assert connection.outbox.dropped == 1
+        assert connection.gc_deadline <= datetime.utcnow()
+
+    def test_slow_consumer_does_not_block_channel(self, test_uuids):
+        channel = Channel("test")
+        slow = self.make_connection(SlowSocket(), test_uuids[1])
+        fast = self.make_connection(PingSocket(), test_uuids[2])
+        channel.add_connection(slow)
+        channel.add_connection(fast)
+        for i in range(3):
+            channel.add_message({"type": "message", "uuid": uuid.uuid4(), "no": i})
+        gevent.sleep(0.05)
+        assert len(json.loads(fast.socket.sent[0])) == 3
+        assert len(slow.socket.sent) == 0
+
+    def test_idle_connection_does_not_wait(self, test_uuids):
+        connection = self.make_connection(PingSocket(), test_uuids[1])
+        connection.send_encoded(b"[1]", window=1)
+        gevent.sleep(0)
+        assert connection.socket.sent == [b"[1]"]
+
+    def test_busy_connection_waits_for_window(self, test_uuids):
+        connection = self.make_connection(PingSocket(), test_uuids[1])
+        connection.send_encoded(b"[1]", window=0.05)
+        gevent.sleep(0)
+        connection.send_encoded(b"[2]", window=0.05)
+        connection.send_encoded(b"[3]", window=0.05)
+        gevent.sleep(0.01)
+        assert connection.socket.sent == [b"[1]"]
+        gevent.sleep(0.06)
+        assert connection.socket.sent == [b"[1]", b"[2,3]"]
+        assert connection.get_info()["outbox_coalesced"] == 1
+
+    def test_frames_are_size_bounded(self, test_uuids, monkeypatch):
+        monkeypatch.setattr(channelstream.outbox, "FLUSH_MAX_BYTES", 8)
+        connection = self.make_connection(PingSocket(), test_uuids[1])
+        for payload in [b"[1]", b"[2]", b"[33]", b"[4]"]:
+            connection.send_encoded(payload)
+        connection.outbox.put(PING)
+        connection.send_encoded(b"[5]")
+        gevent.sleep(0)
+        assert connection.socket.sent == [b"[1,2]", b"[33,4]", b"[5]"]
+        assert connection.socket.pings == 1
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestFanout(object):
+    def make_channel(self, test_uuids, count):
+        server_state = get_state()
+        channel = Channel("test")
+        for i in range(count):
+            username = "user{}".format(i)
+            server_state.users[username] = User(username)
+            connection = Connection(username, test_uuids[i])
+            connection.queue = Queue()
+            channel.add_connection(connection)
+        return channel
+
+    def received(self, connection):
+        payloads = []
+        while not connection.queue.empty():
+            payloads.extend(json.loads(connection.queue.get()))
+        return [m["message"]["no"] for m in payloads]
+
+    def test_messages_are_delivered_in_order(self, test_uuids):
+        channel = self.make_channel(test_uuids, 3)
+        for i in range(3):
+            sent = channel.add_message(
+                {"type": "message", "uuid": uuid.uuid4(), "message": {"no": i}}
+            )
+            assert sent == 3
+        for conns in channel.connections.values():
+            assert self.received(conns[0]) == [0, 1, 2]
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestIngest(object):
+    def make_channel(self, name, usernames):
+        server_state = get_state()
+        channel = Channel(name)
+        server_state.channels[name] = channel
+        for username in usernames:
+            server_state.users.setdefault(username, User(username))
+            connection = Connection(username, uuid.uuid4())
+            connection.queue = Queue()
+            channel.add_connection(connection)
+        return channel
+
+    def make_message(self, channel, no, pm_users=None):
+        return {
+            "uuid": uuid.uuid4(),
+            "timestamp": datetime.utcnow(),
+            "user": "system",
+            "channel": channel,
+            "message": {"no": no},
+            "no_history": False,
+            "pm_users": pm_users or [],
+            "exclude_users": [],
+        }
+
+    def payloads(self, connection):
+        payloads = []
+        while not connection.queue.empty():
+            payloads.append(
+                [m["message"]["no"] for m in json.loads(connection.queue.get())]
+            )
+        return payloads
+
+    def test_channel_messages_are_passed_in_order(self, monkeypatch):
+        monkeypatch.setattr(ingest, "INGEST_BATCH_SIZE", 3)
+        server_state = get_state()
+        a = self.make_channel("a", ["user1"])
+        b = self.make_channel("b", ["user2"])
+        messages = [self.make_message(name, i) for i in range(5) for name in "ab"]
+        ingest.submit(messages, server_state.stats)
+        stats = ingest.get_stats()
+        assert stats["depth"] == 10
+        assert stats["lag_ms"] >= 0
+        gevent.sleep(0.01)
+        assert ingest.get_stats()["depth"] == 0
+        for channel in [a, b]:
+            connection = list(channel.connections.values())[0][0]
+            # consecutive messages of a channel are sent in one payload
+            assert self.payloads(connection) == [[0, 1, 2], [3, 4]]
+            assert channel.seq == 5
+        assert server_state.stats["total_unique_messages"] == 10
+        assert server_state.stats["total_messages"] == 10
+
+    def test_runs_with_different_recipients(self):
+        server_state = get_state()
+        channel = self.make_channel("a", ["user1", "user2"])
+        messages = [
+            self.make_message("a", 0),
+            self.make_message("a", 1),
+            self.make_message("a", 2, pm_users=["user2"]),
+            self.make_message("a", 3),
+        ]
+        operations.pass_messages(messages, server_state.stats)
+        first = channel.connections["user1"][0]
+        second = channel.connections["user2"][0]
+        assert self.payloads(first) == [[0, 1], [3]]
+        assert self.payloads(second) == [[0, 1], [2], [3]]
+        assert server_state.stats["total_messages"] == 7
+        assert [f[1]["seq"] for f in channel.frames] == [1, 2, 3, 4]
+
+    def test_direct_messages(self):
+        server_state = get_state()
+        user = User("user1")
+        server_state.users["user1"] = user
+        connection = Connection("user1", uuid.uuid4())
+        connection.queue = Queue()
+        user.add_connection(connection)
+        messages = [self.make_message(None, i, pm_users=["user1"]) for i in range(3)]
+        ingest.submit(messages, server_state.stats)
+        gevent.sleep(0.01)
+        assert self.payloads(connection) == [[0], [1], [2]]
+
+    def test_failed_batch_is_counted(self, monkeypatch):
+        server_state = get_state()
+        channel = self.make_channel("a", ["user1"])
+
+        def fail(*args, **kwargs):
+            raise ValueError("broken")
+
+        failed = ingest.get_stats()["failed"]
+        monkeypatch.setattr(channel, "add_messages", fail)
+        ingest.submit([self.make_message("a", i) for i in range(2)], server_state.stats)
+        gevent.sleep(0.01)
+        assert ingest.get_stats()["failed"] == failed + 2
+        # workers keep serving other messages
+        monkeypatch.undo()
+        ingest.submit([self.make_message("a", 2)], server_state.stats)
+        gevent.sleep(0.01)
+        connection = channel.connections["user1"][0]
+        assert self.payloads(connection) == [[2]]
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestHeartbeat(object):
+    def test_track_connection_once(self, test_uuids):
+        server_state = get_state()
+        connection = Connection("test", test_uuids[1])
+        heartbeat.track_connection(connection, now=100)
+        heartbeat.track_connection(connection, now=100)
+        scheduled = [c for b in server_state.heartbeat_buckets.values() for c in b]
+        assert scheduled == [connection]
+        when = connection.heartbeat_bucket * heartbeat.BUCKET_SIZE
+        interval = heartbeat.HEARTBEAT_INTERVAL
+        jitter = interval * heartbeat.HEARTBEAT_JITTER
+        assert 100 + interval - jitter - heartbeat.BUCKET_SIZE <= when
+        assert when <= 100 + interval + jitter
+
+    def test_beat_due_buckets(self, test_uuids):
+        server_state = get_state()
+        server_state.users["test"] = User("test")
+        pinged = Connection("test", test_uuids[1])
+        pinged.socket = PingSocket()
+        polling = Connection("test", test_uuids[2])
+        polling.queue = Queue()
+        detached = Connection("test", test_uuids[3])
+        for connection in (pinged, polling, detached):
+            heartbeat.track_connection(connection, now=100)
+        assert heartbeat.beat(now=101) == 0
+        assert heartbeat.beat(now=200) == 2
+        gevent.sleep(0)
+        assert pinged.socket.pings == 1
+        assert json.loads(polling.queue.get_nowait()) == []
+        # detached connection is dropped, others are rescheduled
+        assert detached.heartbeat_bucket is None
+        scheduled = [c for b in server_state.heartbeat_buckets.values() for c in b]
+        assert sorted(scheduled, key=id) == sorted([pinged, polling], key=id)
+        assert min(server_state.heartbeat_buckets) > 200 / heartbeat.BUCKET_SIZE
+
+    def test_claim_schedules_heartbeat(self, test_uuids):
+        connection = Connection("test", test_uuids[1])
+        assert connection.heartbeat_bucket is None
+        operations.claim_connection(connection)
+        assert connection.heartbeat_bucket is not None
 
 
 class TestUser(object):
@@ -319,8 +849,433 @@ class TestUser(object):
             }
         )
         assert len(user.connections) == 2
-        assert len(user.connections[0].queue.get()) == 1
-        assert len(user.connections[1].queue.get()) == 1
+        payload = user.connections[0].queue.get()
+        assert len(json.loads(payload)) == 1
+        # same encoded payload is shared between connections
+        assert user.connections[1].queue.get() is payload
+
+    def test_frames_size(self):
+        user = User("test_user")
+        assert user.frames_size == 50
+        messages = [{"type": "message", "uuid": uuid.uuid4()} for i in range(5)]
+        for message in messages:
+            user.add_message(message)
+        user.frames_size = 3
+        assert [f["uuid"] for t, f in user.frames] == [m["uuid"] for m in messages[2:]]
+        user.alter_message({"uuid": messages[4]["uuid"], "message": "edited"})
+        assert user.frames[1][1]["message"] == "edited"
+        user.delete_message({"uuid": messages[4]["uuid"]})
+        # edit and delete notifications are stored as frames too
+        assert [f["type"] for t, f in user.frames] == [
+            "message",
+            "message:edit",
+            "message:delete",
+        ]
+
+
+@pytest.fixture
+def sqlite_history():
+    backend = history.use_backend(history.SQLiteHistory("", hot_size=2))
+    yield backend
+    history.use_backend(history.MemoryHistory())
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestSQLiteHistory(object):
+    def make_channel(self):
+        return Channel(
+            "test", channel_config={"store_history": True, "history_size": 3}
+        )
+
+    def add_messages(self, channel, count):
+        messages = []
+        for i in range(count):
+            message = {
+                "type": "message",
+                "uuid": uuid.uuid4(),
+                "timestamp": datetime.utcnow(),
+                "message": {"no": i},
+                "pm_users": ["a"],
+            }
+            channel.add_message(message)
+            messages.append(message)
+        return messages
+
+    def test_keeps_history_on_disk(self, sqlite_history):
+        channel = self.make_channel()
+        messages = self.add_messages(channel, 5)
+        assert len(channel.history) == 3
+        assert len(channel.history.hot) == 2
+        stored = list(channel.history)
+        assert [m["uuid"] for m in stored] == [m["uuid"] for m in messages[2:]]
+        assert stored[0]["timestamp"] == messages[2]["timestamp"]
+        assert stored[0]["pm_users"] == ["a"]
+        assert stored[0]["seq"] == 3
+        # oldest message is read from the database
+        assert channel.history.get(messages[2]["uuid"])["message"] == {"no": 2}
+        assert channel.history.get(messages[0]["uuid"]) is None
+        # positions past the hot tail are read one row at a time
+        uuids = [m["uuid"] for m in messages[2:]]
+        assert [channel.history[i]["uuid"] for i in range(3)] == uuids
+        assert [channel.history[i]["uuid"] for i in (-3, -2, -1)] == uuids
+        for position in (3, -4):
+            with pytest.raises(IndexError):
+                channel.history[position]
+
+    def test_trim_reads_within_capacity(self, sqlite_history):
+        channel = self.make_channel()
+        messages = self.add_messages(channel, 3)
+        channel.history.capacity = 2
+        # rows past capacity are not read even before trim removes them
+        assert [m["uuid"] for m in channel.history] == [m["uuid"] for m in messages[1:]]
+        channel.history.trim()
+        assert len(channel.history) == 2
+        (stored,) = sqlite_history.db.execute("SELECT COUNT(*) FROM history").fetchone()
+        assert stored == 2
+
+    def test_edit_and_delete(self, sqlite_history):
+        channel = self.make_channel()
+        messages = self.add_messages(channel, 3)
+        for message in messages[:2]:
+            edit = {
+                "uuid": message["uuid"],
+                "message": {"edited": True},
+                "pm_users": [],
+                "exclude_users": [],
+            }
+            channel.alter_message(edit)
+        assert [m["message"] for m in channel.history] == [
+            {"edited": True},
+            {"edited": True},
+            {"no": 2},
+        ]
+        channel.delete_message(
+            {"uuid": messages[0]["uuid"], "pm_users": [], "exclude_users": []}
+        )
+        assert len(channel.history) == 2
+        assert [m["uuid"] for m in channel.history] == [m["uuid"] for m in messages[1:]]
+
+    def test_recreated_channel_continues(self, sqlite_history):
+        channel = self.make_channel()
+        messages = self.add_messages(channel, 4)
+        channel = self.make_channel()
+        assert [m["uuid"] for m in channel.history] == [m["uuid"] for m in messages[1:]]
+        assert channel.seq == 4
+        channel.add_message({"type": "message", "uuid": uuid.uuid4()})
+        assert channel.history[-1]["seq"] == 5
+
+    def test_workers_sharing_database(self, tmpdir):
+        # both workers store the same replicated messages
+        path = "sqlite://{}".format(tmpdir.join("history.db"))
+        backends = [history.SQLiteHistory(path, hot_size=2) for _ in range(2)]
+        histories = [backend.open("test", 3) for backend in backends]
+        messages = [
+            {"type": "message", "uuid": uuid.uuid4(), "message": {"no": i}}
+            for i in range(5)
+        ]
+        for message in messages:
+            for channel_history in histories:
+                channel_history.append(MessageFrame.from_dict(message))
+        for channel_history in histories:
+            assert len(channel_history) == 3
+            assert [m["uuid"] for m in channel_history] == [
+                m["uuid"] for m in messages[2:]
+            ]
+        reopened = backends[0].open("test", 3)
+        assert [m["uuid"] for m in reopened] == [m["uuid"] for m in messages[2:]]
+        for backend in backends:
+            backend.close()
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestSnapshot(object):
+    def build_state(self):
+        server_state = get_state()
+        configs = {
+            "a": {"store_history": True, "history_size": 5, "notify_presence": True}
+        }
+        connection, user = operations.connect(
+            username="test",
+            fresh_user_state={"key": "foo", "private": 1},
+            state_public_keys=["key"],
+            update_user_state={},
+            conn_id=uuid.uuid4(),
+            channels=["a", "b"],
+            channel_configs=configs,
+            publish=False,
+        )
+        for i in range(3):
+            msg = {
+                "uuid": uuid.uuid4(),
+                "timestamp": datetime.utcnow(),
+                "user": "test",
+                "channel": "a",
+                "message": {"no": i},
+                "no_history": False,
+                "pm_users": [],
+                "exclude_users": [],
+            }
+            operations.pass_message(msg, server_state.stats, publish=False)
+        return connection
+
+    def reset_state(self):
+        server_state = get_state()
+        server_state.channels = {}
+        server_state.connections = {}
+        server_state.users = {}
+        server_state.stats["total_messages"] = 0
+        server_state.stats["total_unique_messages"] = 0
+
+    def test_restores_state(self, tmp_path):
+        path = str(tmp_path / "state.snapshot")
+        connection = self.build_state()
+        server_state = get_state()
+        channel = server_state.channels["a"]
+        history_before = list(channel.history)
+        frames_before = list(channel.frames)
+        assert snapshot.save(path) > 0
+        self.reset_state()
+
+        assert snapshot.load(path) is True
+        user = server_state.users["test"]
+        assert user.state == {"key": "foo", "private": 1}
+        assert user.state_public_keys == ["key"]
+        channel = server_state.channels["a"]
+        assert channel.notify_presence is True
+        assert channel.history_size == 5
+        assert channel.seq == 4
+        assert [m["uuid"] for m in channel.history] == [
+            m["uuid"] for m in history_before
+        ]
+        # restoring sends no presence notifications
+        assert len(channel.frames) == len(frames_before)
+        assert server_state.stats["total_messages"] == 3
+        restored = server_state.connections[connection.id]
+        assert restored.channel_names == {"a", "b"}
+        assert user.connections == [restored]
+        assert channel.connections["test"] == [restored]
+        frames, lost = channel.get_frames_since(1, "test")
+        assert lost is False
+        assert [frame["seq"] for frame in frames] == [2, 3, 4]
+        channel.add_message({"type": "message", "uuid": uuid.uuid4()})
+        assert channel.history[-1]["seq"] == 5
+
+    def test_persistent_history_is_not_stored(self, tmp_path, sqlite_history):
+        self.build_state()
+        data = snapshot.dump_state(get_state())
+        assert all(channel[6] is None for channel in data["channels"])
+        path = str(tmp_path / "state.snapshot")
+        snapshot.save(path)
+        self.reset_state()
+        snapshot.load(path)
+        channel = get_state().channels["a"]
+        assert [m["message"] for m in channel.history] == [
+            {"no": 0},
+            {"no": 1},
+            {"no": 2},
+        ]
+        assert channel.seq == 4
+
+    def test_missing_or_invalid_file(self, tmp_path):
+        assert snapshot.load("") is False
+        assert snapshot.load(str(tmp_path / "missing")) is False
+        path = tmp_path / "invalid"
+        path.write_bytes(b"garbage")
+        assert snapshot.load(str(path)) is False
+        assert get_state().users == {}
+
+    def test_corrupted_file_starts_cold(self, tmp_path):
+        path = str(tmp_path / "state.snapshot")
+        self.build_state()
+        snapshot.save(path)
+        data = snapshot.dump_state(get_state())
+        self.reset_state()
+        with open(path, "rb") as snapshot_file:
+            content = snapshot_file.read()
+        # truncated snapshot
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(content[: len(content) // 2])
+        assert snapshot.load(path) is False
+        # users get restored before broken channel entry is found
+        data["channels"] = [("a",)]
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(snapshot.MAGIC + pickle.dumps(data))
+        assert snapshot.load(path) is False
+        server_state = get_state()
+        assert server_state.users == {}
+        assert server_state.channels == {}
+        assert server_state.connections == {}
+        assert server_state.active_user_count == 0
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestCompiledValidation(object):
+    def plain(self, data):
+        # schemas add unknown keys in no particular order
+        if isinstance(data, list):
+            return [self.plain(item) for item in data]
+        if isinstance(data, dict):
+            return {key: self.plain(value) for key, value in data.items()}
+        return data
+
+    def assert_same(self, schema_cls, data, request=None, many=False):
+        # compiled validator loads the same data or raises the same errors,
+        # pre_load hooks of schemas can change the data passed
+        context = {"request": request}
+        try:
+            expected = schema_cls(context=context, many=many).load(copy.deepcopy(data))
+        except marshmallow.ValidationError as exc:
+            with pytest.raises(marshmallow.ValidationError) as compiled_exc:
+                compiled.load(schema_cls, data, request, many=many)
+            assert compiled_exc.value.messages == exc.messages
+            return None
+        result = compiled.load(schema_cls, data, request, many=many)
+        assert self.plain(result) == self.plain(expected)
+        assert type(result) == type(expected)
+        return result
+
+    def test_messages(self, test_uuids):
+        message = {
+            "type": "message",
+            "uuid": str(test_uuids[0]),
+            "timestamp": "2020-01-01T10:00:00",
+            "user": "test",
+            "channel": "a",
+            "message": {"text": "foo"},
+            "pm_users": ["a", "b"],
+            "extra": 1,
+        }
+        result = self.assert_same(schemas.MessageBodySchema, [message], many=True)
+        assert result[0]["uuid"] == test_uuids[0]
+        assert result[0]["edited"] is None
+        assert result[0]["extra"] == 1
+
+    def test_message_defaults(self):
+        result = compiled.load(schemas.MessageBodySchema, [{"user": "test"}], many=True)
+        assert isinstance(result[0]["uuid"], uuid.UUID)
+        assert isinstance(result[0]["timestamp"], datetime)
+        assert result[0]["channel"] is None
+        assert result[0]["pm_users"] == []
+        assert result[0]["no_history"] is False
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            {"user": "test"},
+            [{"user": "test"}, "foo"],
+            [{"channel": "a"}],
+            [{"user": "test", "channel": ""}],
+            [{"user": "test", "pm_users": "a"}],
+            [{"user": "test", "pm_users": ["a", 1]}],
+            [{"user": "test", "uuid": "foo"}],
+            [{"user": "test", "timestamp": "yesterday"}],
+            [{"user": "test", "message": []}],
+            [{"user": "x" * 513}],
+            # valid, but converted by the schema
+            [
+                {
+                    "user": "test",
+                    "no_history": "yes",
+                    "uuid": str(uuid.UUID(int=1)),
+                    "timestamp": "2020-01-01T10:00:00",
+                }
+            ],
+        ],
+    )
+    def test_message_errors(self, data):
+        self.assert_same(schemas.MessageBodySchema, data, many=True)
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            {
+                "username": "test",
+                "conn_id": str(uuid.UUID(int=1)),
+                "channels": ["a", "b"],
+                "fresh_user_state": {"a": 1, "b": None, "c": True, "d": 1.5},
+                "user_state": {"e": "f"},
+                "state_public_keys": ["a"],
+                "channel_configs": {"a": {"store_history": True, "history_size": 5}},
+                "frames_size": 10,
+                "info": {"include_history": False, "channels": ["a"]},
+            },
+            {"username": "test", "conn_id": str(uuid.UUID(int=1)), "foo": 1},
+            {"username": "test", "fresh_user_state": {"a": [1]}},
+            {"username": "test", "channel_configs": {"a": {"history_size": -1}}},
+            {
+                "username": "test",
+                "conn_id": str(uuid.UUID(int=1)),
+                "channel_configs": {"a": {"flush_window": 0.5}},
+            },
+            {"username": "test", "frames_size": -1},
+            {
+                "username": "test",
+                "conn_id": str(uuid.UUID(int=1)),
+                "info": {"include_users": "no"},
+            },
+            {"channels": ["a"]},
+        ],
+    )
+    def test_connect(self, data):
+        self.assert_same(schemas.ConnectBodySchema, data)
+
+    def test_subscribe(self, dummy_request, test_uuids):
+        server_state = get_state()
+        server_state.connections[test_uuids[1]] = Connection("test", test_uuids[1])
+        configs = {"a": {"notify_state": True}}
+        data = {"channels": ["a"], "channel_configs": configs}
+        self.assert_same(schemas.SubscribeBodySchema, data, dummy_request)
+        dummy_request.GET["conn_id"] = str(test_uuids[1])
+        # schema fills in conn_id of the payload it loads
+        data = {"channels": ["a"], "channel_configs": configs}
+        result = self.assert_same(schemas.SubscribeBodySchema, data, dummy_request)
+        assert result["conn_id"] == test_uuids[1]
+        data = {"conn_id": str(test_uuids[2]), "channels": ["a"]}
+        self.assert_same(schemas.UnsubscribeBodySchema, data, dummy_request)
+
+    def test_validators_are_cached(self):
+        validator = compiled.get_validator(schemas.MessageBodySchema, many=True)
+        assert compiled.get_validator(schemas.MessageBodySchema, many=True) is validator
+        assert validator.load_item is not None
+
+
+class TestRingBuffer(object):
+    def make_buffer(self, capacity):
+        return RingBuffer(capacity, uuid_of=lambda entry: entry.get("uuid"))
+
+    def test_append_evicts_oldest(self):
+        buffer = self.make_buffer(3)
+        evicted = [buffer.append({"uuid": i}) for i in range(5)]
+        assert evicted == [None, None, None, 0, 1]
+        assert list(buffer) == [{"uuid": 2}, {"uuid": 3}, {"uuid": 4}]
+        assert buffer.get(1) is None
+        assert buffer.get(3) == {"uuid": 3}
+        assert buffer[0] == {"uuid": 2}
+        assert buffer[-1] == {"uuid": 4}
+        with pytest.raises(IndexError):
+            buffer[3]
+
+    def test_replace_and_remove(self):
+        buffer = self.make_buffer(3)
+        for i in range(3):
+            buffer.append({"uuid": i}, key=i * 10)
+        assert buffer.replace(1, {"uuid": 1, "edited": True})
+        assert buffer.replace(7, {"uuid": 7}) is False
+        assert buffer.remove(0) == {"uuid": 0}
+        assert buffer.remove(0) is None
+        assert list(buffer) == [{"uuid": 1, "edited": True}, {"uuid": 2}]
+        assert buffer.since(10) == [{"uuid": 2}]
+        assert buffer.since(5) == [{"uuid": 1, "edited": True}, {"uuid": 2}]
+
+    def test_resize(self):
+        buffer = self.make_buffer(5)
+        for i in range(5):
+            buffer.append({"uuid": i})
+        assert buffer.resize(2) == 2
+        assert len(buffer) == 2
+        assert buffer.get(2) is None
+        buffer.resize(0)
+        assert list(buffer) == []
 
 
 @pytest.mark.usefixtures("cleanup_globals")
@@ -408,6 +1363,69 @@ class TestGC(object):
         assert len(server_state.channels["test"].connections.items()) == 0
         assert len(server_state.channels["test2"].connections.items()) == 0
 
+    def test_gc_keeps_state_counters(self, test_uuids):
+        server_state = get_state()
+        channel, user, connection = self._connected(test_uuids)
+        connection2 = Connection("test_user", test_uuids[2])
+        server_state.connections[connection2.id] = connection2
+        user.add_connection(connection2)
+        assert server_state.active_user_count == 1
+        connection.mark_for_gc()
+        channelstream.gc.gc_conns()
+        assert server_state.active_user_count == 1
+        connection2.mark_for_gc()
+        channelstream.gc.gc_conns()
+        assert server_state.active_user_count == 0
+        assert server_state.connections == {}
+
+    def _connected(self, test_uuids):
+        server_state = get_state()
+        channel = Channel("test")
+        server_state.channels[channel.name] = channel
+        user = User("test_user")
+        server_state.users[user.username] = user
+        connection = Connection("test_user", test_uuids[1])
+        server_state.connections[connection.id] = connection
+        user.add_connection(connection)
+        channel.add_connection(connection)
+        return channel, user, connection
+
+    def test_gc_connections_expire(self, test_uuids):
+        server_state = get_state()
+        channel, user, connection = self._connected(test_uuids)
+        later = datetime.utcnow() + timedelta(seconds=10)
+        channelstream.gc.gc_conns(now=later)
+        assert connection.id in server_state.connections
+        later = datetime.utcnow() + timedelta(seconds=20)
+        channelstream.gc.gc_conns(now=later)
+        assert connection.id not in server_state.connections
+        assert channel.connections == {}
+        assert user.connections == []
+        stats = server_state.gc_stats["conns"]
+        assert stats["total_collected"] >= 1
+        assert stats["max_pause_ms"] >= stats["last_pause_ms"] >= 0
+
+    def test_gc_connections_activity_reschedules(self, test_uuids):
+        server_state = get_state()
+        channel, user, connection = self._connected(test_uuids)
+        connection.last_active += timedelta(seconds=10)
+        later = datetime.utcnow() + timedelta(seconds=20)
+        channelstream.gc.gc_conns(now=later)
+        assert connection.id in server_state.connections
+        # only the rescheduled entry is left
+        assert len(server_state.expiring_connections) == 1
+        assert server_state.expiring_connections[0][0] == connection.gc_deadline
+
+    def test_disconnect_tears_down(self, test_uuids):
+        server_state = get_state()
+        channel, user, connection = self._connected(test_uuids)
+        assert operations.disconnect(connection.id) is True
+        assert connection.id not in server_state.connections
+        assert channel.connections == {}
+        assert user.connections == []
+        assert connection.channel_names == set()
+        assert operations.disconnect(connection.id) is False
+
     def test_users_active(self):
         server_state = get_state()
         user = User("test_user")
@@ -416,6 +1434,587 @@ class TestGC(object):
         server_state.users[user2.username] = user2
         channelstream.gc.gc_users()
         assert len(server_state.users.items()) == 2
-        user.last_active -= timedelta(days=2)
-        channelstream.gc.gc_users()
-        assert len(server_state.users.items()) == 1
+        sweep_time = datetime.utcnow() + timedelta(hours=25)
+        # second user was active an hour before the sweep
+        user2.last_active = sweep_time - timedelta(hours=1)
+        channelstream.gc.gc_users(now=sweep_time)
+        assert list(server_state.users.keys()) == ["test_user2"]
+        assert user2.gc_deadline == user2.last_active + channelstream.gc.USER_TIMEOUT
+
+    def test_users_bounded_chunks(self):
+        server_state = get_state()
+        for i in range(10):
+            user = User("test_user{}".format(i))
+            server_state.users[user.username] = user
+        runs = server_state.gc_stats["users"]["runs"]
+        sweep_time = datetime.utcnow() + timedelta(days=2)
+        collected = channelstream.gc.gc_users(now=sweep_time, batch_size=3)
+        assert collected == 10
+        assert server_state.users == {}
+        assert server_state.gc_stats["users"]["runs"] - runs == 4
+
+
+class TestPatchedJSON(object):
+    def _payload(self):
+        class Custom(object):
+            def __json__(self):
+                return {"custom": True}
+
+        return {
+            "uuid": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+            "timestamp": datetime(2020, 1, 2, 3, 4, 5, 6),
+            "aware": datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+            "date": date(2020, 1, 2),
+            "time": time(3, 4, 5, 6),
+            "decimal": Decimal("1.10"),
+            "set": {1},
+            "complex": complex(1, 2),
+            "custom": Custom(),
+            "text": "zażółć",
+        }
+
+    def test_compact_by_default(self):
+        assert json.dumps({"a": [1, 2]}) == '{"a":[1,2]}'
+        assert json.dumps({"a": 1}, indent=4) == '{\n    "a": 1\n}'
+
+    @pytest.mark.parametrize("backend", ["json", "orjson"])
+    def test_backends_match_complex_encoder(self, backend):
+        if backend not in json.BACKENDS:
+            pytest.skip("{} not installed".format(backend))
+        expected = stdlib_json.loads(
+            stdlib_json.dumps(self._payload(), cls=json.ComplexEncoder)
+        )
+        json.use_backend(backend)
+        try:
+            assert json.loads(json.dumps(self._payload())) == expected
+            assert json.loads(json.dumpb(self._payload())) == expected
+        finally:
+            json.use_backend("auto")
+
+    @pytest.mark.parametrize("backend", ["json", "orjson"])
+    def test_backends_unknown_type(self, backend):
+        if backend not in json.BACKENDS:
+            pytest.skip("{} not installed".format(backend))
+        json.use_backend(backend)
+        try:
+            with pytest.raises(NotImplementedError):
+                json.dumps({"a": object()})
+        finally:
+            json.use_backend("auto")
+
+    def test_unknown_backend(self):
+        assert json.use_backend("foo") == "json"
+        json.use_backend("auto")
+
+
+class TestMessageFrame(object):
+    def _message(self):
+        return {
+            "uuid": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+            "type": "message",
+            "channel": "test",
+            "message": {"text": "test"},
+            "no_history": True,
+            "pm_users": ["test_user"],
+            "exclude_users": ["test_user2"],
+        }
+
+    def test_delivery_info_is_separate(self):
+        frame = MessageFrame.from_dict(self._message())
+        assert frame.no_history is True
+        assert frame.pm_users == ("test_user",)
+        assert frame.exclude_users == ("test_user2",)
+        assert "pm_users" not in frame.payload
+        assert json.loads(frame.encoded) == [
+            {
+                "uuid": "12345678-1234-5678-1234-567812345678",
+                "type": "message",
+                "channel": "test",
+                "message": {"text": "test"},
+            }
+        ]
+        # whole message is still available via mapping interface
+        assert frame == self._message()
+
+    def test_immutable(self):
+        frame = MessageFrame.from_dict(self._message())
+        with pytest.raises(TypeError):
+            frame["type"] = "foo"
+        with pytest.raises(TypeError):
+            frame.payload["type"] = "foo"
+        with pytest.raises(AttributeError):
+            frame.no_history = False
+
+    def test_replace(self):
+        frame = MessageFrame.from_dict(self._message())
+        edited = frame.replace(message={"text": "edited"}, pm_users=[])
+        assert edited is not frame
+        assert frame["message"] == {"text": "test"}
+        assert frame.pm_users == ("test_user",)
+        assert edited["message"] == {"text": "edited"}
+        assert edited.pm_users == ()
+        assert edited.exclude_users == ("test_user2",)
+
+    def test_catchup_is_shared(self):
+        frame = MessageFrame.from_dict(self._message())
+        catchup = frame.as_catchup()
+        assert catchup["catchup"] is True
+        assert "catchup" not in frame
+        assert frame.as_catchup() is catchup
+        assert catchup.encoded is catchup.encoded
+
+    def test_channel_shares_frame(self, test_uuids):
+        config = {"store_history": True}
+        channel = Channel("test", channel_config=config)
+        message = self._message()
+        message["no_history"] = False
+        channel.add_message(message)
+        assert channel.history[0] is channel.frames[0][1]
+
+
+class YieldingSocket(object):
+    terminated = False
+
+    def send(self, payload):
+        # force greenlet switches in the middle of operations
+        gevent.sleep(0)
+
+    def close(self):
+        self.terminated = True
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestStateLocks(object):
+    def _worker(self, seed, iterations):
+        server_state = get_state()
+        rand = random.Random(seed)
+        channels = ["chan_{}".format(i) for i in range(5)]
+        configs = {c: {"notify_presence": True} for c in channels}
+        for i in range(iterations):
+            action = rand.choice(["connect", "subscribe", "unsubscribe", "publish"])
+            connections = list(server_state.connections.values())
+            if action == "connect" or not connections:
+                connection, user = operations.connect(
+                    username="user_{}".format(rand.randint(0, 5)),
+                    fresh_user_state={},
+                    state_public_keys=[],
+                    update_user_state={},
+                    conn_id=uuid.uuid4(),
+                    channels=rand.sample(channels, 2),
+                    channel_configs=configs,
+                )
+                connection.socket = YieldingSocket()
+            elif action == "subscribe":
+                operations.subscribe(
+                    connection=rand.choice(connections),
+                    channels=rand.sample(channels, 2),
+                    channel_configs=configs,
+                )
+            elif action == "unsubscribe":
+                operations.unsubscribe(
+                    connection=rand.choice(connections),
+                    unsubscribe_channels=rand.sample(channels, 2),
+                )
+            else:
+                msg = {
+                    "uuid": uuid.uuid4(),
+                    "user": "system",
+                    "channel": rand.choice(channels),
+                    "message": {"text": "hello"},
+                    "no_history": False,
+                    "pm_users": [],
+                    "exclude_users": [],
+                }
+                operations.pass_message(msg, server_state.stats)
+
+    def _gc_worker(self, iterations):
+        server_state = get_state()
+        for i in range(iterations):
+            connections = list(server_state.connections.values())
+            if connections:
+                random.choice(connections).mark_for_gc()
+            channelstream.gc.gc_conns()
+            gevent.sleep(0)
+
+    def test_concurrent_operations(self):
+        server_state = get_state()
+        greenlets = [gevent.spawn(self._worker, seed, 50) for seed in range(8)]
+        greenlets.append(gevent.spawn(self._gc_worker, 50))
+        gevent.joinall(greenlets, raise_error=True)
+
+        for conn in server_state.connections.values():
+            assert conn in server_state.users[conn.username].connections
+            for name in conn.channel_names:
+                assert conn in server_state.channels[name].connections[conn.username]
+        for channel in server_state.channels.values():
+            for username, conns in channel.connections.items():
+                assert conns
+                for conn in conns:
+                    assert server_state.connections[conn.id] is conn
+                    assert channel.name in conn.channel_names
+        lock_stats = server_state.lock_stats()
+        assert lock_stats["channels"]["acquisitions"] > 0
+        assert lock_stats["users"]["wait_time_ms"] >= 0
+
+
+class RecordingNode(object):
+    """Other node on loopback backplane keeping operations it received"""
+
+    def __init__(self, url):
+        self.frames = []
+        self.backplane = LoopbackBackplane(url, "node-b", self.handle)
+        self.backplane.start()
+
+    def handle(self, operation, payload, node_id):
+        self.frames.append((operation, payload, node_id))
+
+    def replay(self):
+        for operation, payload, node_id in self.frames:
+            operations.apply_remote(operation, payload, node_id)
+
+
+@pytest.fixture
+def loopback():
+    backplane.use_backplane(LoopbackBackplane("test", "node-a", None))
+    node = RecordingNode("test")
+    yield node
+    node.backplane.stop()
+    backplane.use_backplane(None)
+
+
+@pytest.fixture
+def two_nodes(loopback, monkeypatch):
+    # two nodes with their own state, operations published by one of
+    # them are applied by the other like the backplane would do
+    states = {"node-a": State(), "node-b": State()}
+
+    def on_node(node_id):
+        monkeypatch.setitem(channelstream.server_state.STATES, "0", states[node_id])
+
+    def apply_published(sender, receiver):
+        frames, loopback.frames = loopback.frames, []
+        on_node(receiver)
+        for operation, payload, _ in frames:
+            operations.apply_remote(operation, payload, sender)
+
+    return on_node, apply_published
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestBackplane(object):
+    @pytest.mark.parametrize("transport", ["tcp", "unix"])
+    def test_broker_relays_to_other_nodes(self, tmpdir, transport):
+        if transport == "tcp":
+            broker = bus.BusBroker("tcp://127.0.0.1:0")
+            broker.start()
+            url = "tcp://127.0.0.1:{}".format(broker.address[1])
+        else:
+            url = "unix://{}".format(tmpdir.join("bus.sock"))
+            broker = bus.BusBroker(url)
+            broker.start()
+        received = {"a": [], "b": []}
+        nodes = [
+            SocketBackplane(
+                url, name, lambda *args, name=name: received[name].append(args)
+            )
+            for name in ("a", "b")
+        ]
+        try:
+            for node in nodes:
+                node.start()
+            with gevent.Timeout(5):
+                while len(broker.peers) < 2:
+                    gevent.sleep(0.01)
+                nodes[0].publish("stats", {"value": 1})
+                while not received["b"]:
+                    gevent.sleep(0.01)
+        finally:
+            for node in nodes:
+                node.stop()
+            broker.stop()
+        assert received == {"a": [], "b": [("stats", {"value": 1}, "a")]}
+
+    def test_replayed_operations_build_same_state(self, loopback):
+        server_state = get_state()
+        configs = {"a": {"store_history": True, "history_size": 5}}
+        connection, user = operations.connect(
+            username="test",
+            fresh_user_state={"key": "foo"},
+            state_public_keys=["key"],
+            update_user_state={},
+            conn_id=uuid.uuid4(),
+            channels=["a"],
+            channel_configs=configs,
+        )
+        operations.subscribe(connection=connection, channels=["b"], channel_configs={})
+        operations.unsubscribe(connection=connection, unsubscribe_channels=["b"])
+        operations.change_user_state(user_inst=user, user_state={"key": "bar"})
+        msg = {
+            "uuid": uuid.uuid4(),
+            "timestamp": datetime.utcnow(),
+            "user": "test",
+            "channel": "a",
+            "message": {"text": "hello"},
+            "no_history": False,
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        operations.pass_message(msg, server_state.stats)
+        assert [frame[0] for frame in loopback.frames] == [
+            "connect",
+            "subscribe",
+            "unsubscribe",
+            "change_user_state",
+            "pass_message",
+        ]
+
+        # apply the same operations on a fresh node
+        backplane.use_backplane(None)
+        server_state.channels = {}
+        server_state.connections = {}
+        server_state.users = {}
+        loopback.replay()
+        replica = server_state.connections[connection.id]
+        assert replica.owner == "node-a"
+        assert replica.channels == ["a"]
+        assert server_state.users["test"].state == {"key": "bar"}
+        assert server_state.users["test"].public_state == {"key": "bar"}
+        history = server_state.channels["a"].history
+        assert history[0]["uuid"] == msg["uuid"]
+        assert history[0]["timestamp"] == msg["timestamp"]
+        assert server_state.channels["a"].history_size == 5
+
+        # expiry of replicated connections is decided by node serving them
+        channelstream.gc.gc_conns(now=datetime.utcnow() + timedelta(days=1))
+        assert connection.id in server_state.connections
+        operations.apply_remote("disconnect", {"conn_id": str(connection.id)})
+        assert connection.id not in server_state.connections
+
+    def test_replayed_bulk_operations(self, loopback):
+        server_state = get_state()
+        items = [
+            {"username": "test{}".format(i), "conn_id": uuid.uuid4(), "channels": ["a"]}
+            for i in range(3)
+        ]
+        connected = operations.bulk_connect(items)
+        connection = connected[0][0]
+        operations.bulk_subscribe([{"connection": connection, "channels": ["b"]}])
+        operations.bulk_unsubscribe([{"connection": connection, "channels": ["a"]}])
+        assert [frame[0] for frame in loopback.frames] == ["bulk", "bulk", "bulk"]
+
+        backplane.use_backplane(None)
+        server_state.channels = {}
+        server_state.connections = {}
+        server_state.users = {}
+        loopback.replay()
+        assert sorted(server_state.users.keys()) == ["test0", "test1", "test2"]
+        replica = server_state.connections[connection.id]
+        assert replica.owner == "node-a"
+        assert replica.channels == ["b"]
+        assert sorted(server_state.channels["a"].connections.keys()) == [
+            "test1",
+            "test2",
+        ]
+
+    def test_claim_connection(self, loopback):
+        connection = Connection("test", uuid.uuid4())
+        get_state().connections[connection.id] = connection
+        operations.claim_connection(connection)
+        assert loopback.frames == []
+        connection.queue = Queue()
+        operations.apply_remote(
+            "claim_connection", {"conn_id": str(connection.id)}, "node-b"
+        )
+        assert connection.owner == "node-b"
+        assert connection.queue is None
+        operations.claim_connection(connection)
+        assert connection.remote is False
+        assert loopback.frames == [
+            ("claim_connection", {"conn_id": str(connection.id)}, "node-a")
+        ]
+
+    def test_cluster_stats(self):
+        server_state = get_state()
+        server_state.stats["total_messages"] = 3
+        stats = {"total_messages": 4, "connections": 1}
+        operations.apply_remote("stats", stats, "node-b")
+        operations.apply_remote("stats", dict(stats, total_messages=5), "node-c")
+        server_state.peer_stats["node-c"]["updated"] -= timedelta(minutes=5)
+        assert operations.cluster_stats() == {
+            "nodes": 2,
+            "connections": 1,
+            "total_messages": 7,
+        }
+
+    def test_cluster_stats_count_each_delivery_once(self, two_nodes):
+        on_node, apply_published = two_nodes
+        for node_id, other in (("node-a", "node-b"), ("node-b", "node-a")):
+            on_node(node_id)
+            for i in range(2):
+                operations.connect(
+                    username="{}-user{}".format(node_id, i),
+                    fresh_user_state={},
+                    state_public_keys=[],
+                    update_user_state={},
+                    conn_id=uuid.uuid4(),
+                    channels=["a"],
+                    channel_configs={},
+                )
+            apply_published(node_id, other)
+        on_node("node-a")
+        msg = {
+            "uuid": uuid.uuid4(),
+            "timestamp": datetime.utcnow(),
+            "user": "node-a-user0",
+            "channel": "a",
+            "message": {"text": "hello"},
+            "no_history": False,
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        operations.pass_message(msg, get_state().stats)
+        pm = dict(msg, uuid=uuid.uuid4(), channel=None, pm_users=["node-b-user0"])
+        operations.pass_message(pm, get_state().stats)
+        apply_published("node-a", "node-b")
+        stats = operations.local_stats()
+        on_node("node-a")
+        operations.apply_remote("stats", stats, "node-b")
+        # 4 subscribers of the channel and 1 private message recipient
+        assert operations.cluster_stats()["total_messages"] == 5
+        assert get_state().stats["total_messages"] == 2
+
+    def test_resume_on_node_that_created_channel_late(self, two_nodes):
+        on_node, apply_published = two_nodes
+
+        def post(text):
+            msg = {
+                "uuid": uuid.uuid4(),
+                "timestamp": datetime.utcnow(),
+                "user": "test",
+                "channel": "a",
+                "message": {"text": text},
+                "no_history": False,
+                "pm_users": [],
+                "exclude_users": [],
+            }
+            operations.pass_message(msg, get_state().stats)
+
+        on_node("node-a")
+        operations.set_channel_config({"a": {"store_history": True}}, publish=False)
+        for i in range(3):
+            post("before {}".format(i))
+        # other node has no channel yet, so it ignores the messages
+        apply_published("node-a", "node-b")
+        operations.connect(
+            username="test",
+            fresh_user_state={},
+            state_public_keys=[],
+            update_user_state={},
+            conn_id=uuid.uuid4(),
+            channels=["a"],
+            channel_configs={"a": {"store_history": True}},
+        )
+        apply_published("node-b", "node-a")
+        post("after 0")
+        post("after 1")
+        apply_published("node-a", "node-b")
+        channel_b = get_state().channels["a"]
+        on_node("node-a")
+        channel_a = get_state().channels["a"]
+        assert [m["seq"] for m in channel_a.history] == [1, 2, 3, 4, 5]
+        assert [m["seq"] for m in channel_b.history] == [4, 5]
+        # client that got message 4 from one node resumes on the other one
+        for channel in (channel_a, channel_b):
+            frames, _ = channel.get_frames_since(4, "test")
+            assert [f["message"]["text"] for f in frames] == ["after 1"]
+        assert channel_b.get_frames_since(3, "test")[1] is False
+        # messages published concurrently can not reuse a sequence number
+        channel_b.add_messages([{"type": "message", "seq": 5, "uuid": uuid.uuid4()}])
+        assert channel_b.seq == 6
+
+    def test_local_stats_count_remote_connections(self):
+        server_state = get_state()
+        connections = [
+            operations.connect(
+                username="test{}".format(i),
+                fresh_user_state={},
+                state_public_keys=[],
+                update_user_state={},
+                conn_id=uuid.uuid4(),
+                channels=["a"],
+                channel_configs={},
+                publish=False,
+            )[0]
+            for i in range(3)
+        ]
+        assert operations.local_stats()["connections"] == 3
+        connections[0].owner = "node-b"
+        connections[1].owner = "node-b"
+        connections[1].owner = "node-c"
+        assert server_state.remote_connection_count == 2
+        assert operations.local_stats()["connections"] == 1
+        operations.claim_connection(connections[1], publish=False)
+        assert operations.local_stats()["connections"] == 2
+        operations.disconnect(connections[0].id, publish=False)
+        assert server_state.remote_connection_count == 0
+        assert operations.local_stats()["connections"] == 2
+        assert server_state.active_user_count == 2
+
+    def test_expire_peers(self):
+        server_state = get_state()
+        connection, user = operations.connect(
+            username="test",
+            fresh_user_state={},
+            state_public_keys=[],
+            update_user_state={},
+            conn_id=uuid.uuid4(),
+            channels=["a"],
+            channel_configs={},
+        )
+        connection.owner = "node-b"
+        stats = {"total_messages": 0, "connections": 1}
+        operations.apply_remote("stats", stats, "node-b")
+        assert operations.expire_peers() == []
+        server_state.peer_stats["node-b"]["updated"] -= timedelta(minutes=5)
+        assert operations.expire_peers() == ["node-b"]
+        assert connection.id not in server_state.connections
+        assert server_state.channels["a"].connections == {}
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestWebSocket(object):
+    def open_socket(self, query_string):
+        socket = ChatApplicationSocket.__new__(ChatApplicationSocket)
+        socket.environ = {"QUERY_STRING": query_string}
+        socket.closed_with = None
+
+        def close(code=1000, reason=""):
+            socket.closed_with = (code, reason)
+
+        socket.close = close
+        socket.opened()
+        return socket
+
+    def test_wrong_since_closes_socket(self, test_uuids):
+        operations.connect(
+            username="test",
+            conn_id=test_uuids[1],
+            channels=["a"],
+            channel_configs={},
+            publish=False,
+        )
+        socket = self.open_socket("conn_id={}&since=a:b".format(test_uuids[1]))
+        assert socket.closed_with == (1008, "Wrong since format")
+        assert get_state().connections[test_uuids[1]].socket is None
+
+    def test_since_is_passed_to_catchup(self, test_uuids):
+        operations.connect(
+            username="test",
+            conn_id=test_uuids[1],
+            channels=["a"],
+            channel_configs={},
+            publish=False,
+        )
+        socket = self.open_socket("conn_id={}&since=0".format(test_uuids[1]))
+        assert socket.closed_with is None
+        assert get_state().connections[test_uuids[1]].socket is socket
@@ -3,9 +3,18 @@ from gevent import monkey
 monkey.patch_all()
 
 import copy
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import gevent
 import pytest
+import requests
 
 from webtest import TestApp
+from channelstream import bus
 from channelstream.cli import SHARED_DEFAULTS
 from channelstream.cli.start import RoutingApplication
 
@@ -170,3 +179,118 @@ class TestServerConfigView(object):
         assert "timestamp" in message
         assert message["user"] == "system"
         assert message["message"] == {"text": "my_text"}
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Node(object):
+    """Channelstream server running in a separate process"""
+
+    def __init__(self, backplane_url):
+        self.port = free_port()
+        self.url = "http://127.0.0.1:{}".format(self.port)
+        env = dict(os.environ)
+        env.update(
+            {
+                "CHANNELSTREAM_PORT": str(self.port),
+                "CHANNELSTREAM_HOST": "127.0.0.1",
+                "CHANNELSTREAM_BACKPLANE_URL": backplane_url,
+                "CHANNELSTREAM_LOG_LEVEL": "WARNING",
+            }
+        )
+        cmd = [sys.executable, "-c", "from channelstream.cli.start import main; main()"]
+        self.process = subprocess.Popen(cmd, env=env)
+
+    def post(self, path, payload):
+        headers = {"x-channelstream-secret": gen_signature(SHARED_DEFAULTS["secret"])}
+        response = requests.post(self.url + path, json=payload, headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    def wait_until_ready(self, timeout=20):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                return requests.get(self.url + "/", timeout=1)
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError("node did not start")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def eventually(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("condition not met in {}s".format(timeout))
+        gevent.sleep(0.1)
+
+
+@pytest.fixture
+def cluster():
+    broker = bus.BusBroker("tcp://127.0.0.1:0")
+    broker.start()
+    url = "tcp://127.0.0.1:{}".format(broker.address[1])
+    nodes = [Node(url), Node(url)]
+    try:
+        for node in nodes:
+            node.wait_until_ready()
+        eventually(lambda: len(broker.peers) == len(nodes))
+        yield nodes
+    finally:
+        for node in nodes:
+            node.stop()
+        broker.stop()
+
+
+class TestCluster(object):
+    def test_nodes_share_channels_and_messages(self, cluster):
+        node_a, node_b = cluster
+        configs = {"chat": {"store_history": True, "notify_presence": True}}
+        alice = node_a.post(
+            "/connect",
+            {"username": "alice", "channels": ["chat"], "channel_configs": configs},
+        )
+        node_b.post(
+            "/connect",
+            {"username": "bob", "channels": ["chat"], "channel_configs": configs},
+        )
+
+        def users_on(node):
+            info = node.post("/info", {"info": {"channels": ["chat"]}})
+            return sorted(u["user"] for u in info["users"])
+
+        eventually(lambda: users_on(node_a) == ["alice", "bob"])
+        eventually(lambda: users_on(node_b) == ["alice", "bob"])
+
+        message = {"channel": "chat", "user": "bob", "message": {"text": "hi"}}
+        sent = node_b.post("/message", [message])[0]
+        listen_url = "{}/listen?conn_id={}".format(node_a.url, alice["conn_id"])
+        received = requests.get(listen_url).json()
+        messages = [m for m in received if m["type"] == "message"]
+        assert messages[0]["uuid"] == sent["uuid"]
+        assert messages[0]["message"] == {"text": "hi"}
+
+        edit = {"uuid": sent["uuid"], "channel": "chat", "message": {"text": "ho"}}
+        requests.patch(
+            node_a.url + "/message",
+            json=[edit],
+            headers={
+                "x-channelstream-secret": gen_signature(SHARED_DEFAULTS["secret"])
+            },
+        ).raise_for_status()
+
+        def history_on(node):
+            info = node.post("/info", {"info": {"channels": ["chat"]}})
+            return [m["message"] for m in info["channels"]["chat"]["history"]]
+
+        eventually(lambda: history_on(node_b) == [{"text": "ho"}])
@@ -2,10 +2,12 @@ from gevent import monkey
 
 monkey.patch_all()
 
+import json
 import pytest
 import gevent
 import marshmallow
-from channelstream.server_state import get_state
+from webob.multidict import MultiDict
+from channelstream.server_state import get_state, LOCK_SHARDS
 from channelstream.channel import Channel
 
 
@@ -232,6 +234,148 @@ class TestUnsubscribeViews(object):
         assert result["channels_info"]["channels"] == {}
 
 
+@pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
+class TestBulkViews(object):
+    def connect_users(self, dummy_request, test_uuids, info=None):
+        from channelstream.wsgi_views.server import bulk_connect
+
+        dummy_request.json_body = {
+            "items": [
+                {
+                    "username": "test1",
+                    "conn_id": str(test_uuids[1]),
+                    "fresh_user_state": {"key": "foo"},
+                    "state_public_keys": ["key"],
+                    "channels": ["b", "a"],
+                },
+                {"username": "", "channels": ["a"]},
+                {
+                    "username": "test2",
+                    "conn_id": str(test_uuids[2]),
+                    "channels": ["a"],
+                    "channel_configs": {"c": {"notify_presence": True}},
+                },
+            ]
+        }
+        if info is not None:
+            dummy_request.json_body["info"] = info
+        return bulk_connect(dummy_request)
+
+    def test_connect(self, dummy_request, test_uuids):
+        server_state = get_state()
+        result = self.connect_users(dummy_request, test_uuids)
+        assert "channels_info" not in result
+        first, invalid, second = result["results"]
+        assert first["conn_id"] == test_uuids[1]
+        assert first["channels"] == ["a", "b"]
+        assert first["public_state"] == {"key": "foo"}
+        assert list(invalid["error"].keys()) == ["username"]
+        assert second["username"] == "test2"
+        assert sorted(server_state.users.keys()) == ["test1", "test2"]
+        assert sorted(server_state.channels["a"].connections.keys()) == [
+            "test1",
+            "test2",
+        ]
+
+    def test_connect_locks_partitions_once(self, dummy_request, test_uuids):
+        server_state = get_state()
+        before = server_state.lock_stats()
+        self.connect_users(dummy_request, test_uuids)
+        after = server_state.lock_stats()
+        user_shards = {hash(name) % LOCK_SHARDS for name in ["test1", "test2"]}
+        channel_shards = {hash(name) % LOCK_SHARDS for name in ["a", "b"]}
+        acquired = after["users"]["acquisitions"] - before["users"]["acquisitions"]
+        assert acquired == len(user_shards)
+        acquired = (
+            after["channels"]["acquisitions"] - before["channels"]["acquisitions"]
+        )
+        assert acquired == len(channel_shards)
+
+    def test_connect_with_info(self, dummy_request, test_uuids):
+        result = self.connect_users(
+            dummy_request, test_uuids, info={"include_history": False}
+        )
+        assert sorted(result["channels_info"]["channels"].keys()) == ["a", "b"]
+
+    def test_subscribe_and_unsubscribe(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import bulk_subscribe, bulk_unsubscribe
+
+        self.connect_users(dummy_request, test_uuids)
+        dummy_request.json_body = {
+            "items": [
+                {"conn_id": str(test_uuids[1]), "channels": ["c"]},
+                {"conn_id": str(test_uuids[5]), "channels": ["c"]},
+                {"conn_id": str(test_uuids[2]), "channels": ["a", "c"]},
+            ]
+        }
+        result = bulk_subscribe(dummy_request)
+        first, unknown, second = result["results"]
+        assert first["subscribed_to"] == ["c"]
+        assert first["channels"] == ["a", "b", "c"]
+        assert unknown == {"error": {"conn_id": ["Unknown connection"]}}
+        assert second["subscribed_to"] == ["c"]
+        assert "channels_info" not in result
+
+        dummy_request.json_body = {
+            "items": [{"conn_id": str(test_uuids[1]), "channels": ["a", "c", "x"]}],
+            "info": {},
+        }
+        result = bulk_unsubscribe(dummy_request)
+        assert result["results"] == [
+            {
+                "conn_id": test_uuids[1],
+                "channels": ["b"],
+                "unsubscribed_from": ["a", "c"],
+            }
+        ]
+        assert list(result["channels_info"]["channels"].keys()) == ["b"]
+
+    def test_replication_is_waited_for_once(
+        self, dummy_request, test_uuids, monkeypatch
+    ):
+        from channelstream import backplane, operations
+        from channelstream.wsgi_views.server import bulk_subscribe
+
+        waits = []
+
+        def wait_for(predicate):
+            # connection created by other node arrives while waiting
+            operations.connect(
+                username="test1",
+                conn_id=test_uuids[1],
+                channels=[],
+                channel_configs={},
+                publish=False,
+            )
+            waits.append(predicate())
+            return waits[-1]
+
+        monkeypatch.setattr(backplane, "wait_for", wait_for)
+        dummy_request.json_body = {
+            "items": [
+                {"conn_id": str(test_uuids[1]), "channels": ["c"]},
+                {"conn_id": str(test_uuids[5]), "channels": ["c"]},
+                {"conn_id": str(test_uuids[6]), "channels": ["c"]},
+                {"conn_id": "wrong", "channels": ["c"]},
+            ]
+        }
+        result = bulk_subscribe(dummy_request)
+        assert waits == [False]
+        replicated, unknown, other_unknown, wrong = result["results"]
+        assert replicated["subscribed_to"] == ["c"]
+        assert unknown == {"error": {"conn_id": ["Unknown connection"]}}
+        assert other_unknown == unknown
+        assert list(wrong["error"].keys()) == ["conn_id"]
+
+    def test_bad_json(self, dummy_request):
+        from channelstream.wsgi_views.server import bulk_subscribe
+
+        dummy_request.json_body = {"items": []}
+        with pytest.raises(marshmallow.ValidationError) as exc:
+            bulk_subscribe(dummy_request)
+        assert list(exc.value.messages.keys()) == ["items"]
+
+
 @pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
 class TestInfoView(object):
     def test_empty_json(self, dummy_request):
@@ -421,6 +565,104 @@ class TestMessageViews(object):
         assert messages[1]["message"]["text"] == "test2"
 
 
+@pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
+class TestListenView(object):
+    def poll(self, dummy_request, conn_id, cursor=None, since=()):
+        from channelstream.wsgi_views.server import listen
+
+        dummy_request.registry.settings["wake_connections_after"] = 0.05
+        dummy_request.params = MultiDict(conn_id=str(conn_id))
+        if cursor is not None:
+            dummy_request.params["cursor"] = str(cursor)
+        for value in since:
+            dummy_request.params.add("since", value)
+        response = listen(dummy_request)
+        return json.loads(b"".join(response.app_iter))
+
+    def publish(self, dummy_request, *texts):
+        from channelstream.wsgi_views.server import message
+
+        dummy_request.json_body = [
+            {"type": "message", "user": "system", "channel": "test", "message": t}
+            for t in texts
+        ]
+        message(dummy_request)
+
+    def connect(self, dummy_request):
+        from channelstream.wsgi_views.server import connect
+
+        dummy_request.json_body = {"username": "test1", "channels": ["test"]}
+        return connect(dummy_request)["conn_id"]
+
+    def test_cursor_returns_messages_published_between_polls(self, dummy_request):
+        conn_id = self.connect(dummy_request)
+        self.publish(dummy_request, {"text": "a"})
+        result = self.poll(dummy_request, conn_id, cursor=0)
+        assert [m["message"] for m in result["messages"]] == [{"text": "a"}]
+        assert result["missed"] == 0
+        cursor = result["cursor"]
+        self.publish(dummy_request, {"text": "b"}, {"text": "c"})
+        result = self.poll(dummy_request, conn_id, cursor=cursor)
+        texts = [m["message"]["text"] for m in result["messages"]]
+        assert texts == ["b", "c"]
+        # response got lost, client polls again with the same cursor
+        result = self.poll(dummy_request, conn_id, cursor=cursor)
+        assert [m["message"]["text"] for m in result["messages"]] == texts
+        result = self.poll(dummy_request, conn_id, cursor=result["cursor"])
+        assert result["messages"] == []
+
+    def test_without_cursor_returns_list(self, dummy_request):
+        conn_id = self.connect(dummy_request)
+        assert self.poll(dummy_request, conn_id) == []
+        self.publish(dummy_request, {"text": "a"})
+        result = self.poll(dummy_request, conn_id)
+        assert [m["message"] for m in result] == [{"text": "a"}]
+        assert self.poll(dummy_request, conn_id) == []
+
+    def test_since_resumes_channel_stream(self, dummy_request):
+        conn_id = self.connect(dummy_request)
+        self.publish(dummy_request, {"text": "a"}, {"text": "b"}, {"text": "c"})
+        gevent.sleep(0)
+        result = self.poll(dummy_request, conn_id, cursor=0, since=["test:1"])
+        messages = result["messages"]
+        assert [m["message"]["text"] for m in messages] == ["b", "c"]
+        assert [m["seq"] for m in messages] == [2, 3]
+        assert all(m["catchup"] for m in messages)
+
+    def test_cursor_of_other_worker(self, dummy_request):
+        conn_id = self.connect(dummy_request)
+        self.publish(dummy_request, {"text": "a"})
+        gevent.sleep(0)
+        result = self.poll(dummy_request, conn_id, cursor=0)
+        assert "reset" not in result
+        last_seq = result["messages"][-1]["seq"]
+        # other worker took the connection over and buffered more messages,
+        # this one starts with a new buffer
+        get_state().connections[conn_id].queue = None
+        self.publish(dummy_request, {"text": "b"})
+        gevent.sleep(0)
+        since = ["test:{}".format(last_seq)]
+        result = self.poll(dummy_request, conn_id, cursor=7, since=since)
+        assert result["reset"] is True
+        assert [m["message"]["text"] for m in result["messages"]] == ["b"]
+        result = self.poll(dummy_request, conn_id, cursor=result["cursor"])
+        assert "reset" not in result
+
+    def test_reports_missed_messages(self, dummy_request, monkeypatch):
+        from channelstream import pollbuffer
+
+        monkeypatch.setattr(pollbuffer, "POLL_BUFFER_SIZE", 2)
+        conn_id = self.connect(dummy_request)
+        cursor = self.poll(dummy_request, conn_id, cursor=0)["cursor"]
+        # messages posted together are buffered as one payload
+        for text in ["a", "b", "c"]:
+            self.publish(dummy_request, {"text": text})
+            gevent.sleep(0)
+        result = self.poll(dummy_request, conn_id, cursor=cursor)
+        assert [m["message"]["text"] for m in result["messages"]] == ["b", "c"]
+        assert result["missed"] == 1
+
+
 @pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
 class TestMessageEditViews(object):
     def test_empty_json(self, dummy_request):
@@ -456,6 +698,10 @@ class TestMessageEditViews(object):
         dummy_request.json_body = [edit_payload]
         response = messages_patch(dummy_request)[0]
         gevent.sleep(0)
+        # edits produce new frames instead of mutating stored ones
+        assert msg["user"] == msg_payload["user"]
+        assert msg["message"] == msg_payload["message"]
+        msg = channel.history[0]
         assert msg["user"] == response["user"]
         assert msg["message"] == response["message"]
         assert msg["edited"] == response["edited"]
@@ -520,6 +766,7 @@ class TestChannelConfigView(object):
                 "broadcast_presence_with_user_lists": True,
                 "notify_state": True,
                 "store_frames": False,
+                "flush_window": 0.1,
             }
         }
         result = channel_config(dummy_request)
@@ -530,3 +777,231 @@ class TestChannelConfigView(object):
         assert channel_settings["broadcast_presence_with_user_lists"] is True
         assert channel_settings["notify_state"] is True
         assert channel_settings["store_frames"] is False
+        assert channel_settings["flush_window"] == 0.1
+
+
+@pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
+class TestSignatureCache(object):
+    @pytest.fixture(autouse=True)
+    def reset_cache(self):
+        from channelstream.wsgi_views import wsgi_security
+
+        yield
+        wsgi_security.configure(cache_size=10000)
+
+    def checker(self, secret="secret"):
+        from unittest import mock
+        from channelstream.utils import DefaultSigner
+
+        checker = DefaultSigner(secret)
+        checker.unsign = mock.Mock(wraps=checker.unsign)
+        return checker
+
+    def test_verified_tokens_are_cached(self):
+        from itsdangerous import TimestampSigner
+        from channelstream.wsgi_views.wsgi_security import verify_signature
+
+        checker = self.checker()
+        token = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        verify_signature(checker, token, max_age=60)
+        verify_signature(checker, token, max_age=60)
+        assert checker.unsign.call_count == 1
+
+    def test_bad_tokens_are_not_cached(self):
+        from itsdangerous import TimestampSigner
+        from channelstream.exceptions import BadSignature
+        from channelstream.wsgi_views.wsgi_security import verify_signature
+
+        checker = self.checker()
+        token = TimestampSigner("other").sign("channelstream").decode("utf8")
+        for _ in range(2):
+            with pytest.raises(BadSignature):
+                verify_signature(checker, token, max_age=60)
+        assert checker.unsign.call_count == 2
+
+    def test_cached_tokens_expire(self, monkeypatch):
+        import time
+        from itsdangerous import TimestampSigner
+        from channelstream.exceptions import BadSignature
+        from channelstream.wsgi_views.wsgi_security import verify_signature
+
+        checker = self.checker()
+        now = time.time()
+        token = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        verify_signature(checker, token, max_age=60)
+        monkeypatch.setattr(time, "time", lambda: now + 30)
+        verify_signature(checker, token, max_age=60)
+        assert checker.unsign.call_count == 1
+        monkeypatch.setattr(time, "time", lambda: now + 90)
+        with pytest.raises(BadSignature):
+            verify_signature(checker, token, max_age=60)
+        # without age validation token is good forever
+        verify_signature(checker, token)
+
+    def test_cache_is_bounded(self):
+        from itsdangerous import TimestampSigner
+        from channelstream.wsgi_views import wsgi_security
+
+        wsgi_security.configure(cache_size=2)
+        checker = self.checker()
+        signer = TimestampSigner("secret")
+        tokens = [signer.sign(str(i)).decode("utf8") for i in range(3)]
+        for token in tokens:
+            wsgi_security.verify_signature(checker, token, max_age=60)
+        assert list(wsgi_security._verified) == [
+            (checker, tokens[1]),
+            (checker, tokens[2]),
+        ]
+        wsgi_security.verify_signature(checker, tokens[0], max_age=60)
+        assert checker.unsign.call_count == 4
+
+    def test_cache_disabled(self):
+        from itsdangerous import TimestampSigner
+        from channelstream.wsgi_views import wsgi_security
+
+        wsgi_security.configure(cache_size=0)
+        checker = self.checker()
+        token = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        wsgi_security.verify_signature(checker, token, max_age=60)
+        wsgi_security.verify_signature(checker, token, max_age=60)
+        assert checker.unsign.call_count == 2
+        assert len(wsgi_security._verified) == 0
+
+    def test_static_key_checker(self):
+        from channelstream.exceptions import BadSignature
+        from channelstream.utils import StaticKeyChecker
+        from channelstream.wsgi_views.wsgi_security import verify_signature
+
+        checker = StaticKeyChecker("secret")
+        verify_signature(checker, "secret", max_age=60)
+        verify_signature(checker, "secret")
+        with pytest.raises(BadSignature):
+            verify_signature(checker, "secreT", max_age=60)
+        with pytest.raises(BadSignature):
+            verify_signature(checker, "", max_age=60)
+
+    def test_api_factory(self, dummy_request, pyramid_config):
+        from channelstream.utils import StaticKeyChecker
+        from channelstream.wsgi_views.wsgi_security import APIFactory
+
+        config, settings = pyramid_config
+        settings.update(
+            {"allow_posting_from": ["127.0.0.1"], "validate_requests": True}
+        )
+        config.registry.signature_checker = StaticKeyChecker("secret")
+        dummy_request.environ["REMOTE_ADDR"] = "127.0.0.1"
+        assert APIFactory(dummy_request).__acl__ == []
+        dummy_request.headers["x-channelstream-secret"] = "secret"
+        assert APIFactory(dummy_request).__acl__ != []
+
+
+@pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
+class TestAdminViews(object):
+    def connect(self, dummy_request, username, conn_id, channels):
+        from channelstream.wsgi_views.server import connect
+
+        dummy_request.json_body = {
+            "username": username,
+            "conn_id": str(conn_id),
+            "channels": channels,
+        }
+        connect(dummy_request)
+
+    def test_admin_json(self, dummy_request, test_uuids):
+        from channelstream import gc
+        from channelstream.wsgi_views.server import ServerViews
+
+        self.connect(dummy_request, "test1", test_uuids[1], ["a", "b"])
+        self.connect(dummy_request, "test1", test_uuids[2], ["a"])
+        self.connect(dummy_request, "test2", test_uuids[3], ["b"])
+        get_state().connections[test_uuids[3]].mark_for_gc()
+        gc.gc_conns()
+        result = ServerViews(dummy_request).admin_json()
+        assert result["remembered_user_count"] == 2
+        assert result["unique_user_count"] == 1
+        assert result["total_connections"] == 2
+        assert result["total_channels"] == 2
+        assert result["listed_channels"] == 2
+        assert sorted(result["channels"].keys()) == ["a", "b"]
+        assert result["channels"]["a"]["users"] == ["test1"]
+        assert "users" not in result
+
+    def test_admin_page_tells_channels_are_truncated(
+        self, dummy_request, test_uuids, monkeypatch
+    ):
+        from channelstream.wsgi_views import server
+
+        monkeypatch.setattr(server, "ADMIN_CHANNELS", 1)
+        self.connect(dummy_request, "test1", test_uuids[1], ["a", "b"])
+        views = server.ServerViews(dummy_request)
+        assert views.admin() == {"total_channels": 2, "listed_channels": 1}
+        result = views.admin_json()
+        assert result["total_channels"] == 2
+        assert result["listed_channels"] == 1
+        assert len(result["channels"]) == 1
+
+    def test_admin_json_counts_deliveries_of_workers(self, dummy_request, test_uuids):
+        from channelstream import operations
+        from channelstream.wsgi_views.server import ServerViews
+
+        self.connect(dummy_request, "test1", test_uuids[1], ["a"])
+        self.connect(dummy_request, "test2", test_uuids[2], ["a"])
+        # connection served by other worker replicated over the bus
+        get_state().connections[test_uuids[2]].owner = "worker-b"
+        msg = {"type": "message", "user": "test1", "channel": "a", "message": {}}
+        operations.pass_message(msg, get_state().stats)
+        stats = {"total_messages": 1, "connections": 1}
+        operations.apply_remote("stats", stats, "worker-b")
+        result = ServerViews(dummy_request).admin_json()
+        assert result["total_messages"] == 2
+        assert result["nodes"] == 2
+
+    def test_admin_users(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import ServerViews
+
+        for i in range(4):
+            self.connect(dummy_request, "user{}".format(i), test_uuids[i], ["a"])
+        self.connect(dummy_request, "other", test_uuids[4], ["a"])
+        views = ServerViews(dummy_request)
+        dummy_request.GET = MultiDict({"offset": "1", "limit": "2"})
+        result = views.admin_users()
+        assert result["total"] == 5
+        assert [u["user"] for u in result["users"]] == ["user1", "user2"]
+        assert result["users"][0]["connections"] == [test_uuids[1]]
+        dummy_request.GET = MultiDict({"name": "user", "offset": "3"})
+        result = views.admin_users()
+        assert result["total"] == 4
+        assert [u["user"] for u in result["users"]] == ["user3"]
+        dummy_request.GET = MultiDict({"limit": "0"})
+        with pytest.raises(marshmallow.ValidationError):
+            views.admin_users()
+
+    def test_admin_users_connected(self, dummy_request, test_uuids):
+        from channelstream.user import User
+        from channelstream.wsgi_views.server import ServerViews
+
+        self.connect(dummy_request, "test1", test_uuids[1], ["a"])
+        get_state().users["test2"] = User("test2")
+        views = ServerViews(dummy_request)
+        dummy_request.GET = MultiDict({"connected": "false"})
+        result = views.admin_users()
+        assert [u["user"] for u in result["users"]] == ["test2"]
+        dummy_request.GET = MultiDict({"connected": "true"})
+        result = views.admin_users()
+        assert [u["user"] for u in result["users"]] == ["test1"]
+
+    def test_admin_channels(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import ServerViews
+
+        self.connect(dummy_request, "test1", test_uuids[1], ["a", "ab", "c"])
+        views = ServerViews(dummy_request)
+        dummy_request.GET = MultiDict({"name": "a", "include_users": "true"})
+        result = views.admin_channels()
+        assert result["total"] == 2
+        assert [c["name"] for c in result["channels"]] == ["a", "ab"]
+        assert result["channels"][0]["users"] == ["test1"]
+        dummy_request.GET = MultiDict({"offset": "2"})
+        result = views.admin_channels()
+        assert result["total"] == 3
+        assert [c["name"] for c in result["channels"]] == ["c"]
+        assert result["channels"][0]["users"] == []